@@ -1,29 +1,680 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, status, UploadFile, File, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
+from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ReturnDocument, UpdateOne, WriteConcern, ASCENDING, DESCENDING, monitoring
+from pymongo.errors import DuplicateKeyError
 import os
+import asyncio
+import bisect
+import contextvars
+import functools
 import logging
 import io
+import math
+import random
+import time
+import re
+import sys
+import threading
+import json
 import base64
+import hashlib
+import heapq
+import mmap
+import struct
+import tempfile
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from typing import Dict, List, Optional
 import uuid
-from datetime import datetime, timezone, timedelta
+from collections import Counter, OrderedDict, deque
+from datetime import date, datetime, time as dt_time, timezone, timedelta
+from zoneinfo import ZoneInfo
 import jwt
+import httpx
 import bcrypt
+from cachetools import LRUCache, TTLCache
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 from emergentintegrations.llm.openai import OpenAISpeechToText, OpenAITextToSpeech
+import litellm
+from litellm import acompletion
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ============== METRICS ==============
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # when set, /metrics requires "Bearer <token>"
+LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get('LOOP_LAG_INTERVAL_SECONDS', '0.5'))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    """Prometheus histogram; observe() is a bisect and three increments.
+    
+    Mongo listener callbacks run on driver threads, so very rarely an increment may be lost
+    under the GIL's non-atomic +=; that is an accepted cost of not locking on the hot path.
+    """
+    
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts, sum, count]
+    
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in list(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                bucket = format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Histograms recorded on the hot path, plus collectors that read existing stats at scrape time"""
+    
+    def __init__(self):
+        self.histograms = []
+        self.collectors = []
+    
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        histogram = Histogram(name, help_text, labelnames, buckets)
+        self.histograms.append(histogram)
+        return histogram
+    
+    def collector(self, name: str, metric_type: str, help_text: str):
+        """Register fn() -> iterable of (labels dict, value), evaluated only when scraped"""
+        def register(fn):
+            self.collectors.append((name, metric_type, help_text, fn))
+            return fn
+        return register
+    
+    def render(self) -> str:
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+        for name, metric_type, help_text, fn in self.collectors:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in fn():
+                lines.append(f"{name}{format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram(
+    "carebot_stage_seconds", "Time spent in each stage of an operation", ("operation", "stage")
+)
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "carebot_http_request_seconds", "HTTP request latency by route template", ("method", "route", "status")
+)
+MONGO_COMMAND_SECONDS = metrics.histogram(
+    "carebot_mongo_command_seconds", "MongoDB command latency reported by the driver", ("command", "outcome")
+)
+LOOP_LAG_SECONDS = metrics.histogram(
+    "carebot_event_loop_lag_seconds", "How late the event loop woke a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+
+class StageTimer:
+    """`with StageTimer("chat_message", "persist"):` records the block into STAGE_SECONDS"""
+    __slots__ = ("operation", "stage", "started", "span")
+    
+    def __init__(self, operation: str, stage: str):
+        self.operation = operation
+        self.stage = stage
+    
+    def __enter__(self):
+        # Stages double as spans when the request is traced
+        self.span = start_span(f"{self.operation}.{self.stage}").__enter__()
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self.started, self.operation, self.stage)
+        self.span.__exit__(*exc_info)
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Driver-reported durations for every command the Motor client sends"""
+    
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1_000_000, event.command_name, "ok")
+    
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1_000_000, event.command_name, "failed")
+
+class MongoPoolMonitor(monitoring.ConnectionPoolListener):
+    """Connections checked out of, and requests waiting on, each server's connection pool"""
+    
+    def __init__(self):
+        self.checked_out = {}  # server address -> connections in use
+        self.waiting = {}  # server address -> checkouts not yet served
+    
+    def saturation(self, max_pool_size: int) -> Optional[float]:
+        """Share of the busiest pool in use; None when the pool is unbounded (maxPoolSize=0)"""
+        if not max_pool_size:
+            return None
+        return max(self.checked_out.values(), default=0) / max_pool_size
+    
+    def connection_check_out_started(self, event):
+        self.waiting[event.address] = self.waiting.get(event.address, 0) + 1
+    
+    def connection_check_out_failed(self, event):
+        self.waiting[event.address] = self.waiting.get(event.address, 1) - 1
+    
+    def connection_checked_out(self, event):
+        self.waiting[event.address] = self.waiting.get(event.address, 1) - 1
+        self.checked_out[event.address] = self.checked_out.get(event.address, 0) + 1
+    
+    def connection_checked_in(self, event):
+        self.checked_out[event.address] = self.checked_out.get(event.address, 1) - 1
+    
+    def pool_closed(self, event):
+        self.checked_out.pop(event.address, None)
+        self.waiting.pop(event.address, None)
+    
+    def pool_created(self, event):
+        pass
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_cleared(self, event):
+        pass
+    
+    def connection_created(self, event):
+        pass
+    
+    def connection_ready(self, event):
+        pass
+    
+    def connection_closed(self, event):
+        pass
+
+mongo_pool = MongoPoolMonitor()
+
+class EventLoopMonitor:
+    """Samples event-loop lag: a blocked loop wakes this task late"""
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lag = 0.0
+        self.task = None
+    
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.perf_counter() - started - self.interval)
+            LOOP_LAG_SECONDS.observe(self.lag)
+    
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+loop_monitor = EventLoopMonitor(LOOP_LAG_INTERVAL_SECONDS)
+
+class MetricsMiddleware:
+    """Per-route request latency and the number of requests in flight"""
+    
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = 0
+        MetricsMiddleware.instance = self
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        status_code = 500
+        
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.in_flight -= 1
+            # The router leaves the matched route in scope; templates keep label cardinality bounded
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                status_code
+            )
+
+# ============== TRACING ==============
+
+# "none", "stdout", "file:<path>" (JSON lines) or "otlp:<url>" (OTLP/HTTP JSON, e.g. a local collector)
+TRACE_SINK = os.environ.get('TRACE_SINK', 'none')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1.0'))
+TRACE_FLUSH_SECONDS = float(os.environ.get('TRACE_FLUSH_SECONDS', '1.0'))
+TRACE_BUFFER_SPANS = int(os.environ.get('TRACE_BUFFER_SPANS', '10000'))
+# Traced requests running longer than this get the event-loop thread's stack sampled
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get('PROFILE_SLOW_REQUEST_MS', '1000'))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.1'))
+PROFILE_INTERVAL_SECONDS = float(os.environ.get('PROFILE_INTERVAL_SECONDS', '0.005'))
+PROFILE_MAX_DEPTH = 40
+SERVICE_NAME = os.environ.get('SERVICE_NAME', 'carebot-backend')
+
+class Trace:
+    """The spans of one request; request_id is echoed back as X-Request-ID"""
+    __slots__ = ("request_id", "trace_id", "sampled", "spans")
+    
+    def __init__(self, request_id: str, sampled: bool):
+        self.request_id = request_id
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.sampled = sampled
+        self.spans = []
+
+class Span:
+    """`with Span(...)` makes this the current span; finished spans are appended to their trace"""
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error", "token")
+    
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str] = None, attributes: Optional[dict] = None):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.error = None
+    
+    def __enter__(self):
+        self.token = current_span.set(self)
+        self.start_ns = time.time_ns()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        current_span.reset(self.token)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.trace.spans.append(self)
+    
+    def to_dict(self) -> dict:
+        return {
+            "request_id": self.trace.request_id,
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+class NoopSpan:
+    """Stands in for a span when the request isn't sampled, so untraced calls cost one contextvar read"""
+    __slots__ = ()
+    attributes = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        pass
+
+NOOP_SPAN = NoopSpan()
+current_span = contextvars.ContextVar("current_span", default=None)
+
+def start_span(name: str, **attributes):
+    """A child of the current span, or a no-op outside a sampled trace"""
+    parent = current_span.get()
+    if parent is None or not parent.trace.sampled:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+def traced(name: str):
+    """Decorator recording each call of an async function as a span"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with start_span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def current_request_id() -> Optional[str]:
+    span = current_span.get()
+    return span.trace.request_id if span is not None else None
+
+class StdoutSink:
+    """One JSON object per span on stdout"""
+    
+    async def write(self, spans: List[Span]):
+        lines = "".join(json.dumps(span.to_dict(), default=str) + "\n" for span in spans)
+        await asyncio.to_thread(self._write, lines)
+    
+    def _write(self, lines: str):
+        sys.stdout.write(lines)
+        sys.stdout.flush()
+    
+    async def close(self):
+        pass
+
+class FileSink(StdoutSink):
+    """JSON lines appended to a file"""
+    
+    def __init__(self, path: str):
+        self.path = path
+    
+    def _write(self, lines: str):
+        with open(self.path, "a", encoding="utf-8") as handle:
+            handle.write(lines)
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [otlp_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+def otlp_attributes(attributes: dict) -> List[dict]:
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items()]
+
+class OTLPSink:
+    """Batches posted to an OTLP/HTTP collector in its JSON encoding"""
+    
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.http = httpx.AsyncClient(timeout=5.0)
+    
+    def encode(self, spans: List[Span]) -> dict:
+        encoded = []
+        for span in spans:
+            entry = {
+                "traceId": span.trace.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 2 if span.parent_id is None else 1,  # SERVER for the request, INTERNAL below it
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": otlp_attributes({"request.id": span.trace.request_id, **span.attributes}),
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+            }
+            if span.parent_id:
+                entry["parentSpanId"] = span.parent_id
+            encoded.append(entry)
+        return {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({"service.name": SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": "carebot.tracing"}, "spans": encoded}],
+        }]}
+    
+    async def write(self, spans: List[Span]):
+        response = await self.http.post(self.endpoint, json=self.encode(spans))
+        response.raise_for_status()
+    
+    async def close(self):
+        await self.http.aclose()
+
+def make_trace_sink(spec: str):
+    if spec == "none":
+        return None
+    if spec == "stdout":
+        return StdoutSink()
+    if spec.startswith("file:"):
+        return FileSink(spec[len("file:"):])
+    if spec.startswith("otlp:"):
+        return OTLPSink(spec[len("otlp:"):] or "http://localhost:4318/v1/traces")
+    raise ValueError(f"Unknown TRACE_SINK {spec!r}")
+
+class TraceExporter:
+    """Buffers finished traces and hands them to the sink in batches, off the request path"""
+    
+    def __init__(self, sink, flush_seconds: float, max_spans: int):
+        self.sink = sink
+        self.flush_seconds = flush_seconds
+        self.buffer = deque(maxlen=max_spans)  # oldest spans dropped if the sink falls behind
+        self.task = None
+        self.stats = {"exported": 0, "failed": 0, "dropped": 0}
+    
+    @property
+    def enabled(self) -> bool:
+        return self.sink is not None
+    
+    def submit(self, trace: Trace):
+        overflow = len(self.buffer) + len(trace.spans) - self.buffer.maxlen
+        if overflow > 0:
+            self.stats["dropped"] += overflow
+        self.buffer.extend(trace.spans)
+    
+    def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+    
+    async def flush(self):
+        if not self.buffer:
+            return
+        batch = list(self.buffer)
+        self.buffer.clear()
+        try:
+            await self.sink.write(batch)
+            self.stats["exported"] += len(batch)
+        except Exception as e:
+            self.stats["failed"] += len(batch)
+            logger.warning(f"Trace export failed: {e}")
+    
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.enabled:
+            await self.flush()
+            await self.sink.close()
+
+trace_exporter = TraceExporter(make_trace_sink(TRACE_SINK), TRACE_FLUSH_SECONDS, TRACE_BUFFER_SPANS)
+
+def collapse_stack(frame, max_depth: int) -> str:
+    """Root-first "file:function:line;..." as used by flame graph tools"""
+    frames = []
+    while frame is not None and len(frames) < max_depth:
+        code = frame.f_code
+        frames.append(f"{Path(code.co_filename).name}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+class SlowRequestProfiler:
+    """Statistical profiler for slow requests.
+    
+    A sampled share of traced requests is armed on arrival. Once an armed request has run past
+    the threshold, a daemon thread snapshots the event-loop thread's stack every interval and
+    counts it against that request. Whatever the loop was busy with while the request waited is
+    what made it slow, so samples are not limited to the request's own frames. The thread
+    sleeps on a condition while nothing is armed, and until the oldest armed request reaches
+    the threshold.
+    """
+    
+    def __init__(self, threshold_seconds: float, sample_rate: float, interval: float):
+        self.threshold = threshold_seconds
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.armed = {}  # request id -> (started, Counter of collapsed stacks)
+        # Guards `armed` and wakes the sampling thread when a request is armed
+        self.wake = threading.Condition()
+        self.loop_thread_id = None
+        self.thread = None
+        self.stats = {"armed": 0, "profiled": 0, "samples": 0}
+    
+    def arm(self, request_id: str) -> bool:
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return False
+        if self.thread is None:
+            self.loop_thread_id = threading.get_ident()
+            self.thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+            self.thread.start()
+        with self.wake:
+            self.armed[request_id] = (time.monotonic(), Counter())
+            self.wake.notify()
+        self.stats["armed"] += 1
+        return True
+    
+    def disarm(self, request_id: str) -> Optional[Counter]:
+        """The stacks sampled for the request, if it ran long enough to be profiled"""
+        with self.wake:
+            _, samples = self.armed.pop(request_id, (None, None))
+        if samples:
+            self.stats["profiled"] += 1
+            return samples
+        return None
+    
+    def _wait_for_slow_request(self):
+        """Block until some armed request has run past the threshold"""
+        with self.wake:
+            while True:
+                oldest = min((started for started, _ in self.armed.values()), default=None)
+                if oldest is None:
+                    self.wake.wait()
+                    continue
+                remaining = oldest + self.threshold - time.monotonic()
+                if remaining <= 0:
+                    return
+                self.wake.wait(remaining)
+    
+    def _run(self):
+        while True:
+            self._wait_for_slow_request()
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                stack = collapse_stack(frame, PROFILE_MAX_DEPTH)
+                del frame
+                now = time.monotonic()
+                with self.wake:
+                    for started, samples in self.armed.values():
+                        if now - started >= self.threshold:
+                            samples[stack] += 1
+                self.stats["samples"] += 1
+            time.sleep(self.interval)
+
+slow_request_profiler = SlowRequestProfiler(PROFILE_SLOW_REQUEST_MS / 1000, PROFILE_SAMPLE_RATE, PROFILE_INTERVAL_SECONDS)
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """Child spans for driver commands.
+    
+    Motor runs the driver on executor threads with a copy of the caller's context, so the
+    current span seen here is the one that issued the command.
+    """
+    
+    def __init__(self):
+        self.collections = {}  # driver request id -> collection name
+    
+    def started(self, event):
+        if current_span.get() is not None:
+            self.collections[event.request_id] = event.command.get(event.command_name)
+    
+    def finish(self, event, error: Optional[str]):
+        collection = self.collections.pop(event.request_id, None)
+        parent = current_span.get()
+        if parent is None or not parent.trace.sampled:
+            return
+        span = Span(parent.trace, f"mongo.{event.command_name}", parent.span_id, {
+            "db.operation": event.command_name,
+            "db.collection": str(collection),
+        })
+        span.end_ns = time.time_ns()
+        span.start_ns = span.end_ns - event.duration_micros * 1000
+        span.error = error
+        parent.trace.spans.append(span)
+    
+    def succeeded(self, event):
+        self.finish(event, None)
+    
+    def failed(self, event):
+        self.finish(event, str(event.failure.get("errmsg", "failed")))
+
+class TracingMiddleware:
+    """Assigns every request an ID (X-Request-ID in and out) and records its spans when sampled"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        sampled = trace_exporter.enabled and random.random() < TRACE_SAMPLE_RATE
+        trace = Trace(request_id, sampled)
+        method = scope.get("method", "WEBSOCKET")
+        root = Span(trace, method, attributes={"http.method": method, "http.target": scope["path"]})
+        header = (b"x-request-id", request_id.encode("latin-1"))
+        
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), header]
+                root.attributes["http.status_code"] = message["status"]
+            await send(message)
+        
+        profiling = sampled and slow_request_profiler.arm(request_id)
+        try:
+            with root:
+                await self.app(scope, receive, send_with_id)
+        finally:
+            route = scope.get("route")
+            root.name = f"{method} {getattr(route, 'path', scope['path'])}"
+            if profiling:
+                samples = slow_request_profiler.disarm(request_id)
+                if samples:
+                    root.attributes["profile.samples"] = sum(samples.values())
+                    root.attributes["profile.stacks"] = [f"{stack} {count}" for stack, count in samples.most_common(50)]
+            if sampled:
+                trace_exporter.submit(trace)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandTimer(), MongoCommandTracer(), mongo_pool])
 db = client[os.environ['DB_NAME']]
 
 # JWT Config
@@ -79,7 +730,10 @@ class ChatMessageResponse(BaseModel):
     content: str
     severity: Optional[str] = None  # "mild", "consultation", "emergency"
     suggestions: Optional[List[str]] = None
+    truncated: bool = False  # reply cut off at the streaming length cap
     timestamp: str
+    # Set on an emergency notice: the model's answer follows as the session's next message
+    follow_up_pending: bool = False
 
 class ChatSessionResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -98,6 +752,15 @@ class DoctorResponse(BaseModel):
     rating: float
     available_slots: List[str]
     image_url: str
+    # Weekday ("mon".."sun") -> [["09:00", "12:00"], ...] opening hours for timestamped slots
+    weekly_schedule: Optional[Dict[str, List[List[str]]]] = None
+
+class SlotResponse(BaseModel):
+    doctor_id: str
+    doctor_name: str
+    specialty: str
+    start: str  # ISO 8601 with offset; book it by passing this string as the slot
+    end: str
 
 class AppointmentCreate(BaseModel):
     doctor_id: str
@@ -126,34 +789,319 @@ def hash_password(password: str) -> str:
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_token(user_id: str, email: str) -> str:
+# bcrypt releases the GIL, so a small thread pool keeps hashing off the event loop
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '4'))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '256'))
+
+password_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+password_hash_stats = {"pending": 0, "peak_queue_depth": 0, "completed": 0, "rejected": 0}
+
+def password_hash_queue_depth() -> int:
+    """Jobs waiting for a free worker"""
+    return max(0, password_hash_stats["pending"] - PASSWORD_HASH_WORKERS)
+
+async def run_password_job(func, *args):
+    if password_hash_stats["pending"] >= PASSWORD_HASH_MAX_PENDING:
+        password_hash_stats["rejected"] += 1
+        raise HTTPException(
+            status_code=503,
+            detail="Authentication service is busy, please retry shortly",
+            headers={"Retry-After": "1"}
+        )
+    
+    password_hash_stats["pending"] += 1
+    password_hash_stats["peak_queue_depth"] = max(password_hash_stats["peak_queue_depth"], password_hash_queue_depth())
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_hash_executor, func, *args)
+    finally:
+        password_hash_stats["pending"] -= 1
+        password_hash_stats["completed"] += 1
+
+async def hash_password_async(password: str) -> str:
+    return await run_password_job(hash_password, password)
+
+async def verify_password_async(password: str, hashed: str) -> bool:
+    return await run_password_job(verify_password, password, hashed)
+
+def create_token(user_id: str, email: str, profile: Optional[dict] = None) -> str:
     payload = {
         "sub": user_id,
         "email": email,
         "exp": datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     }
+    if TRUST_TOKEN_CLAIMS and profile:
+        payload["profile"] = {field: profile.get(field) for field in TOKEN_PROFILE_FIELDS}
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+# ============== USER CACHE ==============
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', '60'))
+
+# When enabled, tokens carry a signed copy of the profile so read-only routes skip the user lookup
+TRUST_TOKEN_CLAIMS = os.environ.get('TRUST_TOKEN_CLAIMS', 'false').lower() == 'true'
+TOKEN_PROFILE_FIELDS = ("full_name", "age", "existing_conditions", "created_at")
+
+class UserCache:
+    """Bounded TTL/LRU cache of user profiles keyed by user id"""
+    
+    def __init__(self, maxsize: int, ttl: int):
+        self._users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id: str) -> Optional[dict]:
+        user = self._users.get(user_id)
+        if user is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(user)
+    
+    def set(self, user_id: str, user: dict):
+        self._users[user_id] = dict(user)
+    
+    def invalidate(self, user_id: str):
+        self._users.pop(user_id, None)
+    
+    def stats(self) -> dict:
+        return {"size": len(self._users), "hits": self.hits, "misses": self.misses}
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+
+def invalidate_cached_user(user_id: str):
+    """Drop a user's cached profile. Call whenever a user document is modified or deleted."""
+    user_cache.invalidate(user_id)
+
+def decode_access_token(token: str) -> dict:
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get("sub")
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    
+    if not payload.get("sub"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+async def load_user(user_id: str) -> dict:
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    user_cache.set(user_id, user)
+    return user
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    with StageTimer("auth", "get_current_user"):
+        payload = decode_access_token(credentials.credentials)
+        return await load_user(payload["sub"])
+
+async def get_token_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Dependency for hot read-only routes: trusts the token's signed profile when TRUST_TOKEN_CLAIMS is on"""
+    with StageTimer("auth", "get_token_user"):
+        payload = decode_access_token(credentials.credentials)
+        profile = payload.get("profile")
+        if TRUST_TOKEN_CLAIMS and profile:
+            return {"id": payload["sub"], "email": payload.get("email"), **profile}
+        return await load_user(payload["sub"])
+
+# ============== RATE LIMITING ==============
+
+# Per-user limits by endpoint class, as "class=count/period:burst" with period s, m or h; a class
+# left out is unlimited. Auth routes have no user yet: they spend from a bucket for the submitted
+# email (auth_email) and one for the client address (auth_ip), so neither spraying many emails
+# from one address nor one email from many addresses gets around the limit.
+RATE_LIMITS = os.environ.get(
+    'RATE_LIMITS',
+    'read=20/s:40,write=30/m:10,llm=20/m:5,voice=30/m:10,auth_email=10/m:5,auth_ip=60/m:30'
+)
+# Limits shared by all users: per process with the memory backend, cluster-wide with mongo
+RATE_LIMITS_GLOBAL = os.environ.get('RATE_LIMITS_GLOBAL', 'llm=50/s:100,voice=50/s:100')
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # "memory" or "mongo"
+RATE_LIMIT_PRUNE_SECONDS = float(os.environ.get('RATE_LIMIT_PRUNE_SECONDS', '10'))
+# Proxies in front of the app that append to X-Forwarded-For; 0 trusts only the socket address
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+RATE_LIMIT_CAS_ATTEMPTS = 5
+RATE_PERIODS = {"s": 1, "m": 60, "h": 3600}
+
+def parse_rate_limits(spec: str) -> Dict[str, tuple]:
+    """"llm=20/m:5" -> {"llm": (seconds per token, burst)}"""
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        match = re.fullmatch(r"(\w+)=(\d+)/([smh])(?::(\d+))?", entry)
+        if not match:
+            raise ValueError(f"Invalid rate limit {entry!r}")
+        endpoint_class, count, period, burst = match.groups()
+        limits[endpoint_class] = (RATE_PERIODS[period] / int(count), int(burst or count))
+    return limits
+
+class MemoryBucketStore:
+    """Token buckets held in this process.
+    
+    Each bucket is kept as its theoretical arrival time (GCRA): the moment it would be full
+    again. That single number replaces a token count and refill timestamp, so taking a token is
+    a dict lookup and a comparison. Buckets whose time has passed are full; they are dropped
+    by a sweep that runs at most once per prune interval, keeping the per-request cost constant.
+    """
+    
+    def __init__(self, prune_seconds: float):
+        self.prune_seconds = prune_seconds
+        self.next_prune = time.monotonic() + prune_seconds
+        self.tats = {}
+    
+    async def take(self, key: str, interval: float, burst: int) -> float:
+        """Spend one token; 0 if allowed, else the seconds until one is available"""
+        now = time.monotonic()
+        tat = self.tats.get(key, now)
+        if tat < now:
+            tat = now
+        tat += interval
+        excess = tat - now - interval * burst
+        if excess > 0:
+            return excess
+        if now >= self.next_prune:
+            self.next_prune = now + self.prune_seconds
+            self.tats = {k: v for k, v in self.tats.items() if v > now}
+        self.tats[key] = tat
+        return 0.0
+    
+    async def refund(self, key: str, interval: float):
+        """Give back a token spent by take()"""
+        tat = self.tats.get(key)
+        if tat is not None:
+            self.tats[key] = tat - interval
+
+class MongoBucketStore:
+    """Token buckets shared by every node through MongoDB.
+    
+    Same arrival-time state, updated with a compare-and-set on the stored value so it only
+    needs plain document operations. Costs a read and a write per check instead of the memory
+    store's microseconds. When Mongo is unavailable requests are let through rather than
+    rejected. A TTL index removes buckets once they are full again.
+    """
+    
+    def __init__(self, collection):
+        self.collection = collection
+        self.stats = {"conflicts": 0, "errors": 0}
+    
+    async def take(self, key: str, interval: float, burst: int) -> float:
+        try:
+            for _ in range(RATE_LIMIT_CAS_ATTEMPTS):
+                now = time.time()
+                bucket = await self.collection.find_one({"_id": key}, {"tat": 1})
+                tat = max(bucket["tat"], now) + interval if bucket else now + interval
+                excess = tat - now - interval * burst
+                if excess > 0:
+                    return excess
+                update = {"tat": tat, "expires": datetime.fromtimestamp(tat, timezone.utc)}
+                if bucket is None:
+                    try:
+                        await self.collection.insert_one({"_id": key, **update})
+                        return 0.0
+                    except DuplicateKeyError:
+                        pass
+                else:
+                    result = await self.collection.update_one({"_id": key, "tat": bucket["tat"]}, {"$set": update})
+                    if result.matched_count:
+                        return 0.0
+                self.stats["conflicts"] += 1
+            # Heavily contended bucket: have the client back off for about one token
+            return interval
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Rate limit store unavailable, allowing request: {e}")
+            return 0.0
+    
+    async def refund(self, key: str, interval: float):
+        try:
+            await self.collection.update_one({"_id": key}, {"$inc": {"tat": -interval}})
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Rate limit store unavailable, token not refunded: {e}")
+
+class RateLimiter:
+    """Per-user and global token buckets for each endpoint class, rejecting with 429 and Retry-After"""
+    
+    def __init__(self, store, limits: Dict[str, tuple], global_limits: Dict[str, tuple]):
+        self.store = store
+        self.limits = limits
+        self.global_limits = global_limits
+        self.stats = {}  # (endpoint class, scope) -> rejections
+    
+    def _reject(self, endpoint_class: str, scope: str, retry_after: float):
+        key = (endpoint_class, scope)
+        self.stats[key] = self.stats.get(key, 0) + 1
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests, please slow down" if scope == "user" else "Service is busy, please retry shortly",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+    
+    async def check(self, endpoint_class: str, subject: str):
+        await self.check_all([(endpoint_class, subject)])
+    
+    async def check_all(self, subjects: List[tuple]):
+        """Spend a token from each (endpoint class, subject) bucket, then from each class's global one.
+        
+        The callers' own buckets come first, so one caller hammering an endpoint can't drain
+        the global ones. A rejection refunds every token already spent for the request.
+        """
+        buckets = [
+            (endpoint_class, f"{endpoint_class}:{subject}", "user", self.limits[endpoint_class])
+            for endpoint_class, subject in subjects if endpoint_class in self.limits
+        ]
+        buckets += [
+            (endpoint_class, f"{endpoint_class}:*", "global", self.global_limits[endpoint_class])
+            for endpoint_class in dict.fromkeys(endpoint_class for endpoint_class, _ in subjects)
+            if endpoint_class in self.global_limits
+        ]
+        spent = []
+        for endpoint_class, key, scope, (interval, burst) in buckets:
+            retry_after = await self.store.take(key, interval, burst)
+            if retry_after:
+                for spent_key, spent_interval in spent:
+                    await self.store.refund(spent_key, spent_interval)
+                self._reject(endpoint_class, scope, retry_after)
+            spent.append((key, interval))
+
+def make_bucket_store(backend: str):
+    if backend == "memory":
+        return MemoryBucketStore(RATE_LIMIT_PRUNE_SECONDS)
+    if backend == "mongo":
+        return MongoBucketStore(db.rate_limits)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND {backend!r}")
+
+rate_limiter = RateLimiter(make_bucket_store(RATE_LIMIT_BACKEND), parse_rate_limits(RATE_LIMITS), parse_rate_limits(RATE_LIMITS_GLOBAL))
+
+def rate_limited(user_dependency, endpoint_class: str):
+    """Wrap a user dependency so the route also spends a token of `endpoint_class`"""
+    async def dependency(current_user: dict = Depends(user_dependency)) -> dict:
+        await rate_limiter.check(endpoint_class, current_user["id"])
+        return current_user
+    return dependency
+
+def client_address(request: Request) -> str:
+    """The caller's address: the X-Forwarded-For entry added by the outermost trusted proxy"""
+    if TRUSTED_PROXY_HOPS:
+        hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+async def check_auth_rate(request: Request, email: str):
+    """Limit sign-ins and sign-ups per submitted email and, separately, per client address"""
+    await rate_limiter.check_all([("auth_email", email.lower()), ("auth_ip", client_address(request))])
 
 # ============== AUTH ROUTES ==============
 
 @api_router.post("/auth/register", response_model=TokenResponse)
-async def register(user_data: UserCreate):
+async def register(user_data: UserCreate, request: Request):
+    await check_auth_rate(request, user_data.email)
     existing = await db.users.find_one({"email": user_data.email})
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
@@ -164,7 +1112,7 @@ async def register(user_data: UserCreate):
     user_doc = {
         "id": user_id,
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": await hash_password_async(user_data.password),
         "full_name": user_data.full_name,
         "age": user_data.age,
         "existing_conditions": user_data.existing_conditions or [],
@@ -173,7 +1121,7 @@ async def register(user_data: UserCreate):
     
     await db.users.insert_one(user_doc)
     
-    token = create_token(user_id, user_data.email)
+    token = create_token(user_id, user_data.email, user_doc)
     
     user_response = UserResponse(
         id=user_id,
@@ -187,12 +1135,13 @@ async def register(user_data: UserCreate):
     return TokenResponse(access_token=token, user=user_response)
 
 @api_router.post("/auth/login", response_model=TokenResponse)
-async def login(credentials: UserLogin):
+async def login(credentials: UserLogin, request: Request):
+    await check_auth_rate(request, credentials.email)
     user = await db.users.find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await verify_password_async(credentials.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    token = create_token(user["id"], user["email"])
+    token = create_token(user["id"], user["email"], user)
     
     user_response = UserResponse(
         id=user["id"],
@@ -206,190 +1155,1428 @@ async def login(credentials: UserLogin):
     return TokenResponse(access_token=token, user=user_response)
 
 @api_router.get("/auth/me", response_model=UserResponse)
-async def get_me(current_user: dict = Depends(get_current_user)):
+async def get_me(current_user: dict = Depends(rate_limited(get_token_user, "read"))):
     return UserResponse(**current_user)
 
-# ============== CHAT ROUTES ==============
+# ============== PAGINATION ==============
 
-SYSTEM_PROMPT = """You are CareBot, an AI healthcare assistant. Your role is to:
+PAGE_MAX_LIMIT = 200
 
-1. Listen to patient symptoms with empathy and care
-2. Ask clarifying questions about symptoms, duration, and severity
-3. Classify the urgency:
-   - MILD: Common, treatable issues (cold, minor headache, small cuts)
-   - CONSULTATION: Should see a doctor but not urgent (persistent symptoms, moderate pain)
-   - EMERGENCY: Needs immediate care (chest pain, severe bleeding, breathing difficulty, stroke symptoms)
+def encode_cursor(doc: dict, field: str) -> str:
+    raw = json.dumps([doc[field], doc["id"]]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
 
-4. For MILD issues, you may suggest:
-   - Common OTC medications (with standard dosage guidance)
-   - Home care tips (rest, hydration, etc.)
-   
-5. Always include this disclaimer for any medical guidance:
-   "⚠️ This is not a medical diagnosis. Please consult a healthcare professional if symptoms persist or worsen."
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        value, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # Both halves go straight into a query, so anything but a scalar (e.g. {"$ne": null}) is refused
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)) or not isinstance(doc_id, str):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, doc_id
 
-6. For EMERGENCY cases, immediately advise:
-   "🚨 EMERGENCY: Please call emergency services (911) or go to the nearest emergency room immediately."
+async def fetch_page(
+    collection: str,
+    query: dict,
+    field: str,
+    limit: int,
+    before: Optional[str],
+    after: Optional[str],
+    response: Response,
+    oldest_first: bool = False
+) -> List[dict]:
+    """Keyset pagination over (field, id).
 
-7. Be warm, reassuring, and professional. Use simple language.
+    `before` pages towards older documents and `after` towards newer ones. Cursors for the
+    adjacent pages are returned in the X-Before-Cursor / X-After-Cursor headers.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    
+    cursor = before or after
+    if cursor:
+        value, doc_id = decode_cursor(cursor)
+        op = "$lt" if before else "$gt"
+        query = {**query, "$or": [{field: {op: value}}, {field: value, "id": {op: doc_id}}]}
+    
+    # Walk away from the cursor; without one, start from the newest document
+    direction = ASCENDING if after else DESCENDING
+    docs = await db[collection].find(query, {"_id": 0}).sort(
+        [(field, direction), ("id", direction)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    if after:
+        docs.reverse()
+    
+    # docs is now newest first; the cursor itself proves there is more on its side
+    older_remaining = True if after else has_more
+    newer_remaining = has_more if after else bool(before)
+    if docs and older_remaining:
+        response.headers["X-Before-Cursor"] = encode_cursor(docs[-1], field)
+    if docs and newer_remaining:
+        response.headers["X-After-Cursor"] = encode_cursor(docs[0], field)
+    
+    if oldest_first:
+        docs.reverse()
+    return docs
 
-IMPORTANT RULES:
-- Never prescribe prescription medications
-- Never diagnose serious conditions
-- Always recommend doctor consultation for unclear or serious symptoms
-- Suggest booking an appointment when appropriate
+# ============== PROVIDER CLIENTS ==============
 
-Respond in a conversational, caring manner. Keep responses concise but helpful."""
+LLM_MAX_CONCURRENT = int(os.environ.get('LLM_MAX_CONCURRENT', '32'))
+LLM_MAX_CONCURRENT_PER_USER = int(os.environ.get('LLM_MAX_CONCURRENT_PER_USER', '2'))
+VOICE_MAX_CONCURRENT = int(os.environ.get('VOICE_MAX_CONCURRENT', '16'))
+VOICE_MAX_CONCURRENT_PER_USER = int(os.environ.get('VOICE_MAX_CONCURRENT_PER_USER', '2'))
+# Longest a request may queue for a free upstream slot before getting a 429
+PROVIDER_QUEUE_DEADLINE_SECONDS = float(os.environ.get('PROVIDER_QUEUE_DEADLINE_SECONDS', '10'))
 
-async def analyze_with_ai(message: str, session_id: str, user_context: dict) -> dict:
-    """Analyze symptoms using Claude AI"""
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
+class ProviderClients:
+    """Provider key and speech clients shared by every request.
     
-    # Build context about user
-    context_parts = []
-    if user_context.get("age"):
-        context_parts.append(f"Patient age: {user_context['age']}")
-    if user_context.get("existing_conditions"):
-        context_parts.append(f"Existing conditions: {', '.join(user_context['existing_conditions'])}")
+    Chat connections are not pooled here: litellm sends Anthropic calls (LlmChat's and the
+    streaming ones) through its own cached per-provider httpx client, which already keeps
+    connections alive across calls; litellm.aclient_session would only reach its OpenAI provider.
+    """
     
-    user_context_str = "\n".join(context_parts) if context_parts else "No additional patient context available."
+    def __init__(self, api_key: Optional[str]):
+        self.api_key = api_key
+        self.stt = OpenAISpeechToText(api_key=api_key)
+        self.tts = OpenAITextToSpeech(api_key=api_key)
     
-    enhanced_system = f"{SYSTEM_PROMPT}\n\nPatient Context:\n{user_context_str}"
+    def chat(self, session_id: str, system_message: str) -> LlmChat:
+        # A plain holder for one conversation's messages, so it is built per call
+        return LlmChat(
+            api_key=self.api_key,
+            session_id=session_id,
+            system_message=system_message
+        ).with_model(LLM_PROVIDER, LLM_MODEL)
+
+providers = ProviderClients(os.environ.get('EMERGENT_LLM_KEY'))
+
+class LimiterSlot:
+    __slots__ = ("limiter", "user_id", "started", "released")
     
-    # Get chat history for this session
-    history = await db.chat_messages.find(
-        {"session_id": session_id},
-        {"_id": 0}
-    ).sort("timestamp", 1).to_list(20)
-    
-    chat = LlmChat(
-        api_key=api_key,
-        session_id=session_id,
-        system_message=enhanced_system
-    ).with_model("anthropic", "claude-sonnet-4-5-20250929")
-    
-    # Add history to chat context
-    for msg in history:
-        if msg["role"] == "user":
-            chat.messages.append({"role": "user", "content": msg["content"]})
-        else:
-            chat.messages.append({"role": "assistant", "content": msg["content"]})
-    
-    user_message = UserMessage(text=message)
-    response = await chat.send_message(user_message)
-    
-    # Determine severity from response
-    severity = "mild"
-    response_lower = response.lower()
-    if "emergency" in response_lower or "🚨" in response or "911" in response_lower:
-        severity = "emergency"
-    elif "consult" in response_lower or "doctor" in response_lower or "appointment" in response_lower:
-        severity = "consultation"
-    
-    # Extract suggestions if any
-    suggestions = []
-    if severity == "mild":
-        if "rest" in response_lower:
-            suggestions.append("Get adequate rest")
-        if "hydrat" in response_lower or "water" in response_lower:
-            suggestions.append("Stay hydrated")
-        if "pain reliever" in response_lower or "acetaminophen" in response_lower or "ibuprofen" in response_lower:
-            suggestions.append("Consider OTC pain relievers")
+    def __init__(self, limiter, user_id: str):
+        self.limiter = limiter
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.released = False
     
-    return {
-        "response": response,
-        "severity": severity,
-        "suggestions": suggestions
-    }
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release(self)
 
-@api_router.post("/chat/message", response_model=ChatMessageResponse)
-async def send_chat_message(
-    message_data: ChatMessageCreate,
-    current_user: dict = Depends(get_current_user)
-):
-    session_id = message_data.session_id
-    now = datetime.now(timezone.utc).isoformat()
+class ConcurrencyLimiter:
+    """Caps in-flight upstream calls globally and per user, queueing briefly beyond that.
     
-    # Create new session if needed
-    if not session_id:
-        session_id = str(uuid.uuid4())
-        title = message_data.message[:50] + "..." if len(message_data.message) > 50 else message_data.message
-        await db.chat_sessions.insert_one({
-            "id": session_id,
-            "user_id": current_user["id"],
-            "title": title,
-            "created_at": now,
-            "last_message_at": now
-        })
+    A request is rejected with 429 and a Retry-After hint when its user already has the maximum
+    in flight, or when it could not start within the deadline -- estimated up front from the
+    queue length and recent upstream latency, and enforced while it waits.
+    """
     
-    # Save user message
-    user_msg_id = str(uuid.uuid4())
-    await db.chat_messages.insert_one({
-        "id": user_msg_id,
-        "session_id": session_id,
-        "role": "user",
-        "content": message_data.message,
-        "severity": None,
-        "suggestions": None,
-        "timestamp": now
-    })
+    def __init__(self, name: str, max_concurrent: int, max_per_user: int, deadline: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.deadline = deadline
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._per_user = {}
+        self.waiting = 0
+        self.in_flight = 0
+        self.avg_upstream_seconds = 1.0
+        self.stats = {
+            "admitted": 0,
+            "rejected": 0,
+            "queue_wait_seconds_total": 0.0,
+            "queue_wait_seconds_max": 0.0,
+            "upstream_seconds_total": 0.0,
+            "upstream_seconds_max": 0.0,
+            "completed": 0
+        }
     
-    # Get AI response
-    try:
-        ai_result = await analyze_with_ai(
-            message_data.message,
-            session_id,
-            current_user
+    def estimated_wait(self) -> float:
+        if self.in_flight + self.waiting < self.max_concurrent:
+            return 0.0
+        return (self.waiting + 1) * self.avg_upstream_seconds / self.max_concurrent
+    
+    def _reject(self, retry_after: float, detail: str):
+        self.stats["rejected"] += 1
+        raise HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
         )
-    except Exception as e:
-        logging.error(f"AI Error: {e}")
-        ai_result = {
-            "response": "I apologize, but I'm having trouble processing your request right now. Please try again or contact support if the issue persists.",
-            "severity": "consultation",
-            "suggestions": ["Please try again later"]
-        }
     
-    # Save AI response
-    ai_msg_id = str(uuid.uuid4())
-    ai_timestamp = datetime.now(timezone.utc).isoformat()
+    def _release_user(self, user_id: str):
+        remaining = self._per_user.get(user_id, 1) - 1
+        if remaining > 0:
+            self._per_user[user_id] = remaining
+        else:
+            self._per_user.pop(user_id, None)
     
-    await db.chat_messages.insert_one({
-        "id": ai_msg_id,
-        "session_id": session_id,
-        "role": "assistant",
-        "content": ai_result["response"],
-        "severity": ai_result["severity"],
-        "suggestions": ai_result["suggestions"],
-        "timestamp": ai_timestamp
-    })
+    async def acquire(self, user_id: str) -> LimiterSlot:
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            self._reject(self.avg_upstream_seconds, "Too many requests in progress, please wait for the previous one")
+        estimate = self.estimated_wait()
+        if estimate > self.deadline:
+            self._reject(estimate, "Service is busy, please retry shortly")
+        
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self.waiting += 1
+        queued_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.deadline)
+        except asyncio.TimeoutError:
+            self._release_user(user_id)
+            self._reject(self.avg_upstream_seconds, "Service is busy, please retry shortly")
+        except BaseException:
+            # Cancelled while queued (client gone, sibling TTS chunk cancelled): no slot was taken
+            self._release_user(user_id)
+            raise
+        finally:
+            self.waiting -= 1
+        
+        queue_wait = time.perf_counter() - queued_at
+        self.in_flight += 1
+        self.stats["admitted"] += 1
+        self.stats["queue_wait_seconds_total"] += queue_wait
+        self.stats["queue_wait_seconds_max"] = max(self.stats["queue_wait_seconds_max"], queue_wait)
+        return LimiterSlot(self, user_id)
     
-    # Update session last message time
-    await db.chat_sessions.update_one(
-        {"id": session_id},
-        {"$set": {"last_message_at": ai_timestamp}}
-    )
+    def release(self, slot: LimiterSlot):
+        upstream = time.perf_counter() - slot.started
+        self.avg_upstream_seconds = 0.8 * self.avg_upstream_seconds + 0.2 * upstream
+        self.stats["upstream_seconds_total"] += upstream
+        self.stats["upstream_seconds_max"] = max(self.stats["upstream_seconds_max"], upstream)
+        self.stats["completed"] += 1
+        self.in_flight -= 1
+        self._semaphore.release()
+        self._release_user(slot.user_id)
     
-    return ChatMessageResponse(
-        id=ai_msg_id,
-        session_id=session_id,
-        role="assistant",
-        content=ai_result["response"],
-        severity=ai_result["severity"],
-        suggestions=ai_result["suggestions"],
-        timestamp=ai_timestamp
-    )
+    @asynccontextmanager
+    async def slot(self, user_id: str):
+        slot = await self.acquire(user_id)
+        try:
+            yield slot
+        finally:
+            slot.release()
 
-@api_router.get("/chat/sessions", response_model=List[ChatSessionResponse])
-async def get_chat_sessions(current_user: dict = Depends(get_current_user)):
-    sessions = await db.chat_sessions.find(
-        {"user_id": current_user["id"]},
-        {"_id": 0}
-    ).sort("last_message_at", -1).to_list(50)
-    return sessions
+llm_limiter = ConcurrencyLimiter("llm", LLM_MAX_CONCURRENT, LLM_MAX_CONCURRENT_PER_USER, PROVIDER_QUEUE_DEADLINE_SECONDS)
+voice_limiter = ConcurrencyLimiter("voice", VOICE_MAX_CONCURRENT, VOICE_MAX_CONCURRENT_PER_USER, PROVIDER_QUEUE_DEADLINE_SECONDS)
 
-@api_router.get("/chat/sessions/{session_id}/messages", response_model=List[ChatMessageResponse])
-async def get_session_messages(
+# ============== LLM RESILIENCE ==============
+
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '30'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BASE_DELAY_SECONDS = float(os.environ.get('LLM_RETRY_BASE_DELAY_SECONDS', '0.5'))
+# Hedging sends a second identical request when the first is slower than the recent p95
+LLM_HEDGE_ENABLED = os.environ.get('LLM_HEDGE_ENABLED', 'false').lower() == 'true'
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('LLM_HEDGE_MIN_DELAY_SECONDS', '2'))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('LLM_BREAKER_FAILURE_THRESHOLD', '5'))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS', '30'))
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    httpx.TransportError,
+    litellm.RateLimitError,
+    litellm.APIConnectionError,
+    litellm.ServiceUnavailableError,
+    litellm.InternalServerError,
+    litellm.Timeout
+)
+
+class CircuitOpenError(Exception):
+    pass
+
+def is_retryable(error: Exception) -> bool:
+    return isinstance(error, RETRYABLE_ERRORS) or getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+class CircuitBreaker:
+    """Opens after consecutive failures; after the cooldown one trial call decides whether it closes"""
+    
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.trial_started = 0.0
+    
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.state = "half_open"
+            self.trial_in_flight = False
+        if self.state == "half_open":
+            # A trial that never reported back (e.g. a lost task) is replaced after another cooldown
+            if self.trial_in_flight and time.monotonic() - self.trial_started < self.cooldown:
+                return False
+            self.trial_in_flight = True
+            self.trial_started = time.monotonic()
+        return True
+    
+    def release_trial(self):
+        """The call ended without a verdict (cancelled, or its stream closed early); let another try"""
+        self.trial_in_flight = False
+    
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+class ResilientCaller:
+    """Runs upstream calls with a timeout, jittered exponential retries, optional hedging and a
+    circuit breaker, counting every outcome.
+    
+    `factory` must start a fresh, independent request each time it is called.
+    """
+    
+    def __init__(self, breaker: CircuitBreaker):
+        self.breaker = breaker
+        self.latencies = deque(maxlen=200)
+        self.outcomes = {
+            "success": 0,
+            "success_after_retry": 0,
+            "timeout": 0,
+            "retryable_error": 0,
+            "error": 0,
+            "retried": 0,
+            "hedged": 0,
+            "hedge_won": 0,
+            "circuit_open": 0
+        }
+    
+    def check_circuit(self) -> bool:
+        """Raise when the circuit is open; True when this call is the half-open trial"""
+        if not self.breaker.allow():
+            self.outcomes["circuit_open"] += 1
+            raise CircuitOpenError("LLM provider circuit is open")
+        return self.breaker.state == "half_open"
+    
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < 20:
+            return max(LLM_HEDGE_MIN_DELAY_SECONDS, LLM_TIMEOUT_SECONDS / 2)
+        ordered = sorted(self.latencies)
+        return max(LLM_HEDGE_MIN_DELAY_SECONDS, ordered[int(len(ordered) * 0.95) - 1])
+    
+    async def _hedged(self, factory):
+        first = asyncio.ensure_future(asyncio.wait_for(factory(), LLM_TIMEOUT_SECONDS))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_delay())
+        if done:
+            return first.result()
+        
+        self.outcomes["hedged"] += 1
+        second = asyncio.ensure_future(asyncio.wait_for(factory(), LLM_TIMEOUT_SECONDS))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.outcomes["hedge_won"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def call(self, factory):
+        trial = self.check_circuit()
+        try:
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                started = time.monotonic()
+                try:
+                    if LLM_HEDGE_ENABLED:
+                        result = await self._hedged(factory)
+                    else:
+                        result = await asyncio.wait_for(factory(), LLM_TIMEOUT_SECONDS)
+                except Exception as e:
+                    retryable = is_retryable(e)
+                    if isinstance(e, asyncio.TimeoutError):
+                        self.outcomes["timeout"] += 1
+                    else:
+                        self.outcomes["retryable_error" if retryable else "error"] += 1
+                    if not retryable or attempt == LLM_MAX_RETRIES:
+                        self.breaker.record_failure()
+                        raise
+                    self.outcomes["retried"] += 1
+                    await asyncio.sleep(random.uniform(0, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+                    continue
+                
+                self.latencies.append(time.monotonic() - started)
+                self.breaker.record_success()
+                self.outcomes["success" if attempt == 0 else "success_after_retry"] += 1
+                return result
+        except BaseException:
+            # Cancelled mid-call: no verdict was recorded, so free the half-open trial
+            if trial:
+                self.breaker.release_trial()
+            raise
+
+llm_caller = ResilientCaller(CircuitBreaker(LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_COOLDOWN_SECONDS))
+
+# ============== TRIAGE CLASSIFIER ==============
+
+# Weighted phrase rules; TRIAGE_RULES_PATH may point to a JSON file with the same shape.
+# Phrases match whole words only ("*" extends to the end of a word) and the longest phrase
+# at a position wins, so weight-0 rules can absorb text such as the standard disclaimer
+# whose words would otherwise count towards a label.
+DEFAULT_TRIAGE_RULES = {
+    "severity_thresholds": {"emergency": 1.0, "consultation": 1.0},
+    "severity_rules": [
+        {"pattern": "🚨", "label": "emergency", "weight": 1.0},
+        {"pattern": "emergency", "label": "emergency", "weight": 1.0},
+        {"pattern": "911", "label": "emergency", "weight": 1.0},
+        {"pattern": "not an emergency", "label": "emergency", "weight": -1.0},
+        {"pattern": "not a medical emergency", "label": "emergency", "weight": -1.0},
+        {"pattern": "isn't an emergency", "label": "emergency", "weight": -1.0},
+        {"pattern": "non-emergency", "label": "emergency", "weight": -1.0},
+        {"pattern": "consult*", "label": "consultation", "weight": 1.0},
+        {"pattern": "doctor*", "label": "consultation", "weight": 1.0},
+        {"pattern": "appointment*", "label": "consultation", "weight": 1.0},
+        {"pattern": "physician*", "label": "consultation", "weight": 1.0},
+        {"pattern": "medical attention", "label": "consultation", "weight": 1.0},
+        {"pattern": "consult a healthcare professional if symptoms persist or worsen", "label": "consultation", "weight": 0.0}
+    ],
+    "suggestion_rules": [
+        {"pattern": "rest", "label": "Get adequate rest", "weight": 1.0},
+        {"pattern": "resting", "label": "Get adequate rest", "weight": 1.0},
+        {"pattern": "hydrat*", "label": "Stay hydrated", "weight": 1.0},
+        {"pattern": "water", "label": "Stay hydrated", "weight": 1.0},
+        {"pattern": "fluids", "label": "Stay hydrated", "weight": 1.0},
+        {"pattern": "pain reliever*", "label": "Consider OTC pain relievers", "weight": 1.0},
+        {"pattern": "acetaminophen", "label": "Consider OTC pain relievers", "weight": 1.0},
+        {"pattern": "paracetamol", "label": "Consider OTC pain relievers", "weight": 1.0},
+        {"pattern": "ibuprofen", "label": "Consider OTC pain relievers", "weight": 1.0}
+    ],
+    # Scored on the patient's own message before the LLM call; reaching the threshold puts
+    # emergency guidance in front of the reply. Weight-0 phrases absorb benign uses of an
+    # alarming word ("can't breathe through my nose"), and general questions count against.
+    "patient_emergency_threshold": 1.0,
+    "patient_emergency_rules": [
+        {"pattern": "crushing chest pain", "weight": 1.0},
+        {"pattern": "severe chest pain", "weight": 1.0},
+        {"pattern": "chest pain", "weight": 0.6},
+        {"pattern": "pain in my chest", "weight": 0.6},
+        {"pattern": "chest tightness", "weight": 0.5},
+        {"pattern": "no chest pain", "weight": -0.6},
+        {"pattern": "heart attack*", "weight": 1.0},
+        {"pattern": "signs of a heart attack", "weight": 0.0},
+        {"pattern": "symptoms of a heart attack", "weight": 0.0},
+        {"pattern": "risk of a heart attack", "weight": 0.0},
+        {"pattern": "risk of heart attack*", "weight": 0.0},
+        {"pattern": "had a heart attack", "weight": 0.0},
+        {"pattern": "can't breathe", "weight": 1.0},
+        {"pattern": "cannot breathe", "weight": 1.0},
+        {"pattern": "can't breathe through my nose", "weight": 0.0},
+        {"pattern": "cannot breathe through my nose", "weight": 0.0},
+        {"pattern": "can't breathe out of my nose", "weight": 0.0},
+        {"pattern": "can't breathe through my nostril*", "weight": 0.0},
+        {"pattern": "stuffy", "weight": -1.0},
+        {"pattern": "blocked nose", "weight": -1.0},
+        {"pattern": "congest*", "weight": -1.0},
+        {"pattern": "unable to breathe", "weight": 1.0},
+        {"pattern": "struggling to breathe", "weight": 1.0},
+        {"pattern": "struggle to breathe", "weight": 1.0},
+        {"pattern": "not breathing", "weight": 1.0},
+        {"pattern": "stopped breathing", "weight": 1.0},
+        {"pattern": "shortness of breath", "weight": 0.6},
+        {"pattern": "short of breath", "weight": 0.6},
+        {"pattern": "difficulty breathing", "weight": 0.6},
+        {"pattern": "trouble breathing", "weight": 0.6},
+        {"pattern": "hard to breathe", "weight": 0.6},
+        {"pattern": "hard time breathing", "weight": 0.6},
+        {"pattern": "can't catch my breath", "weight": 0.6},
+        {"pattern": "no shortness of breath", "weight": -0.6},
+        {"pattern": "not short of breath", "weight": -0.6},
+        {"pattern": "severe bleeding", "weight": 1.0},
+        {"pattern": "bleeding heavily", "weight": 1.0},
+        {"pattern": "heavy bleeding", "weight": 1.0},
+        {"pattern": "won't stop bleeding", "weight": 1.0},
+        {"pattern": "unconscious", "weight": 1.0},
+        {"pattern": "unresponsive", "weight": 1.0},
+        {"pattern": "passed out", "weight": 0.6},
+        {"pattern": "passing out", "weight": 0.6},
+        {"pattern": "collapsed", "weight": 0.8},
+        {"pattern": "face drooping", "weight": 1.0},
+        {"pattern": "face is droop*", "weight": 1.0},
+        {"pattern": "face droops", "weight": 1.0},
+        {"pattern": "drooping face", "weight": 1.0},
+        {"pattern": "droopy face", "weight": 1.0},
+        {"pattern": "slurred speech", "weight": 1.0},
+        {"pattern": "slurring*", "weight": 0.8},
+        {"pattern": "numbness on one side", "weight": 1.0},
+        {"pattern": "stroke", "weight": 0.6},
+        {"pattern": "having a stroke", "weight": 1.0},
+        {"pattern": "signs of a stroke", "weight": 0.0},
+        {"pattern": "symptoms of a stroke", "weight": 0.0},
+        {"pattern": "risk of a stroke", "weight": 0.0},
+        {"pattern": "risk of stroke", "weight": 0.0},
+        {"pattern": "had a stroke", "weight": 0.0},
+        {"pattern": "seizure*", "weight": 0.8},
+        {"pattern": "seizing", "weight": 0.8},
+        {"pattern": "no seizure*", "weight": 0.0},
+        {"pattern": "overdose*", "weight": 0.6},
+        {"pattern": "overdosed", "weight": 1.0},
+        {"pattern": "took an overdose", "weight": 1.0},
+        {"pattern": "too many pills", "weight": 1.0},
+        {"pattern": "too many tablets", "weight": 1.0},
+        {"pattern": "took too many", "weight": 1.0},
+        {"pattern": "swallowed too many", "weight": 1.0},
+        {"pattern": "whole bottle of", "weight": 0.8},
+        {"pattern": "swallowed bleach", "weight": 1.0},
+        {"pattern": "drank bleach", "weight": 1.0},
+        {"pattern": "swallowed poison", "weight": 1.0},
+        {"pattern": "drank poison", "weight": 1.0},
+        {"pattern": "swallowed a battery", "weight": 1.0},
+        {"pattern": "swallowed a button battery", "weight": 1.0},
+        {"pattern": "swallowed detergent", "weight": 1.0},
+        {"pattern": "swallowed antifreeze", "weight": 1.0},
+        {"pattern": "drank antifreeze", "weight": 1.0},
+        {"pattern": "poisoned", "weight": 0.8},
+        {"pattern": "possible to overdose*", "weight": 0.0},
+        {"pattern": "can you overdose*", "weight": 0.0},
+        {"pattern": "can i overdose*", "weight": 0.0},
+        {"pattern": "risk of overdose*", "weight": 0.0},
+        {"pattern": "suicid*", "weight": 1.0},
+        {"pattern": "not suicidal", "weight": 0.0},
+        {"pattern": "kill myself", "weight": 1.0},
+        {"pattern": "killing myself", "weight": 1.0},
+        {"pattern": "want to die", "weight": 1.0},
+        {"pattern": "wanna die", "weight": 1.0},
+        {"pattern": "end my life", "weight": 1.0},
+        {"pattern": "don't want to live", "weight": 1.0},
+        {"pattern": "don't want to be alive", "weight": 1.0},
+        {"pattern": "hurt myself", "weight": 0.8},
+        {"pattern": "anaphyla*", "weight": 1.0},
+        {"pattern": "throat is closing", "weight": 1.0},
+        {"pattern": "choking", "weight": 0.8},
+        {"pattern": "is it possible", "weight": -0.5},
+        {"pattern": "what happens if", "weight": -0.5},
+        {"pattern": "is it safe", "weight": -0.5},
+        {"pattern": "is it normal", "weight": -0.5},
+        {"pattern": "what are the", "weight": -0.5}
+    ]
+}
+
+class PhraseMatcher:
+    """Compiles weighted phrase rules into one regex and scores text in a single pass.
+    
+    The phrases are merged into a character trie before being turned into a regex, so at each
+    position the engine follows one branch instead of trying every phrase in turn.
+    """
+    
+    def __init__(self, rules: List[dict]):
+        self.rules = rules
+        trie = {}
+        for i, rule in enumerate(rules):
+            node = trie
+            for atom in self.phrase_atoms(rule["pattern"].lower()):
+                node = node.setdefault(atom, {})
+            node[None] = i
+        self.regex = re.compile(rf"(?<!\w){self.trie_regex(trie)}(?!\w)")
+    
+    @staticmethod
+    def phrase_atoms(phrase: str) -> List[str]:
+        atoms = []
+        for i, word in enumerate(phrase.split()):
+            if i:
+                atoms.append(r"\s+")
+            for char in word:
+                if char == "*":
+                    atoms.append(r"\w*")
+                elif char == "'":
+                    atoms.append("['’]")
+                else:
+                    atoms.append(re.escape(char))
+        return atoms
+    
+    @classmethod
+    def trie_regex(cls, node: dict) -> str:
+        # Literal continuations first, then wildcards (which can match nothing), then the
+        # end-of-phrase marker, so the longest phrase at a position wins
+        atoms = sorted((atom for atom in node if atom is not None), key=lambda atom: atom == r"\w*")
+        branches = [atom + cls.trie_regex(node[atom]) for atom in atoms]
+        if None in node:
+            branches.append(f"(?P<r{node[None]}>)")
+        return branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+    
+    def scores(self, text: str) -> dict:
+        totals = {}
+        for match in self.regex.finditer(text.lower()):
+            rule = self.rules[int(match.lastgroup[1:])]
+            key = rule["key"]
+            totals[key] = totals.get(key, 0.0) + rule["weight"]
+        return totals
+
+class TriageClassifier:
+    """Severity and home-care suggestion classifier for AI responses.
+    
+    Any object with a compatible classify() can be assigned to `triage_classifier`.
+    """
+    
+    def __init__(self, config: dict):
+        # Threshold order is precedence order, most severe first
+        self.thresholds = config["severity_thresholds"]
+        self.suggestion_labels = list(dict.fromkeys(rule["label"] for rule in config["suggestion_rules"]))
+        rules = [{**rule, "key": ("severity", rule["label"])} for rule in config["severity_rules"]]
+        rules += [{**rule, "key": ("suggestion", rule["label"])} for rule in config["suggestion_rules"]]
+        self.matcher = PhraseMatcher(rules)
+        
+        self.patient_emergency_threshold = config.get("patient_emergency_threshold", 1.0)
+        self.patient_matcher = PhraseMatcher(
+            [{**rule, "key": "emergency"} for rule in config.get("patient_emergency_rules", [])]
+        )
+    
+    def classify(self, text: str) -> dict:
+        scores = self.matcher.scores(text)
+        
+        severity = "mild"
+        for label, threshold in self.thresholds.items():
+            if scores.get(("severity", label), 0.0) >= threshold:
+                severity = label
+                break
+        
+        suggestions = []
+        if severity == "mild":
+            suggestions = [label for label in self.suggestion_labels if scores.get(("suggestion", label), 0.0) > 0]
+        
+        return {
+            "severity": severity,
+            "suggestions": suggestions
+        }
+    
+    def is_emergency_message(self, text: str) -> bool:
+        """High-confidence emergency in the patient's own words"""
+        return self.patient_matcher.scores(text).get("emergency", 0.0) >= self.patient_emergency_threshold
+
+def load_triage_rules() -> dict:
+    path = os.environ.get('TRIAGE_RULES_PATH')
+    if not path:
+        return DEFAULT_TRIAGE_RULES
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+triage_classifier = TriageClassifier(load_triage_rules())
+
+# ============== CONVERSATION CONTEXT ==============
+
+CONTEXT_CACHE_SESSIONS = int(os.environ.get('CONTEXT_CACHE_SESSIONS', '5000'))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '4000'))
+CONTEXT_MAX_MESSAGES = 50  # most turns read from Mongo at once
+# Incremental reads look back this far before the newest message seen, so a concurrent turn
+# stored after a later-stamped one is still picked up; longer than any turn takes to finish
+CONTEXT_LATE_WRITE_SECONDS = int(os.environ.get('CONTEXT_LATE_WRITE_SECONDS', '300'))
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token plus per-message overhead; close enough for windowing
+    return len(text) // 4 + 4
+
+class ConversationContext:
+    """Window of a session's turns in timestamp order, trimmed to the token budget"""
+    __slots__ = ("messages", "tokens", "last_timestamp", "seen")
+    
+    def __init__(self):
+        self.messages = deque()
+        self.tokens = 0
+        self.last_timestamp = ""
+        # message id -> timestamp, for messages a lookback read may return again
+        self.seen = {}
+    
+    def add(self, doc: dict):
+        if doc["id"] in self.seen:
+            return
+        self.seen[doc["id"]] = doc["timestamp"]
+        tokens = estimate_tokens(doc["content"])
+        role = "user" if doc["role"] == "user" else "assistant"
+        # A late write from a concurrent turn goes before the newer messages already held
+        position = len(self.messages)
+        while position and self.messages[position - 1][2] > doc["timestamp"]:
+            position -= 1
+        self.messages.insert(position, ({"role": role, "content": doc["content"]}, tokens, doc["timestamp"]))
+        self.tokens += tokens
+        self.last_timestamp = max(self.last_timestamp, doc["timestamp"])
+        while self.tokens > CONTEXT_TOKEN_BUDGET and len(self.messages) > 1:
+            _, dropped, _ = self.messages.popleft()
+            self.tokens -= dropped
+    
+    def since(self) -> str:
+        """Lower timestamp bound for the next incremental read; forgets ids it can no longer return"""
+        if not self.last_timestamp:
+            return ""
+        cutoff = (datetime.fromisoformat(self.last_timestamp) - timedelta(seconds=CONTEXT_LATE_WRITE_SECONDS)).isoformat()
+        self.seen = {message_id: timestamp for message_id, timestamp in self.seen.items() if timestamp > cutoff}
+        return cutoff
+    
+    def window(self) -> List[dict]:
+        return [message for message, _, _ in self.messages]
+
+class ConversationContextStore:
+    """Per-session LLM context kept in a bounded LRU and extended incrementally.
+    
+    Lookups ask Mongo only for the last CONTEXT_LATE_WRITE_SECONDS before the newest message
+    seen and skip message ids already held, so turns persisted by other workers (even ones
+    stored out of timestamp order) are picked up without re-reading the history. Concurrent
+    lookups for a session share one read, and an entry is cached only once it is complete.
+    """
+    
+    def __init__(self, maxsize: int):
+        self._sessions = LRUCache(maxsize=maxsize)
+        # session_id -> in-flight read
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+    
+    async def get(self, session_id: str) -> List[dict]:
+        task = self._loading.get(session_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(session_id))
+            self._loading[session_id] = task
+            task.add_done_callback(lambda done: self._loaded(session_id, done))
+        # Shielded so one caller going away doesn't cancel the read for the others
+        return list(await asyncio.shield(task))
+    
+    async def _load(self, session_id: str) -> List[dict]:
+        query = {"session_id": session_id}
+        
+        context = self._sessions.get(session_id)
+        if context is None:
+            self.misses += 1
+            context = ConversationContext()
+        else:
+            self.hits += 1
+            query["timestamp"] = {"$gt": context.since()}
+        
+        docs = await db.chat_messages.find(
+            query,
+            {"_id": 0, "id": 1, "role": 1, "content": 1, "timestamp": 1}
+        ).sort([("timestamp", -1), ("id", -1)]).to_list(CONTEXT_MAX_MESSAGES)
+        for doc in reversed(docs):
+            context.add(doc)
+        # Not cached if the session was invalidated while the read was in flight
+        if self._loading.get(session_id) is asyncio.current_task():
+            self._sessions[session_id] = context
+        return context.window()
+    
+    def _loaded(self, session_id: str, task: asyncio.Task):
+        if self._loading.get(session_id) is task:
+            del self._loading[session_id]
+    
+    def append(self, session_id: str, *docs: dict):
+        """Record turns this worker just persisted so the next lookup finds nothing new"""
+        context = self._sessions.get(session_id)
+        if context is None:
+            return
+        for doc in docs:
+            context.add(doc)
+    
+    def invalidate(self, session_id: str):
+        self._sessions.pop(session_id, None)
+        self._loading.pop(session_id, None)
+    
+    def stats(self) -> dict:
+        return {"size": len(self._sessions), "hits": self.hits, "misses": self.misses}
+
+conversation_store = ConversationContextStore(CONTEXT_CACHE_SESSIONS)
+
+# ============== CHAT PERSISTENCE ==============
+
+# Optional write concern for chat writes, e.g. "1" to skip waiting for replication
+CHAT_WRITE_CONCERN = os.environ.get('CHAT_WRITE_CONCERN')
+# Acknowledge replies before they are persisted; queued turns are flushed on shutdown
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'false').lower() == 'true'
+CHAT_WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('CHAT_WRITE_BEHIND_QUEUE_SIZE', '1000'))
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BEHIND_BATCH_SIZE', '100'))
+
+def chat_collection(name: str):
+    collection = db[name]
+    if CHAT_WRITE_CONCERN:
+        w = int(CHAT_WRITE_CONCERN) if CHAT_WRITE_CONCERN.isdigit() else CHAT_WRITE_CONCERN
+        collection = collection.with_options(write_concern=WriteConcern(w=w))
+    return collection
+
+def start_chat_turn(message_data: ChatMessageCreate, current_user: dict) -> dict:
+    """Prepare the session and user message for a turn. Nothing is written until the reply is ready."""
+    session_id = message_data.session_id
+    now = datetime.now(timezone.utc).isoformat()
+    
+    # Create new session if needed
+    new_session = None
+    if not session_id:
+        session_id = str(uuid.uuid4())
+        title = message_data.message[:50] + "..." if len(message_data.message) > 50 else message_data.message
+        new_session = {
+            "id": session_id,
+            "user_id": current_user["id"],
+            "title": title,
+            "created_at": now
+        }
+    
+    return {
+        "session_id": session_id,
+        "new_session": new_session,
+        "user_msg": {
+            "id": str(uuid.uuid4()),
+            "session_id": session_id,
+            "role": "user",
+            "content": message_data.message,
+            "severity": None,
+            "suggestions": None,
+            "timestamp": now
+        }
+    }
+
+def session_update(turn: dict, last_message_at: str) -> UpdateOne:
+    """Bump last_message_at, creating the session on its first turn"""
+    update = {"$set": {"last_message_at": last_message_at}}
+    if turn["new_session"]:
+        update["$setOnInsert"] = turn["new_session"]
+    return UpdateOne({"id": turn["session_id"]}, update, upsert=bool(turn["new_session"]))
+
+async def write_chat_turns(turns: List[dict]):
+    """Persist finished turns with one unordered insert and one session bulk write.
+    
+    A follow-up turn has no user message, only a further assistant message.
+    """
+    messages = [
+        message for turn in turns for message in (turn["user_msg"], turn["assistant_msg"]) if message is not None
+    ]
+    session_ops = [session_update(turn, turn["assistant_msg"]["timestamp"]) for turn in turns]
+    await asyncio.gather(
+        chat_collection("chat_messages").insert_many(messages, ordered=False),
+        chat_collection("chat_sessions").bulk_write(session_ops, ordered=False)
+    )
+
+class ChatWriteBehind:
+    """Background writer that batches queued turns; join() waits until everything is persisted"""
+    
+    def __init__(self, maxsize: int, batch_size: int):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.task = None
+        self.written = 0
+        self.failed = 0
+    
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+    
+    async def submit(self, turn: dict):
+        # Blocks when the queue is full, pushing back on new turns instead of dropping them
+        await self.queue.put(turn)
+    
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await write_chat_turns(batch)
+                self.written += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logging.error(f"Chat write-behind error ({len(batch)} turns): {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+    
+    async def stop(self):
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        self.task = None
+
+chat_write_behind = ChatWriteBehind(CHAT_WRITE_BEHIND_QUEUE_SIZE, CHAT_WRITE_BEHIND_BATCH_SIZE)
+
+async def finish_chat_turn(turn: dict, ai_result: dict) -> ChatMessageResponse:
+    """Persist the turn (or queue it when write-behind is on) and extend the cached context"""
+    assistant_msg = {
+        "id": str(uuid.uuid4()),
+        "session_id": turn["session_id"],
+        "role": "assistant",
+        "content": ai_result["response"],
+        "severity": ai_result["severity"],
+        "suggestions": ai_result["suggestions"],
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+    if ai_result.get("truncated"):
+        assistant_msg["truncated"] = True
+    reply = ChatMessageResponse(**assistant_msg)
+    turn["assistant_msg"] = assistant_msg
+    
+    if CHAT_WRITE_BEHIND:
+        await chat_write_behind.submit(turn)
+    else:
+        await write_chat_turns([turn])
+    
+    conversation_store.append(turn["session_id"], *[msg for msg in (turn["user_msg"], assistant_msg) if msg is not None])
+    return reply
+
+# ============== RESPONSE CACHE ==============
+
+# Opt-in reuse of first-turn replies for near-identical symptom questions
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '2000'))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '3600'))
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get('RESPONSE_CACHE_SIMILARITY', '0.8'))
+
+AGE_BANDS = ((12, "child"), (17, "teen"), (39, "adult"), (64, "middle-aged"))
+
+# Filler words that don't change what is being asked
+CACHE_STOPWORDS = frozenset(
+    "a an the i i'm im i've ive my me have has had got am is are was been be and or of for with "
+    "since about really very so just some it its this that".split()
+)
+
+def normalize_message(text: str) -> str:
+    words = re.sub(r"[^a-z0-9'\s]", " ", text.lower()).split()
+    return " ".join(word for word in words if word not in CACHE_STOPWORDS)
+
+def age_band(age: Optional[int]) -> str:
+    if age is None:
+        return "unknown"
+    for upper, band in AGE_BANDS:
+        if age <= upper:
+            return band
+    return "senior"
+
+def patient_context_key(user: dict) -> str:
+    conditions = sorted({c.strip().lower() for c in user.get("existing_conditions") or [] if c.strip()})
+    return f"{age_band(user.get('age'))}|{','.join(conditions)}"
+
+def trigrams(text: str) -> frozenset:
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+class EvictionTTLCache(TTLCache):
+    """TTLCache that calls `on_evict(key)` for entries dropped by LRU eviction or expiry"""
+    
+    def __init__(self, maxsize: int, ttl: int, on_evict):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.on_evict = on_evict
+    
+    def popitem(self):
+        key, value = super().popitem()
+        self.on_evict(key)
+        return key, value
+    
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for key, _ in expired:
+            self.on_evict(key)
+        return expired
+
+class ResponseCache:
+    """First-turn AI replies keyed by patient context and normalised message.
+    
+    Lookups try an exact match first, then the most similar cached message for the same
+    patient context by trigram Jaccard similarity.
+    """
+    
+    def __init__(self, maxsize: int, ttl: int, threshold: float):
+        self._entries = EvictionTTLCache(maxsize, ttl, self._forget)
+        # context_key -> normalised messages cached for it; kept in step with _entries
+        self._by_context = {}
+        self.threshold = threshold
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.skipped = 0
+    
+    def get(self, message: str, user: dict) -> Optional[dict]:
+        context_key = patient_context_key(user)
+        normalized = normalize_message(message)
+        
+        entry = self._entries.get((context_key, normalized))
+        if entry is not None:
+            self.exact_hits += 1
+            return self._copy(entry[1])
+        
+        grams = trigrams(normalized)
+        best, best_score = None, self.threshold
+        candidates = self._by_context.get(context_key, set())
+        for candidate in list(candidates):
+            cached = self._entries.get((context_key, candidate))
+            if cached is None:
+                # Expired or evicted from the TTL cache
+                candidates.discard(candidate)
+                continue
+            score = len(grams & cached[0]) / len(grams | cached[0])
+            if score >= best_score:
+                best, best_score = cached, score
+        
+        if best is None:
+            self.misses += 1
+            return None
+        self.similar_hits += 1
+        return self._copy(best[1])
+    
+    def put(self, message: str, user: dict, ai_result: dict):
+        if ai_result["severity"] == "emergency":
+            # Emergency guidance must always come from a fresh assessment
+            self.skipped += 1
+            return
+        context_key = patient_context_key(user)
+        normalized = normalize_message(message)
+        self._entries[(context_key, normalized)] = (trigrams(normalized), self._copy(ai_result))
+        self._by_context.setdefault(context_key, set()).add(normalized)
+    
+    def _forget(self, key: tuple):
+        context_key, normalized = key
+        candidates = self._by_context.get(context_key)
+        if candidates is not None:
+            candidates.discard(normalized)
+            if not candidates:
+                del self._by_context[context_key]
+    
+    @staticmethod
+    def _copy(ai_result: dict) -> dict:
+        return {**ai_result, "suggestions": list(ai_result["suggestions"])}
+    
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.similar_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "skipped_emergency": self.skipped,
+            "hit_rate": (self.exact_hits + self.similar_hits) / lookups if lookups else 0.0
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_SIMILARITY)
+
+def cached_reply(turn: dict, current_user: dict) -> Optional[dict]:
+    """Cached reply for a session's opening message, when the cache is enabled"""
+    if not RESPONSE_CACHE_ENABLED or not turn["new_session"]:
+        return None
+    return response_cache.get(turn["user_msg"]["content"], current_user)
+
+def remember_reply(turn: dict, current_user: dict, ai_result: dict):
+    if RESPONSE_CACHE_ENABLED and turn["new_session"]:
+        response_cache.put(turn["user_msg"]["content"], current_user, ai_result)
+
+# ============== EMERGENCY FAST PATH ==============
+
+EMERGENCY_FAST_PATH_RESULT = {
+    "response": (
+        "🚨 EMERGENCY: Please call emergency services (911) or go to the nearest emergency room immediately.\n\n"
+        "What you describe can be a sign of a serious medical emergency. Don't wait for an online answer, "
+        "and don't drive yourself if you feel faint or short of breath. If someone is with you, ask them to help.\n\n"
+        "If you are thinking about harming yourself, call or text 988 (Suicide & Crisis Lifeline) now."
+    ),
+    "severity": "emergency",
+    "suggestions": []
+}
+
+emergency_fast_path_stats = {"flagged": 0, "notice_only": 0}
+
+# Strong references so fire-and-forget tasks aren't garbage collected mid-flight
+background_tasks = set()
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def emergency_notice(turn: dict) -> Optional[str]:
+    """Emergency guidance to send the moment the patient's message is classified as an obvious emergency.
+    
+    The model still answers afterwards: a phrase match can't tell "I took an overdose" from every
+    benign question, so the notice comes first rather than instead of the reply.
+    """
+    if not triage_classifier.is_emergency_message(turn["user_msg"]["content"]):
+        return None
+    emergency_fast_path_stats["flagged"] += 1
+    return EMERGENCY_FAST_PATH_RESULT["response"]
+
+def with_emergency_notice(notice: str, ai_result: Optional[dict]) -> dict:
+    """The notice followed by the model's reply, or the notice alone when there is no reply"""
+    if ai_result is None:
+        emergency_fast_path_stats["notice_only"] += 1
+        return {**EMERGENCY_FAST_PATH_RESULT, "suggestions": []}
+    return {
+        **ai_result,
+        "response": f"{notice}\n\n{ai_result['response']}",
+        "severity": "emergency",
+        "suggestions": []
+    }
+
+# ============== CHAT ROUTES ==============
+
+SYSTEM_PROMPT = """You are CareBot, an AI healthcare assistant. Your role is to:
+
+1. Listen to patient symptoms with empathy and care
+2. Ask clarifying questions about symptoms, duration, and severity
+3. Classify the urgency:
+   - MILD: Common, treatable issues (cold, minor headache, small cuts)
+   - CONSULTATION: Should see a doctor but not urgent (persistent symptoms, moderate pain)
+   - EMERGENCY: Needs immediate care (chest pain, severe bleeding, breathing difficulty, stroke symptoms)
+
+4. For MILD issues, you may suggest:
+   - Common OTC medications (with standard dosage guidance)
+   - Home care tips (rest, hydration, etc.)
+   
+5. Always include this disclaimer for any medical guidance:
+   "⚠️ This is not a medical diagnosis. Please consult a healthcare professional if symptoms persist or worsen."
+
+6. For EMERGENCY cases, immediately advise:
+   "🚨 EMERGENCY: Please call emergency services (911) or go to the nearest emergency room immediately."
+
+7. Be warm, reassuring, and professional. Use simple language.
+
+IMPORTANT RULES:
+- Never prescribe prescription medications
+- Never diagnose serious conditions
+- Always recommend doctor consultation for unclear or serious symptoms
+- Suggest booking an appointment when appropriate
+
+Respond in a conversational, caring manner. Keep responses concise but helpful."""
+
+LLM_PROVIDER = "anthropic"
+LLM_MODEL = "claude-sonnet-4-5-20250929"
+
+AI_FALLBACK_RESULT = {
+    "response": "I apologize, but I'm having trouble processing your request right now. Please try again or contact support if the issue persists.",
+    "severity": "consultation",
+    "suggestions": ["Please try again later"]
+}
+
+def build_system_message(user_context: dict) -> str:
+    """Append the patient's profile to the system prompt"""
+    context_parts = []
+    if user_context.get("age"):
+        context_parts.append(f"Patient age: {user_context['age']}")
+    if user_context.get("existing_conditions"):
+        context_parts.append(f"Existing conditions: {', '.join(user_context['existing_conditions'])}")
+    
+    user_context_str = "\n".join(context_parts) if context_parts else "No additional patient context available."
+    
+    return f"{SYSTEM_PROMPT}\n\nPatient Context:\n{user_context_str}"
+
+def classify_response(response: str) -> dict:
+    """Determine severity and home-care suggestions from an AI response"""
+    return triage_classifier.classify(response)
+
+@traced("llm.analyze")
+async def analyze_with_ai(message: str, session_id: str, user_context: dict, history: Optional[List[dict]] = None) -> dict:
+    """Analyze symptoms using Claude AI, with the session's history unless one is given"""
+    enhanced_system = build_system_message(user_context)
+    
+    # Get chat history for this session
+    if history is None:
+        with StageTimer("analyze_with_ai", "history"):
+            history = await conversation_store.get(session_id)
+    
+    def send():
+        # A fresh LlmChat per attempt, since retries and hedges may overlap
+        chat = providers.chat(session_id, enhanced_system)
+        
+        # Add history to chat context
+        chat.messages.extend(history)
+        
+        return chat.send_message(UserMessage(text=message))
+    
+    with StageTimer("analyze_with_ai", "llm_queue"):
+        slot = await llm_limiter.acquire(user_context["id"])
+    try:
+        with StageTimer("analyze_with_ai", "llm"):
+            response = await llm_caller.call(send)
+    finally:
+        slot.release()
+    
+    with StageTimer("analyze_with_ai", "classify"):
+        return {
+            "response": response,
+            **classify_response(response)
+        }
+
+async def emergency_follow_up(turn: dict, current_user: dict, history: List[dict]) -> Optional[ChatMessageResponse]:
+    """The model's answer to an emergency message, saved as a second assistant message after the notice"""
+    try:
+        ai_result = await analyze_with_ai(turn["user_msg"]["content"], turn["session_id"], current_user, history)
+    except Exception as e:
+        # Overloaded or failing: the guidance is already out, so it stands alone
+        emergency_fast_path_stats["notice_only"] += 1
+        logging.error(f"Emergency follow-up error: {e}")
+        return None
+    follow_up = {"session_id": turn["session_id"], "new_session": None, "user_msg": None}
+    return await finish_chat_turn(follow_up, {**ai_result, "severity": "emergency", "suggestions": []})
+
+async def reply_to_message(message_data: ChatMessageCreate, current_user: dict) -> tuple:
+    """Run one chat turn: emergency notice, response cache, then the LLM.
+    
+    Returns (reply, follow_up). For an obvious emergency the reply is the notice, saved and
+    returned without waiting for the model, and follow_up is a background task that resolves
+    to the model's answer once it is saved (None if there is none). Otherwise follow_up is None.
+    """
+    with StageTimer("chat_message", "start_turn"):
+        turn = start_chat_turn(message_data, current_user)
+    
+    with StageTimer("chat_message", "fast_path"):
+        notice = emergency_notice(turn)
+    if notice is not None:
+        # History is read before the turn is saved, so the follow-up prompt doesn't repeat it
+        history = await conversation_store.get(turn["session_id"])
+        with StageTimer("chat_message", "persist"):
+            reply = await finish_chat_turn(turn, {**EMERGENCY_FAST_PATH_RESULT, "suggestions": []})
+        reply.follow_up_pending = True
+        return reply, spawn_background(emergency_follow_up(turn, current_user, history))
+    
+    # Get AI response
+    with StageTimer("chat_message", "cache_lookup"):
+        ai_result = cached_reply(turn, current_user)
+    if ai_result is None:
+        try:
+            with StageTimer("chat_message", "analyze"):
+                ai_result = await analyze_with_ai(
+                    message_data.message,
+                    turn["session_id"],
+                    current_user
+                )
+            remember_reply(turn, current_user, ai_result)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logging.error(f"AI Error: {e}")
+            ai_result = AI_FALLBACK_RESULT
+    
+    with StageTimer("chat_message", "persist"):
+        return await finish_chat_turn(turn, ai_result), None
+
+@api_router.post("/chat/message", response_model=ChatMessageResponse)
+async def send_chat_message(
+    message_data: ChatMessageCreate,
+    current_user: dict = Depends(rate_limited(get_current_user, "llm"))
+):
+    """One chat turn. An emergency is answered at once with the emergency notice
+    ("follow_up_pending": true); the model's answer is then added to the session as the next message.
+    """
+    reply, _ = await reply_to_message(message_data, current_user)
+    return reply
+
+# ============== CHAT STREAMING ==============
+
+# Caps on concurrent streams and on the text buffered per stream
+CHAT_STREAM_MAX_CONCURRENT = int(os.environ.get('CHAT_STREAM_MAX_CONCURRENT', '100'))
+CHAT_STREAM_MAX_CHARS = int(os.environ.get('CHAT_STREAM_MAX_CHARS', '16000'))
+
+chat_stream_stats = {
+    "active": 0,
+    "peak_active": 0,
+    "completed": 0,
+    "rejected": 0,
+    "truncated": 0,
+    "failed": 0,
+    "peak_chars": 0
+}
+
+def check_chat_stream_capacity():
+    """Reject with 429 while the response can still carry a status, when the cap is reached"""
+    if chat_stream_stats["active"] >= CHAT_STREAM_MAX_CONCURRENT:
+        chat_stream_stats["rejected"] += 1
+        raise HTTPException(
+            status_code=429,
+            detail="Too many active chat streams, please retry shortly",
+            headers={"Retry-After": "1"}
+        )
+
+def open_chat_stream():
+    """Count a stream as active; called from the body generator so close_chat_stream always pairs with it"""
+    chat_stream_stats["active"] += 1
+    chat_stream_stats["peak_active"] = max(chat_stream_stats["peak_active"], chat_stream_stats["active"])
+
+def close_chat_stream(chars: int):
+    chat_stream_stats["active"] -= 1
+    chat_stream_stats["completed"] += 1
+    chat_stream_stats["peak_chars"] = max(chat_stream_stats["peak_chars"], chars)
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_llm_reply(system_message: str, history: List[dict], message: str):
+    """Yield assistant text deltas as the model generates them.
+    
+    Tokens can't be replayed once sent, so streams get the circuit breaker and per-chunk
+    timeouts but no retries or hedging.
+    """
+    trial = llm_caller.check_circuit()
+    try:
+        response = await asyncio.wait_for(acompletion(
+            model=f"{LLM_PROVIDER}/{LLM_MODEL}",
+            messages=[{"role": "system", "content": system_message}, *history, {"role": "user", "content": message}],
+            api_key=providers.api_key,
+            api_base=os.environ.get('LLM_API_BASE') or None,
+            stream=True
+        ), LLM_TIMEOUT_SECONDS)
+        chunks = aiter(response)
+        while True:
+            try:
+                chunk = await asyncio.wait_for(anext(chunks), LLM_TIMEOUT_SECONDS)
+            except StopAsyncIteration:
+                break
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    except asyncio.TimeoutError:
+        llm_caller.outcomes["timeout"] += 1
+        llm_caller.breaker.record_failure()
+        raise
+    except Exception:
+        llm_caller.outcomes["error"] += 1
+        llm_caller.breaker.record_failure()
+        raise
+    except BaseException:
+        # Closed early (client gone, length cap) or cancelled: no verdict, free the half-open trial
+        if trial:
+            llm_caller.breaker.release_trial()
+        raise
+    llm_caller.outcomes["success"] += 1
+    llm_caller.breaker.record_success()
+
+async def stream_chat_events(
+    turn: dict,
+    current_user: dict,
+    ai_result: Optional[dict],
+    notice: Optional[str],
+    llm_slot: Optional[LimiterSlot]
+):
+    """Relay tokens to the client, then classify and persist the full reply.
+    
+    `notice` is emergency guidance sent ahead of everything else. `ai_result` is a reply that
+    is already known (cache); otherwise the model is streamed under `llm_slot`, if there is one.
+    """
+    session_id = turn["session_id"]
+    # Deltas are kept once, in order, and joined a single time at the end
+    parts = []
+    chars = 0
+    open_chat_stream()
+    try:
+        yield sse_event("session", {"session_id": session_id})
+        if notice is not None:
+            yield sse_event("token", {"text": f"{notice}\n\n"})
+        
+        if ai_result is not None:
+            yield sse_event("token", {"text": ai_result["response"]})
+        elif llm_slot is not None:
+            try:
+                truncated = False
+                history = await conversation_store.get(session_id)
+                async for delta in stream_llm_reply(build_system_message(current_user), history, turn["user_msg"]["content"]):
+                    if chars + len(delta) > CHAT_STREAM_MAX_CHARS:
+                        chat_stream_stats["truncated"] += 1
+                        truncated = True
+                        break
+                    parts.append(delta)
+                    chars += len(delta)
+                    yield sse_event("token", {"text": delta})
+                
+                response = "".join(parts)
+                parts = None
+                ai_result = {"response": response, **classify_response(response)}
+                if truncated:
+                    ai_result["truncated"] = True
+                elif notice is None:
+                    remember_reply(turn, current_user, ai_result)
+            except Exception as e:
+                logging.error(f"AI Streaming Error: {e}")
+                chat_stream_stats["failed"] += 1
+                if chars:
+                    # Part of a reply went out; have the client drop it and show what gets saved
+                    yield sse_event("reset", {})
+                    if notice is not None:
+                        yield sse_event("token", {"text": f"{notice}\n\n"})
+                if notice is None:
+                    ai_result = AI_FALLBACK_RESULT
+                    yield sse_event("token", {"text": ai_result["response"]})
+                else:
+                    # The guidance already went out; don't follow it with an apology
+                    ai_result = None
+            finally:
+                llm_slot.release()
+        
+        if notice is not None:
+            ai_result = with_emergency_notice(notice, ai_result)
+        saved = await finish_chat_turn(turn, ai_result)
+        yield sse_event("done", saved.model_dump())
+    finally:
+        if llm_slot is not None:
+            llm_slot.release()
+        close_chat_stream(chars)
+
+@api_router.post("/chat/message/stream")
+async def stream_chat_message(
+    message_data: ChatMessageCreate,
+    current_user: dict = Depends(rate_limited(get_current_user, "llm"))
+):
+    """Server-sent events variant of /chat/message: session, token..., done.
+    
+    The done event's message carries "truncated": true when the reply hit CHAT_STREAM_MAX_CHARS.
+    If the model fails partway, a reset event tells the client to discard the text shown so far;
+    the tokens after it are the reply that is saved.
+    """
+    check_chat_stream_capacity()
+    turn = start_chat_turn(message_data, current_user)
+    
+    notice = emergency_notice(turn)
+    ai_result = cached_reply(turn, current_user) if notice is None else None
+    
+    # Queue for an upstream slot before the response starts, so overload is still a 429
+    llm_slot = None
+    if ai_result is None:
+        try:
+            llm_slot = await llm_limiter.acquire(current_user["id"])
+        except HTTPException:
+            # An emergency is answered with its guidance alone rather than refused
+            if notice is None:
+                raise
+    
+    return StreamingResponse(
+        stream_chat_events(turn, current_user, ai_result, notice, llm_slot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Runs even when the client leaves before the body generator starts; release is idempotent
+        background=BackgroundTask(llm_slot.release) if llm_slot is not None else None
+    )
+
+@api_router.get("/chat/sessions", response_model=List[ChatSessionResponse])
+async def get_chat_sessions(
+    response: Response,
+    limit: int = Query(50, ge=1, le=PAGE_MAX_LIMIT),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    current_user: dict = Depends(rate_limited(get_token_user, "read"))
+):
+    return await fetch_page(
+        "chat_sessions", {"user_id": current_user["id"]}, "last_message_at",
+        limit, before, after, response
+    )
+
+@api_router.get("/chat/sessions/{session_id}/messages", response_model=List[ChatMessageResponse])
+async def get_session_messages(
     session_id: str,
-    current_user: dict = Depends(get_current_user)
+    response: Response,
+    limit: int = Query(100, ge=1, le=PAGE_MAX_LIMIT),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    current_user: dict = Depends(rate_limited(get_token_user, "read"))
 ):
     # Verify session belongs to user
     session = await db.chat_sessions.find_one({
@@ -399,98 +2586,847 @@ async def get_session_messages(
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    messages = await db.chat_messages.find(
-        {"session_id": session_id},
-        {"_id": 0}
-    ).sort("timestamp", 1).to_list(100)
-    return messages
+    # Latest page by default, returned in conversation order
+    return await fetch_page(
+        "chat_messages", {"session_id": session_id}, "timestamp",
+        limit, before, after, response, oldest_first=True
+    )
+
+@api_router.delete("/chat/sessions/{session_id}")
+async def delete_session(
+    session_id: str,
+    current_user: dict = Depends(rate_limited(get_current_user, "write"))
+):
+    session = await db.chat_sessions.find_one({
+        "id": session_id,
+        "user_id": current_user["id"]
+    })
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    await db.chat_sessions.delete_one({"id": session_id})
+    await db.chat_messages.delete_many({"session_id": session_id})
+    conversation_store.invalidate(session_id)
+    
+    return {"message": "Session deleted"}
+
+# ============== TTS CACHE ==============
+
+TTS_MODEL = "tts-1"
+TTS_FORMAT = "mp3"
+TTS_CACHE_DIR = Path(os.environ.get('TTS_CACHE_DIR', str(ROOT_DIR / 'tts_cache')))
+TTS_CACHE_MEMORY_BYTES = int(os.environ.get('TTS_CACHE_MEMORY_BYTES', str(64 * 1024 * 1024)))
+TTS_CACHE_DISK_BYTES = int(os.environ.get('TTS_CACHE_DISK_BYTES', str(1024 * 1024 * 1024)))
+# Disk hits up to this size are also promoted into memory
+TTS_CACHE_PROMOTE_MAX_BYTES = 256 * 1024
+TTS_PREWARM = os.environ.get('TTS_PREWARM', 'false').lower() == 'true'
+TTS_PREWARM_VOICE = os.environ.get('TTS_PREWARM_VOICE', 'nova')
+# Long replies are synthesized sentence by sentence; parallelism is bounded by the per-user voice cap
+TTS_PIPELINE_PARALLELISM = int(os.environ.get('TTS_PIPELINE_PARALLELISM', '2'))
+TTS_SENTENCE_MAX_CHARS = int(os.environ.get('TTS_SENTENCE_MAX_CHARS', '400'))
+# How long a registered clip URL keeps working; matches the audio's Cache-Control max-age
+TTS_CLIP_TTL_SECONDS = 86400
+
+def tts_cache_key(text: str, voice: str, model: str = TTS_MODEL, audio_format: str = TTS_FORMAT) -> str:
+    return hashlib.sha256("\x1f".join((model, voice, audio_format, text)).encode('utf-8')).hexdigest()
+
+class AudioCache:
+    """Content-addressed audio clips: a byte-bounded in-memory LRU in front of a byte-bounded
+    on-disk LRU. Disk hits are memory-mapped rather than read into memory.
+    """
+    
+    def __init__(self, directory: Path, memory_bytes: int, disk_bytes: int):
+        self.directory = directory
+        self.disk_limit = disk_bytes
+        self._memory = LRUCache(maxsize=memory_bytes, getsizeof=len)
+        # key -> size, least recently used first
+        self._disk = OrderedDict()
+        self.disk_bytes = 0
+        # key -> hash of the stored bytes, for clips on disk
+        self._digests = {}
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "disk_evictions": 0, "disk_errors": 0}
+        
+        directory.mkdir(parents=True, exist_ok=True)
+        entries = sorted(directory.glob("*.audio"), key=lambda path: path.stat().st_mtime)
+        for path in entries:
+            self._disk[path.stem] = path.stat().st_size
+            self.disk_bytes += self._disk[path.stem]
+    
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.audio"
+    
+    def _remember(self, key: str, data):
+        if len(data) <= self._memory.maxsize:
+            self._memory[key] = data
+    
+    def get(self, key: str):
+        """bytes or a read-only mmap, or None on a miss"""
+        data = self._memory.get(key)
+        if data is not None:
+            self.stats["memory_hits"] += 1
+            return data
+        
+        if key in self._disk:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                self.disk_bytes -= self._disk.pop(key)
+                self._digests.pop(key, None)
+            else:
+                self._disk.move_to_end(key)
+                self.stats["disk_hits"] += 1
+                if len(data) <= TTS_CACHE_PROMOTE_MAX_BYTES:
+                    self._remember(key, bytes(data))
+                return data
+        
+        self.stats["misses"] += 1
+        return None
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self._memory or key in self._disk
+    
+    def digest(self, key: str, data) -> str:
+        """Hash of the clip's bytes as stored, computed once per clip while it stays on disk"""
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            if key in self._disk:
+                self._digests[key] = digest
+        return digest
+    
+    async def put(self, key: str, data: bytes):
+        if not data:
+            return
+        # A regenerated clip may differ byte for byte from the one it replaces
+        self._digests.pop(key, None)
+        self._remember(key, data)
+        if key in self._disk:
+            return
+        try:
+            await asyncio.to_thread(self._write_file, self._path(key), data)
+        except OSError as e:
+            # Full disk, permissions...: the clip is still served, just not cached on disk
+            self.stats["disk_errors"] += 1
+            logging.warning(f"TTS cache write failed for {key}: {e}")
+            return
+        self._disk[key] = len(data)
+        self.disk_bytes += len(data)
+        while self.disk_bytes > self.disk_limit and len(self._disk) > 1:
+            old_key, size = self._disk.popitem(last=False)
+            self.disk_bytes -= size
+            self._digests.pop(old_key, None)
+            self.stats["disk_evictions"] += 1
+            self._path(old_key).unlink(missing_ok=True)
+    
+    @staticmethod
+    def _write_file(path: Path, data: bytes):
+        # Write then rename so readers never map a partial clip
+        tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+tts_cache = AudioCache(TTS_CACHE_DIR, TTS_CACHE_MEMORY_BYTES, TTS_CACHE_DISK_BYTES)
+
+@traced("tts.synthesize")
+async def synthesize_speech(text: str, voice: str, user_id: str):
+    """MP3 audio for `text`, from the cache when possible. Returns bytes or a read-only mmap."""
+    key = tts_cache_key(text, voice)
+    audio = tts_cache.get(key)
+    if audio is None:
+        async with voice_limiter.slot(user_id):
+            audio = await providers.tts.generate_speech(
+                text=text,
+                model=TTS_MODEL,
+                voice=voice,
+                response_format=TTS_FORMAT
+            )
+        await tts_cache.put(key, audio)
+    return audio
+
+# Split after sentence punctuation (but not list markers like "1." or common abbreviations) and at line breaks
+SENTENCE_BOUNDARY = re.compile(
+    r'(?<=[^\s\d][.!?])(?<!\be\.g\.)(?<!\bi\.e\.)(?<!\bDr\.)(?<!\bMr\.)(?<!\bMs\.)(?<!\bvs\.)\s+|\s*\n+\s*'
+)
+
+def split_sentences(text: str, max_chars: int = TTS_SENTENCE_MAX_CHARS) -> List[str]:
+    """TTS chunks for `text`: one per sentence, with overlong sentences cut at word boundaries"""
+    chunks = []
+    for sentence in SENTENCE_BOUNDARY.split(text):
+        sentence = sentence.strip()
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            chunks.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            chunks.append(sentence)
+    return chunks
+
+async def synthesize_pipelined(chunks: List[str], voice: str, user_id: str):
+    """Yield audio for each chunk in order while the next few synthesize in the background.
+    
+    Each chunk is cached on its own, so repeated sentences (disclaimers, fallbacks) are reused
+    across replies and time-to-first-audio depends on the first sentence only.
+    """
+    parallelism = max(1, min(TTS_PIPELINE_PARALLELISM, voice_limiter.max_per_user))
+    upcoming = iter(chunks)
+    pending = deque()
+    
+    def schedule_next():
+        chunk = next(upcoming, None)
+        if chunk is not None:
+            pending.append(asyncio.ensure_future(synthesize_speech(chunk, voice, user_id)))
+    
+    try:
+        for _ in range(parallelism):
+            schedule_next()
+        while pending:
+            audio = await pending.popleft()
+            schedule_next()
+            yield audio
+    finally:
+        # Client went away or a chunk failed: don't keep paying for audio nobody hears
+        for task in pending:
+            task.cancel()
+
+def tts_prewarm_phrases() -> List[str]:
+    return [
+        EMERGENCY_FAST_PATH_RESULT["response"],
+        AI_FALLBACK_RESULT["response"],
+        "⚠️ This is not a medical diagnosis. Please consult a healthcare professional if symptoms persist or worsen."
+    ]
+
+async def prewarm_tts_cache():
+    for text in tts_prewarm_phrases():
+        for chunk in split_sentences(text):
+            if tts_cache_key(chunk, TTS_PREWARM_VOICE) in tts_cache:
+                continue
+            try:
+                await synthesize_speech(chunk, TTS_PREWARM_VOICE, "tts-prewarm")
+            except Exception as e:
+                logging.error(f"TTS prewarm error: {e}")
+                return
+
+# ============== VOICE ROUTES ==============
+
+class TTSRequest(BaseModel):
+    text: str
+    voice: str = "nova"  # Default: nova voice (energetic, upbeat - good for healthcare)
+
+class TTSResponse(BaseModel):
+    audio_base64: str
+    text: str
+
+class TTSClipResponse(BaseModel):
+    clip_id: str
+    url: str
+
+class STTResponse(BaseModel):
+    text: str
+
+# Whisper rejects files over 25 MB; refuse them before they are buffered at all
+STT_MAX_UPLOAD_BYTES = int(os.environ.get('STT_MAX_UPLOAD_BYTES', str(25 * 1024 * 1024)))
+STT_MAX_DURATION_SECONDS = float(os.environ.get('STT_MAX_DURATION_SECONDS', '300'))
+# Highest bitrate expected of compressed speech (320 kbps MP3). When a compressed container
+# states no duration, its size over this rate is the least it can last
+STT_MAX_COMPRESSED_BYTES_PER_SECOND = 40_000
+STT_PATH = "/api/voice/speech-to-text"
+
+class UploadLimitMiddleware:
+    """Rejects request bodies over a per-path byte limit with 413.
+    
+    Declared Content-Length is checked before anything is read; chunked bodies are counted as
+    they arrive, so an oversized upload is cut off mid-stream instead of spooled to the end.
+    """
+    
+    def __init__(self, app, limits: dict):
+        self.app = app
+        self.limits = limits
+    
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        
+        too_large = HTTPException(status_code=413, detail=f"Upload exceeds {limit // (1024 * 1024)} MB limit")
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            response = Response(
+                json.dumps({"detail": too_large.detail}),
+                status_code=413,
+                media_type="application/json",
+                headers={"Connection": "close"}
+            )
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise too_large
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+# (format, filename extension, matcher on the first bytes) for containers Whisper accepts
+AUDIO_SIGNATURES = [
+    ("webm", "webm", lambda head: head.startswith(b"\x1a\x45\xdf\xa3")),
+    ("ogg", "ogg", lambda head: head.startswith(b"OggS")),
+    ("wav", "wav", lambda head: head.startswith(b"RIFF") and head[8:12] == b"WAVE"),
+    ("flac", "flac", lambda head: head.startswith(b"fLaC")),
+    ("mp4", "m4a", lambda head: head[4:8] == b"ftyp"),
+    ("mp3", "mp3", lambda head: head.startswith(b"ID3") or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0)),
+]
+
+def sniff_audio_format(head: bytes) -> Optional[tuple]:
+    for audio_format, extension, matches in AUDIO_SIGNATURES:
+        if matches(head):
+            return audio_format, extension
+    return None
+
+def read_at(upload, offset: int, length: int) -> bytes:
+    upload.seek(offset)
+    return upload.read(length)
+
+def wav_duration_seconds(upload, head: bytes, size: int) -> Optional[float]:
+    """From a canonical WAV header (byte rate at offset 28)"""
+    if len(head) < 32:
+        return None
+    byte_rate = int.from_bytes(head[28:32], "little")
+    return (size - 44) / byte_rate if byte_rate else None
+
+def flac_duration_seconds(upload, head: bytes, size: int) -> Optional[float]:
+    """From STREAMINFO, which always directly follows the fLaC marker"""
+    if len(head) < 26:
+        return None
+    # 20 bits sample rate, 3 channels, 5 bits per sample, 36 total samples
+    fields = int.from_bytes(head[18:26], "big")
+    rate, samples = fields >> 44, fields & ((1 << 36) - 1)
+    return samples / rate if rate and samples else None
+
+def ogg_duration_seconds(upload, head: bytes, size: int) -> Optional[float]:
+    """The last page's granule position over the sample rate (Opus always counts at 48 kHz)"""
+    if head[28:36] == b"OpusHead":
+        rate = 48000
+    elif head[28:35] == b"\x01vorbis" and len(head) >= 44:
+        rate = int.from_bytes(head[40:44], "little")
+    else:
+        return None
+    tail = read_at(upload, max(0, size - 65536), 65536)
+    page = tail.rfind(b"OggS")
+    if page < 0 or len(tail) < page + 14:
+        return None
+    granule = int.from_bytes(tail[page + 6:page + 14], "little")
+    return granule / rate if rate and granule < 1 << 63 else None
+
+def mp4_boxes(upload, start: int, end: int):
+    """(type, body offset, end offset) of each box between start and end, read by seeking"""
+    position = start
+    while position + 8 <= end:
+        header = read_at(upload, position, 16)
+        if len(header) < 8:
+            return
+        box_size, box_type, body = int.from_bytes(header[:4], "big"), header[4:8], position + 8
+        if box_size == 1:
+            box_size, body = int.from_bytes(header[8:16], "big"), position + 16
+        elif box_size == 0:
+            box_size = end - position
+        if box_size < body - position:
+            return
+        yield box_type, body, position + box_size
+        position += box_size
+
+def mp4_duration_seconds(upload, head: bytes, size: int) -> Optional[float]:
+    """From the movie header (moov/mvhd), wherever moov sits in the file"""
+    for box_type, body, end in mp4_boxes(upload, 0, size):
+        if box_type != b"moov":
+            continue
+        for child_type, child_body, _ in mp4_boxes(upload, body, end):
+            if child_type == b"mvhd":
+                mvhd = read_at(upload, child_body, 32)
+                if len(mvhd) < 32:
+                    return None
+                if mvhd[0] == 1:
+                    timescale, duration = int.from_bytes(mvhd[20:24], "big"), int.from_bytes(mvhd[24:32], "big")
+                else:
+                    timescale, duration = int.from_bytes(mvhd[12:16], "big"), int.from_bytes(mvhd[16:20], "big")
+                return duration / timescale if timescale else None
+        return None
+    return None
+
+EBML_SEGMENT = 0x18538067
+EBML_INFO = 0x1549A966
+EBML_TIMECODE_SCALE = 0x2AD7B1
+EBML_DURATION = 0x4489
+EBML_CLUSTER = 0x1F43B675
+
+def ebml_vint(data: bytes, position: int, keep_marker: bool) -> Optional[tuple]:
+    """(value, next position) of the variable-length integer at `position`"""
+    if position >= len(data) or data[position] == 0:
+        return None
+    length = 9 - data[position].bit_length()
+    if position + length > len(data):
+        return None
+    value = int.from_bytes(data[position:position + length], "big")
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+    return value, position + length
+
+def webm_duration_seconds(upload, head: bytes, size: int) -> Optional[float]:
+    """From Segment > Info > Duration, which browser recorders often leave out"""
+    data = read_at(upload, 0, 65536)
+    position, scale, duration = 0, 1_000_000, None
+    while True:
+        element = ebml_vint(data, position, keep_marker=True)
+        if element is None:
+            break
+        length = ebml_vint(data, element[1], keep_marker=False)
+        if length is None:
+            break
+        element_id, (element_size, position) = element[0], length
+        if element_id in (EBML_SEGMENT, EBML_INFO):
+            # Descend: the children follow the header directly
+            continue
+        if element_id == EBML_CLUSTER:
+            break
+        if element_id == EBML_TIMECODE_SCALE:
+            scale = int.from_bytes(data[position:position + element_size], "big")
+        elif element_id == EBML_DURATION and element_size in (4, 8):
+            duration = struct.unpack(">f" if element_size == 4 else ">d", data[position:position + element_size])[0]
+        position += element_size
+    return duration * scale / 1e9 if duration else None
+
+AUDIO_DURATION_READERS = {
+    "wav": wav_duration_seconds,
+    "flac": flac_duration_seconds,
+    "ogg": ogg_duration_seconds,
+    "mp4": mp4_duration_seconds,
+    "webm": webm_duration_seconds,
+}
+COMPRESSED_AUDIO_FORMATS = {"webm", "ogg", "mp4", "mp3"}
+
+def audio_duration_seconds(upload, audio_format: str, head: bytes, size: int) -> Optional[float]:
+    """Duration stated by the container, else for compressed audio the least it can last; None if unknown.
+    
+    Only headers and the odd box are read, by seeking, never the audio itself.
+    """
+    reader = AUDIO_DURATION_READERS.get(audio_format)
+    try:
+        duration = reader(upload, head, size) if reader else None
+    except (ValueError, struct.error, OSError):
+        duration = None
+    finally:
+        upload.seek(0)
+    if duration is None and audio_format in COMPRESSED_AUDIO_FORMATS:
+        duration = size / STT_MAX_COMPRESSED_BYTES_PER_SECOND
+    return duration
 
-@api_router.delete("/chat/sessions/{session_id}")
-async def delete_session(
-    session_id: str,
-    current_user: dict = Depends(get_current_user)
-):
-    session = await db.chat_sessions.find_one({
-        "id": session_id,
-        "user_id": current_user["id"]
-    })
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+class UploadStream(io.RawIOBase):
+    """Read-only view of a spooled upload with the filename the transcriber should see.
     
-    await db.chat_sessions.delete_one({"id": session_id})
-    await db.chat_messages.delete_many({"session_id": session_id})
+    The HTTP client streams it into the outgoing multipart body in chunks, so the audio is never
+    copied into another in-memory buffer.
+    """
     
-    return {"message": "Session deleted"}
-
-# ============== VOICE ROUTES ==============
-
-class TTSRequest(BaseModel):
-    text: str
-    voice: str = "nova"  # Default: nova voice (energetic, upbeat - good for healthcare)
+    def __init__(self, file, name: str):
+        self._file = file
+        self.name = name
+    
+    def readable(self) -> bool:
+        return True
+    
+    def seekable(self) -> bool:
+        return True
+    
+    def readinto(self, buffer) -> int:
+        data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+    
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+    
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+    
+    def tell(self) -> int:
+        return self._file.tell()
 
-class TTSResponse(BaseModel):
-    audio_base64: str
-    text: str
+def open_audio_upload(upload, filename: Optional[str]) -> UploadStream:
+    """Validate a spooled upload by its header bytes, without reading the body into memory"""
+    upload.seek(0, io.SEEK_END)
+    size = upload.tell()
+    upload.seek(0)
+    head = upload.read(64)
+    upload.seek(0)
+    
+    if size > STT_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {STT_MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit")
+    sniffed = sniff_audio_format(head)
+    if sniffed is None:
+        raise HTTPException(status_code=415, detail="Unsupported audio format; use webm, ogg, wav, flac, m4a or mp3")
+    audio_format, extension = sniffed
+    duration = audio_duration_seconds(upload, audio_format, head, size)
+    if duration is not None and duration > STT_MAX_DURATION_SECONDS:
+        raise HTTPException(status_code=413, detail=f"Audio longer than {STT_MAX_DURATION_SECONDS:g} seconds")
+    
+    # The sniffed type decides the extension; client-supplied names are often wrong or missing
+    stem = Path(filename or "audio").stem or "audio"
+    return UploadStream(upload, f"{stem}.{extension}")
 
-class STTResponse(BaseModel):
-    text: str
+@traced("stt.transcribe")
+async def transcribe_audio(audio_io: UploadStream, user_id: str) -> str:
+    async with voice_limiter.slot(user_id):
+        response = await providers.stt.transcribe(
+            file=audio_io,
+            model="whisper-1",
+            response_format="json",
+            language="en"
+        )
+    return response.text
 
 @api_router.post("/voice/speech-to-text", response_model=STTResponse)
+@traced("voice.speech_to_text")
 async def speech_to_text(
     audio_file: UploadFile = File(...),
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(rate_limited(get_current_user, "voice"))
 ):
     """Convert audio to text using OpenAI Whisper"""
     try:
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        stt = OpenAISpeechToText(api_key=api_key)
-        
-        # Read audio file content
-        audio_content = await audio_file.read()
-        audio_io = io.BytesIO(audio_content)
-        audio_io.name = audio_file.filename or "audio.webm"
+        # Hand the spooled upload straight to the transcriber
+        audio_io = open_audio_upload(audio_file.file, audio_file.filename)
         
         # Transcribe using Whisper
-        response = await stt.transcribe(
-            file=audio_io,
-            model="whisper-1",
-            response_format="json",
-            language="en"
-        )
-        
-        return STTResponse(text=response.text)
+        return STTResponse(text=await transcribe_audio(audio_io, current_user["id"]))
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Speech-to-text error: {e}")
         raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
 
 @api_router.post("/voice/text-to-speech", response_model=TTSResponse)
+@traced("voice.text_to_speech")
 async def text_to_speech(
     request: TTSRequest,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(rate_limited(get_current_user, "voice"))
 ):
     """Convert text to speech using OpenAI TTS"""
     try:
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        tts = OpenAITextToSpeech(api_key=api_key)
-        
-        # Generate audio using OpenAI TTS
-        audio_base64 = await tts.generate_speech_base64(
-            text=request.text,
-            model="tts-1",
-            voice=request.voice,
-            response_format="mp3"
-        )
+        # Generate audio using OpenAI TTS, sentences in parallel
+        parts = [
+            bytes(audio)
+            async for audio in synthesize_pipelined(split_sentences(request.text), request.voice, current_user["id"])
+        ]
         
         return TTSResponse(
-            audio_base64=audio_base64,
+            audio_base64=base64.b64encode(b"".join(parts)).decode('ascii'),
             text=request.text
         )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Text-to-speech error: {e}")
+        raise HTTPException(status_code=500, detail=f"TTS failed: {str(e)}")
+
+TTS_STREAM_CHUNK_BYTES = 64 * 1024
+
+def parse_byte_range(range_header: str, size: int) -> Optional[tuple]:
+    """Inclusive (start, end) for a single `bytes=` range; None when the header should be ignored"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start = max(0, size - int(last))
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+def iter_audio(parts: list, start: int, end: int):
+    # Slices of the cached buffers (or mmaps) so a clip is never copied whole
+    offset = 0
+    for audio in parts:
+        size = len(audio)
+        lo, hi = max(start, offset), min(end + 1, offset + size)
+        if lo < hi:
+            view = memoryview(audio)
+            for position in range(lo - offset, hi - offset, TTS_STREAM_CHUNK_BYTES):
+                yield bytes(view[position:min(position + TTS_STREAM_CHUNK_BYTES, hi - offset)])
+        offset += size
+
+async def iter_audio_pipeline(first, rest):
+    for chunk in iter_audio([first], 0, len(first) - 1):
+        yield chunk
+    try:
+        async for audio in rest:
+            for chunk in iter_audio([audio], 0, len(audio) - 1):
+                yield chunk
+    except Exception as e:
+        # Headers are already sent; the best we can do is end the clip early
+        logging.error(f"Text-to-speech stream error: {e}")
+    finally:
+        await rest.aclose()
+
+async def tts_audio_response(http_request: Request, chunks: List[str], voice: str, current_user: dict) -> Response:
+    if not chunks:
+        raise HTTPException(status_code=400, detail="Text is empty")
+    keys = [tts_cache_key(chunk, voice) for chunk in chunks]
+    # Known before synthesis, but a clip may be regenerated with different bytes, so only weak
+    weak_etag = 'W/"' + hashlib.sha256("\n".join(keys).encode()).hexdigest()[:32] + '"'
+    headers = {"ETag": weak_etag, "Accept-Ranges": "bytes", "Cache-Control": f"private, max-age={TTS_CLIP_TTL_SECONDS}"}
+    
+    cached = [tts_cache.get(key) for key in keys]
+    if all(audio is not None for audio in cached):
+        # Whole clip on hand: a strong ETag from the stored bytes, and exact length for byte ranges
+        digests = "".join(tts_cache.digest(key, audio) for key, audio in zip(keys, cached))
+        etag = '"' + hashlib.sha256(digests.encode()).hexdigest()[:32] + '"'
+        headers["ETag"] = etag
+        if etag_matches(http_request, etag) or etag_matches(http_request, weak_etag):
+            return Response(status_code=304, headers=headers)
+        
+        size = sum(len(audio) for audio in cached)
+        start, end, status_code = 0, size - 1, 200
+        range_header = http_request.headers.get("range")
+        if_range = http_request.headers.get("if-range")
+        # If-Range needs a strong match: a weak or stale tag gets the whole clip
+        if range_header and (not if_range or if_range.strip() == etag):
+            byte_range = parse_byte_range(range_header, size)
+            if byte_range:
+                start, end = byte_range
+                status_code = 206
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        
+        return StreamingResponse(
+            iter_audio(cached, start, end),
+            status_code=status_code,
+            media_type="audio/mpeg",
+            headers=headers
+        )
+    
+    if etag_matches(http_request, weak_etag):
+        return Response(status_code=304, headers=headers)
+    
+    # Otherwise stream sentence by sentence as they finish; Range is ignored (full 200) until cached
+    pipeline = synthesize_pipelined(chunks, voice, current_user["id"])
+    try:
+        first = await pipeline.__anext__()
+    except HTTPException:
+        await pipeline.aclose()
+        raise
     except Exception as e:
+        await pipeline.aclose()
         logging.error(f"Text-to-speech error: {e}")
         raise HTTPException(status_code=500, detail=f"TTS failed: {str(e)}")
+    
+    return StreamingResponse(
+        iter_audio_pipeline(first, pipeline),
+        media_type="audio/mpeg",
+        headers=headers
+    )
+
+@api_router.post("/voice/text-to-speech/stream")
+@traced("voice.text_to_speech_stream")
+async def text_to_speech_stream(
+    request: TTSRequest,
+    http_request: Request,
+    current_user: dict = Depends(rate_limited(get_current_user, "voice"))
+):
+    """Stream MP3 audio as audio/mpeg in the response to the POST itself"""
+    return await tts_audio_response(http_request, split_sentences(request.text), request.voice, current_user)
+
+@api_router.post("/voice/text-to-speech/clips", response_model=TTSClipResponse)
+@traced("voice.create_tts_clip")
+async def create_tts_clip(
+    request: TTSRequest,
+    current_user: dict = Depends(rate_limited(get_current_user, "write"))
+):
+    """Register text for playback and return an opaque URL for it.
+    
+    Audio elements can only GET, and patient text must not end up in URLs or access logs, so the
+    text stays server-side under an id derived from the user and the clip's content.
+    """
+    chunks = split_sentences(request.text)
+    if not chunks:
+        raise HTTPException(status_code=400, detail="Text is empty")
+    keys = [tts_cache_key(chunk, request.voice) for chunk in chunks]
+    clip_id = hashlib.sha256("\n".join([current_user["id"], *keys]).encode()).hexdigest()[:32]
+    await db.tts_clips.update_one(
+        {"id": clip_id},
+        {"$set": {
+            "id": clip_id,
+            "user_id": current_user["id"],
+            "voice": request.voice,
+            "chunks": chunks,
+            "expires": datetime.now(timezone.utc) + timedelta(seconds=TTS_CLIP_TTL_SECONDS)
+        }},
+        upsert=True
+    )
+    return TTSClipResponse(clip_id=clip_id, url=f"/api/voice/text-to-speech/clips/{clip_id}")
+
+@api_router.get("/voice/text-to-speech/clips/{clip_id}")
+@traced("voice.text_to_speech_clip")
+async def text_to_speech_clip(
+    clip_id: str,
+    http_request: Request,
+    current_user: dict = Depends(rate_limited(get_current_user, "voice"))
+):
+    """Stream a registered clip as audio/mpeg, with ETag and Range support"""
+    clip = await db.tts_clips.find_one({"id": clip_id, "user_id": current_user["id"]}, {"_id": 0, "voice": 1, "chunks": 1})
+    if not clip:
+        raise HTTPException(status_code=404, detail="Clip not found")
+    return await tts_audio_response(http_request, clip["chunks"], clip["voice"], current_user)
+
+# ============== VOICE TURNS ==============
+
+# Audio frames are spooled like form uploads: in memory up to this size, on disk beyond it
+VOICE_TURN_SPOOL_BYTES = 1024 * 1024
+# How long a new socket may take to send its auth message
+VOICE_TURN_AUTH_TIMEOUT_SECONDS = 5.0
+
+async def receive_voice_audio(websocket: WebSocket):
+    """Spool binary frames until {"type": "end"}; oversized turns are drained, then rejected"""
+    audio = tempfile.SpooledTemporaryFile(max_size=VOICE_TURN_SPOOL_BYTES)
+    size = 0
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                size += len(message["bytes"])
+                if size <= STT_MAX_UPLOAD_BYTES:
+                    audio.write(message["bytes"])
+            elif json.loads(message.get("text") or "{}").get("type") == "end":
+                break
+        if size > STT_MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"Upload exceeds {STT_MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit")
+        return audio
+    except BaseException:
+        audio.close()
+        raise
+
+@traced("voice.turn")
+async def run_voice_turn(websocket: WebSocket, start: dict, current_user: dict):
+    """STT -> chat turn -> pipelined TTS, sending each stage's result as soon as it exists"""
+    audio = await receive_voice_audio(websocket)
+    try:
+        # Checked once the turn's audio is in, so a rejected turn leaves no frames on the socket
+        await rate_limiter.check("voice", current_user["id"])
+        await rate_limiter.check("llm", current_user["id"])
+        text = await transcribe_audio(open_audio_upload(audio, start.get("filename")), current_user["id"])
+    finally:
+        audio.close()
+    await websocket.send_json({"type": "transcript", "text": text})
+    if not text.strip():
+        raise HTTPException(status_code=422, detail="No speech detected")
+    
+    reply, follow_up = await reply_to_message(
+        ChatMessageCreate(message=text, session_id=start.get("session_id")),
+        current_user
+    )
+    voice = start.get("voice") or "nova"
+    await speak_reply(websocket, reply, voice, current_user["id"])
+    if follow_up is not None:
+        # Shielded: the answer is still saved if the socket goes away while it is pending
+        answer = await asyncio.shield(follow_up)
+        if answer is not None:
+            await speak_reply(websocket, answer, voice, current_user["id"])
+    await websocket.send_json({"type": "audio_end", "session_id": reply.session_id})
+
+async def speak_reply(websocket: WebSocket, reply: ChatMessageResponse, voice: str, user_id: str):
+    await websocket.send_json({"type": "reply", **reply.model_dump()})
+    # MP3 frames concatenate, so sentence clips go out as binary frames the moment they are ready
+    async for clip in synthesize_pipelined(split_sentences(reply.content), voice, user_id):
+        for chunk in iter_audio([clip], 0, len(clip) - 1):
+            await websocket.send_bytes(chunk)
+
+async def authenticate_voice_socket(websocket: WebSocket) -> Optional[dict]:
+    """The user named by the socket's first message, {"type": "auth", "token"}; None once closed.
+    
+    The token comes in a message rather than the URL so it stays out of access logs and traces.
+    """
+    try:
+        message = await asyncio.wait_for(websocket.receive_json(), VOICE_TURN_AUTH_TIMEOUT_SECONDS)
+        if not isinstance(message, dict) or message.get("type") != "auth" or not isinstance(message.get("token"), str):
+            raise HTTPException(status_code=401, detail="Expected an auth message")
+        return await load_user(decode_access_token(message["token"])["sub"])
+    except WebSocketDisconnect:
+        return None
+    except asyncio.TimeoutError:
+        reason = "Authentication timed out"
+    except HTTPException as e:
+        reason = e.detail
+    except (ValueError, KeyError):
+        # Not JSON, or a binary frame
+        reason = "Expected an auth message"
+    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=reason)
+    return None
+
+@api_router.websocket("/voice/turn")
+async def voice_turn(websocket: WebSocket):
+    """Full voice conversation over one authenticated socket.
+    
+    The first message must be {"type": "auth", "token"}, answered with {"type": "ready"}. Per
+    turn the client then sends {"type": "start", "session_id"?, "voice"?, "filename"?}, binary
+    audio frames and {"type": "end"}; the server answers with "transcript", "reply", binary MP3
+    frames and "audio_end". An emergency gets the notice's "reply" and audio first, then a
+    second "reply" and audio with the model's answer. Failures arrive as {"type": "error", "status", "detail"} and the
+    socket stays open.
+    """
+    await websocket.accept()
+    current_user = await authenticate_voice_socket(websocket)
+    if current_user is None:
+        return
+    await websocket.send_json({"type": "ready"})
+    
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            try:
+                start = json.loads(message.get("text") or "null")
+                if not isinstance(start, dict) or start.get("type") != "start":
+                    raise HTTPException(status_code=400, detail="Expected a start message")
+                await run_voice_turn(websocket, start, current_user)
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "status": e.status_code, "detail": e.detail})
+            except json.JSONDecodeError:
+                await websocket.send_json({"type": "error", "status": 400, "detail": "Malformed message"})
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                logging.error(f"Voice turn error: {e}")
+                await websocket.send_json({"type": "error", "status": 500, "detail": "Voice turn failed"})
+    except WebSocketDisconnect:
+        return
 
 @api_router.get("/voice/voices")
-async def get_available_voices(current_user: dict = Depends(get_current_user)):
+async def get_available_voices(current_user: dict = Depends(rate_limited(get_token_user, "read"))):
     """Get list of available OpenAI TTS voices"""
     # OpenAI TTS has 9 available voices
     return {
@@ -507,7 +3443,232 @@ async def get_available_voices(current_user: dict = Depends(get_current_user)):
         ]
     }
 
-# ============== DOCTORS ROUTES ==============
+# ============== SLOT CALENDAR ==============
+
+# Timestamped slots: fixed-length slots inside each doctor's weekly opening hours, one bit per
+# slot per day, so a day's availability is an int and "first free slot" is a lowest-set-bit.
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+SLOT_HORIZON_DAYS = int(os.environ.get('SLOT_HORIZON_DAYS', '60'))
+SLOT_CALENDAR_REFRESH_SECONDS = float(os.environ.get('SLOT_CALENDAR_REFRESH_SECONDS', '30'))
+# Refreshes re-read changes this far before the previous one, covering clock skew between workers
+SLOT_CALENDAR_CHANGE_OVERLAP_SECONDS = 10
+SCHEDULE_TIMEZONE = ZoneInfo(os.environ.get('SCHEDULE_TIMEZONE', 'UTC'))
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+NO_SCHEDULE = (0,) * 7
+
+def schedule_masks(weekly_schedule: Optional[dict]) -> tuple:
+    """Seven day bitmaps (Monday first) from {"mon": [["09:00", "12:00"], ...], ...}"""
+    if not weekly_schedule:
+        return NO_SCHEDULE
+    masks = [0] * 7
+    for day, ranges in weekly_schedule.items():
+        weekday = WEEKDAYS.index(day.lower()[:3])
+        for opens, closes in ranges:
+            first = slot_of_day(opens)
+            last = slot_of_day(closes) if closes != "24:00" else SLOTS_PER_DAY
+            if not 0 <= first < last <= SLOTS_PER_DAY:
+                raise ValueError(f"Bad opening hours {opens}-{closes} on {day}")
+            masks[weekday] |= ((1 << (last - first)) - 1) << first
+    return tuple(masks)
+
+def slot_of_day(clock: str) -> int:
+    hours, minutes = clock.split(":")
+    offset = int(hours) * 60 + int(minutes)
+    if offset % SLOT_MINUTES:
+        raise ValueError(f"{clock} is not on a {SLOT_MINUTES}-minute boundary")
+    return offset // SLOT_MINUTES
+
+def slot_start(position: int) -> datetime:
+    """Wall-clock start of the slot at day_ordinal * SLOTS_PER_DAY + bit, in the schedule timezone"""
+    day, bit = divmod(position, SLOTS_PER_DAY)
+    minutes = bit * SLOT_MINUTES
+    return datetime.combine(date.fromordinal(day), dt_time(minutes // 60, minutes % 60), tzinfo=SCHEDULE_TIMEZONE)
+
+def slot_position(moment: datetime, round_up: bool = False) -> int:
+    """Slot position containing `moment` (or the first one starting at/after it with round_up)"""
+    local = moment.astimezone(SCHEDULE_TIMEZONE)
+    minutes = local.hour * 60 + local.minute
+    bit, remainder = divmod(minutes, SLOT_MINUTES)
+    if round_up and (remainder or local.second or local.microsecond):
+        bit += 1
+    return local.date().toordinal() * SLOTS_PER_DAY + bit
+
+def parse_slot_key(slot: str) -> Optional[int]:
+    """Position of a timestamped slot key, or None for legacy free-text slots"""
+    try:
+        moment = datetime.fromisoformat(slot)
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        return None
+    position = slot_position(moment)
+    return position if slot_start(position) == moment else None
+
+def is_scheduled(week_masks: tuple, position: int) -> bool:
+    day, bit = divmod(position, SLOTS_PER_DAY)
+    # Day ordinal 1 (0001-01-01) was a Monday
+    return bool(week_masks[(day - 1) % 7] >> bit & 1)
+
+def slot_key(position: int) -> str:
+    # Canonical form, so "Z" and "+00:00" spellings reserve the same slot
+    return slot_start(position).isoformat()
+
+def slot_starts_at(slot: str) -> Optional[datetime]:
+    """Start time stored on a reservation, so the calendar can query by date; None for legacy slots"""
+    position = parse_slot_key(slot)
+    return slot_start(position) if position is not None else None
+
+class SlotCalendar:
+    """Reserved-slot bitmaps per doctor per day, answering next-free-slot queries.
+    
+    Mongo's slot_reservations stays the source of truth; this is a read model kept current by
+    reservations made in this process and, for those made elsewhere, a periodic refresh that
+    applies only the reservations changed since the previous one.
+    """
+    
+    def __init__(self, refresh_seconds: float):
+        self.refresh_seconds = refresh_seconds
+        self.reserved = {}  # doctor_id -> {day_ordinal: bitmap}
+        self.synced_at = None  # when the last load/refresh started
+        self.task = None
+    
+    def mark(self, doctor_id: str, slot: str, taken: bool):
+        position = parse_slot_key(slot)
+        if position is None:
+            return
+        day, bit = divmod(position, SLOTS_PER_DAY)
+        days = self.reserved.setdefault(doctor_id, {})
+        if taken:
+            days[day] = days.get(day, 0) | (1 << bit)
+        else:
+            days[day] = days.get(day, 0) & ~(1 << bit)
+    
+    def first_free(self, week_masks: tuple, doctor_id: str, start: int, end: int) -> Optional[int]:
+        """Earliest free slot position in [start, end)"""
+        reserved = self.reserved.get(doctor_id, {})
+        day, bit = divmod(start, SLOTS_PER_DAY)
+        floor = ~((1 << bit) - 1)
+        last_day = (end - 1) // SLOTS_PER_DAY
+        while day <= last_day:
+            free = week_masks[(day - 1) % 7] & floor & ~reserved.get(day, 0)
+            if free:
+                position = day * SLOTS_PER_DAY + (free & -free).bit_length() - 1
+                return position if position < end else None
+            day += 1
+            floor = -1
+        return None
+    
+    def next_free(self, doctors: List[dict], week_masks: dict, after: datetime, limit: int) -> List[tuple]:
+        """The `limit` earliest (position, doctor) free slots across `doctors` starting at/after `after`.
+        
+        A k-way merge: each doctor contributes its first free slot to a heap, and popping a slot
+        pushes that doctor's next one, so cost grows with doctors + limit, not with the horizon.
+        """
+        now = datetime.now(timezone.utc)
+        start = slot_position(max(after, now), round_up=True)
+        end = slot_position(now) + SLOT_HORIZON_DAYS * SLOTS_PER_DAY
+        
+        heap = []
+        for order, doc in enumerate(doctors):
+            masks = week_masks[doc["id"]]
+            if masks is NO_SCHEDULE:
+                continue
+            position = self.first_free(masks, doc["id"], start, end)
+            if position is not None:
+                heap.append((position, order))
+        heapq.heapify(heap)
+        
+        found = []
+        while heap and len(found) < limit:
+            position, order = heapq.heappop(heap)
+            doc = doctors[order]
+            found.append((position, doc))
+            following = self.first_free(week_masks[doc["id"]], doc["id"], position + 1, end)
+            if following is not None:
+                heapq.heappush(heap, (following, order))
+        return found
+    
+    @staticmethod
+    def window() -> tuple:
+        """(first day ordinal, start of that day, end of the horizon) in the schedule timezone"""
+        today = slot_position(datetime.now(timezone.utc)) // SLOTS_PER_DAY
+        return today, slot_start(today * SLOTS_PER_DAY), slot_start((today + SLOT_HORIZON_DAYS + 1) * SLOTS_PER_DAY)
+    
+    async def backfill(self):
+        """Give reservations written before starts_at existed their start time; a no-op afterwards"""
+        updates = []
+        now = datetime.now(timezone.utc)
+        async for reservation in db.slot_reservations.find({"starts_at": {"$exists": False}}, {"slot": 1}):
+            updates.append(UpdateOne(
+                {"_id": reservation["_id"]},
+                {"$set": {"starts_at": slot_starts_at(reservation["slot"]), "changed_at": now}}
+            ))
+        if updates:
+            await db.slot_reservations.bulk_write(updates, ordered=False)
+    
+    async def load(self):
+        """Rebuild from the reservations inside the calendar's window"""
+        synced_at = datetime.now(timezone.utc)
+        _, window_start, window_end = self.window()
+        reserved = {}
+        cursor = db.slot_reservations.find(
+            {"starts_at": {"$gte": window_start, "$lt": window_end}, "appointment_id": {"$ne": None}},
+            {"_id": 0, "doctor_id": 1, "slot": 1}
+        )
+        async for reservation in cursor:
+            position = parse_slot_key(reservation["slot"])
+            if position is None:
+                continue
+            day, bit = divmod(position, SLOTS_PER_DAY)
+            days = reserved.setdefault(reservation["doctor_id"], {})
+            days[day] = days.get(day, 0) | (1 << bit)
+        self.reserved = reserved
+        self.synced_at = synced_at
+    
+    async def refresh(self):
+        """Apply reservations made or released since the last sync, and drop days that have passed"""
+        synced_at = datetime.now(timezone.utc)
+        today, window_start, _ = self.window()
+        since = self.synced_at - timedelta(seconds=SLOT_CALENDAR_CHANGE_OVERLAP_SECONDS)
+        cursor = db.slot_reservations.find(
+            {"changed_at": {"$gt": since}, "starts_at": {"$gte": window_start}},
+            {"_id": 0, "doctor_id": 1, "slot": 1, "appointment_id": 1}
+        )
+        # Re-applying a change seen before is harmless: each one sets the slot's current state
+        async for reservation in cursor:
+            self.mark(reservation["doctor_id"], reservation["slot"], reservation["appointment_id"] is not None)
+        for days in self.reserved.values():
+            for day in [day for day in days if day < today]:
+                del days[day]
+        self.synced_at = synced_at
+    
+    def start(self):
+        if self.refresh_seconds > 0:
+            self.task = asyncio.create_task(self._refresh())
+    
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Slot calendar refresh failed: {e}")
+    
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+slot_calendar = SlotCalendar(SLOT_CALENDAR_REFRESH_SECONDS)
+
+# ============== DOCTOR DIRECTORY ==============
+
+# Where doctors come from: "builtin" (MOCK_DOCTORS), "mongo" (the doctors collection) or a JSON file path
+DOCTOR_SOURCE = os.environ.get('DOCTOR_SOURCE', 'builtin')
+# How often to check the source for changes; 0 disables hot reload
+DOCTOR_RELOAD_SECONDS = float(os.environ.get('DOCTOR_RELOAD_SECONDS', '60'))
+DOCTOR_SORTS = ("rating", "experience", "name")
 
 # Mock doctor data
 MOCK_DOCTORS = [
@@ -518,7 +3679,14 @@ MOCK_DOCTORS = [
         "experience_years": 12,
         "rating": 4.9,
         "available_slots": ["Tomorrow 9:00 AM", "Tomorrow 2:00 PM", "Friday 10:00 AM", "Friday 3:00 PM"],
-        "image_url": "https://images.pexels.com/photos/5215017/pexels-photo-5215017.jpeg?auto=compress&cs=tinysrgb&w=400"
+        "image_url": "https://images.pexels.com/photos/5215017/pexels-photo-5215017.jpeg?auto=compress&cs=tinysrgb&w=400",
+        "weekly_schedule": {
+            "mon": [["09:00", "12:00"], ["14:00", "17:00"]],
+            "tue": [["09:00", "12:00"], ["14:00", "17:00"]],
+            "wed": [["09:00", "12:00"]],
+            "thu": [["09:00", "12:00"], ["14:00", "17:00"]],
+            "fri": [["09:00", "12:00"], ["14:00", "17:00"]]
+        }
     },
     {
         "id": "doc-2",
@@ -527,7 +3695,13 @@ MOCK_DOCTORS = [
         "experience_years": 15,
         "rating": 4.8,
         "available_slots": ["Today 4:00 PM", "Tomorrow 11:00 AM", "Thursday 9:00 AM"],
-        "image_url": "https://images.pexels.com/photos/5327580/pexels-photo-5327580.jpeg?auto=compress&cs=tinysrgb&w=400"
+        "image_url": "https://images.pexels.com/photos/5327580/pexels-photo-5327580.jpeg?auto=compress&cs=tinysrgb&w=400",
+        "weekly_schedule": {
+            "mon": [["11:00", "17:00"]],
+            "wed": [["11:00", "17:00"]],
+            "thu": [["09:00", "13:00"]],
+            "fri": [["11:00", "17:00"]]
+        }
     },
     {
         "id": "doc-3",
@@ -536,7 +3710,14 @@ MOCK_DOCTORS = [
         "experience_years": 8,
         "rating": 4.7,
         "available_slots": ["Tomorrow 8:00 AM", "Tomorrow 1:00 PM", "Friday 11:00 AM", "Friday 4:00 PM"],
-        "image_url": "https://images.pexels.com/photos/8376277/pexels-photo-8376277.jpeg?auto=compress&cs=tinysrgb&w=400"
+        "image_url": "https://images.pexels.com/photos/8376277/pexels-photo-8376277.jpeg?auto=compress&cs=tinysrgb&w=400",
+        "weekly_schedule": {
+            "mon": [["08:00", "14:00"]],
+            "tue": [["08:00", "14:00"]],
+            "wed": [["08:00", "14:00"]],
+            "thu": [["08:00", "14:00"]],
+            "fri": [["08:00", "12:00"], ["13:00", "17:00"]]
+        }
     },
     {
         "id": "doc-4",
@@ -545,112 +3726,790 @@ MOCK_DOCTORS = [
         "experience_years": 20,
         "rating": 4.9,
         "available_slots": ["Today 6:00 PM", "Tomorrow 7:00 AM", "Saturday 9:00 AM"],
-        "image_url": "https://images.pexels.com/photos/5327656/pexels-photo-5327656.jpeg?auto=compress&cs=tinysrgb&w=400"
+        "image_url": "https://images.pexels.com/photos/5327656/pexels-photo-5327656.jpeg?auto=compress&cs=tinysrgb&w=400",
+        "weekly_schedule": {
+            "tue": [["18:00", "24:00"]],
+            "thu": [["18:00", "24:00"]],
+            "sat": [["07:00", "19:00"]],
+            "sun": [["07:00", "19:00"]]
+        }
     }
 ]
 
+class DoctorIndex:
+    """Immutable snapshot of the directory with lookup indexes.
+    
+    Readers grab the current snapshot once per request, so a reload never shows them a half-built
+    index. `version` is a content hash and doubles as the ETag.
+    """
+    
+    def __init__(self, doctors: List[dict]):
+        self.doctors = [DoctorResponse(**doc).model_dump() for doc in doctors]
+        self.version = hashlib.sha256(
+            json.dumps(self.doctors, sort_keys=True).encode()
+        ).hexdigest()[:32]
+        self.by_id = {doc["id"]: doc for doc in self.doctors}
+        
+        # One presorted order per sort key; ratings descending, ties broken by name then id
+        self.orders = {
+            "rating": sorted(self.doctors, key=lambda doc: (-doc["rating"], doc["name"], doc["id"])),
+            "experience": sorted(self.doctors, key=lambda doc: (-doc["experience_years"], doc["name"], doc["id"])),
+            "name": sorted(self.doctors, key=lambda doc: (doc["name"].lower(), doc["id"])),
+        }
+        # Each doctor's place in every order, for re-sorting a filtered subset without a full scan
+        self.positions = {
+            sort: {doc["id"]: i for i, doc in enumerate(order)} for sort, order in self.orders.items()
+        }
+        self.by_specialty = {}
+        for doc in self.orders["rating"]:
+            self.by_specialty.setdefault(doc["specialty"].lower(), []).append(doc)
+        self.specialties = sorted({doc["specialty"] for doc in self.doctors})
+        self.week_masks = {doc["id"]: schedule_masks(doc.get("weekly_schedule")) for doc in self.doctors}
+    
+    def get(self, doctor_id: str) -> Optional[dict]:
+        return self.by_id.get(doctor_id)
+    
+    def query(
+        self,
+        specialty: Optional[str] = None,
+        min_rating: Optional[float] = None,
+        search: Optional[str] = None,
+        sort: str = "rating"
+    ) -> List[dict]:
+        if specialty:
+            # Specialty lists are rating-ordered, so a rating floor is a prefix of them
+            candidates = self.by_specialty.get(specialty.lower(), [])
+            if min_rating is not None:
+                candidates = candidates[:rating_prefix(candidates, min_rating)]
+            if sort != "rating":
+                position = self.positions[sort]
+                candidates = sorted(candidates, key=lambda doc: position[doc["id"]])
+        elif min_rating is not None and sort == "rating":
+            candidates = self.orders["rating"][:rating_prefix(self.orders["rating"], min_rating)]
+        else:
+            candidates = self.orders[sort]
+            if min_rating is not None:
+                candidates = [doc for doc in candidates if doc["rating"] >= min_rating]
+        
+        if search:
+            needle = search.lower()
+            candidates = [doc for doc in candidates if needle in doc["name"].lower()]
+        return candidates
+
+def rating_prefix(doctors: List[dict], min_rating: float) -> int:
+    """Length of the leading run rated >= min_rating in a rating-descending list (binary search)"""
+    lo, hi = 0, len(doctors)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if doctors[mid]["rating"] >= min_rating:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class DoctorDirectory:
+    """Current DoctorIndex plus the loader and background watcher that keep it fresh"""
+    
+    def __init__(self, source: str, reload_seconds: float):
+        self.source = source
+        self.reload_seconds = reload_seconds
+        self.index = DoctorIndex(MOCK_DOCTORS)
+        self.file_mtime = None
+        self.task = None
+        self.stats = {"reloads": 0, "unchanged": 0, "errors": 0}
+    
+    async def load(self) -> Optional[List[dict]]:
+        """Doctors from the source, or None when a file source hasn't changed since the last load"""
+        if self.source == "builtin":
+            return MOCK_DOCTORS
+        if self.source == "mongo":
+            return await db.doctors.find({}, {"_id": 0}).to_list(None)
+        
+        path = Path(self.source)
+        mtime = path.stat().st_mtime
+        if mtime == self.file_mtime:
+            return None
+        self.file_mtime = mtime
+        return json.loads(path.read_text(encoding='utf-8'))
+    
+    async def reload(self) -> bool:
+        """Swap in a fresh index if the source changed; a bad source keeps the current one"""
+        try:
+            doctors = await self.load()
+            if doctors is None:
+                self.stats["unchanged"] += 1
+                return False
+            index = DoctorIndex(doctors)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logging.error(f"Doctor directory reload failed, keeping version {self.index.version}: {e}")
+            return False
+        
+        if index.version == self.index.version:
+            self.stats["unchanged"] += 1
+            return False
+        self.index = index
+        self.stats["reloads"] += 1
+        logging.info(f"Doctor directory loaded {len(index.doctors)} doctors (version {index.version})")
+        return True
+    
+    def start(self):
+        if self.reload_seconds > 0 and self.source != "builtin":
+            self.task = asyncio.create_task(self._watch())
+    
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_seconds)
+            await self.reload()
+    
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+doctor_directory = DoctorDirectory(DOCTOR_SOURCE, DOCTOR_RELOAD_SECONDS)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match uses weak comparison: W/"x" and "x" match
+    if_none_match = request.headers.get("if-none-match")
+    return bool(if_none_match) and (
+        if_none_match.strip() == "*"
+        or etag.removeprefix("W/") in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    )
+
+# ============== SLOT RESERVATIONS ==============
+
+# Availability may lag a reservation made by another worker by at most this long; bookings never do
+SLOT_AVAILABILITY_TTL_SECONDS = float(os.environ.get('SLOT_AVAILABILITY_TTL_SECONDS', '5'))
+
+class SlotInventory:
+    """Atomic per-slot reservations in the slot_reservations collection.
+    
+    One document per (doctor_id, slot), unique-indexed; it is free while appointment_id is null.
+    Reserving is a single find_one_and_update that claims a free document or upserts a new one, so
+    when many requests race for a slot the unique index lets exactly one of them win.
+    """
+    
+    def __init__(self, ttl: float):
+        self.taken = TTLCache(maxsize=10000, ttl=ttl)
+        self.stats = {"reserved": 0, "conflicts": 0, "released": 0, "hits": 0, "misses": 0}
+    
+    async def reserve(self, doctor_id: str, slot: str, appointment_id: str, user_id: str) -> bool:
+        try:
+            await db.slot_reservations.find_one_and_update(
+                {"doctor_id": doctor_id, "slot": slot, "appointment_id": None},
+                {"$set": {
+                    "appointment_id": appointment_id,
+                    "user_id": user_id,
+                    "starts_at": slot_starts_at(slot),
+                    "reserved_at": datetime.now(timezone.utc).isoformat(),
+                    "changed_at": datetime.now(timezone.utc)
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The slot's document exists and is held by someone else
+            self.stats["conflicts"] += 1
+            return False
+        finally:
+            self.invalidate(doctor_id)
+        slot_calendar.mark(doctor_id, slot, True)
+        self.stats["reserved"] += 1
+        return True
+    
+    async def release(self, doctor_id: str, slot: str, appointment_id: str) -> bool:
+        released = await db.slot_reservations.find_one_and_update(
+            {"doctor_id": doctor_id, "slot": slot, "appointment_id": appointment_id},
+            {"$set": {
+                "appointment_id": None,
+                "user_id": None,
+                "released_at": datetime.now(timezone.utc).isoformat(),
+                "changed_at": datetime.now(timezone.utc)
+            }}
+        )
+        self.invalidate(doctor_id)
+        if released is not None:
+            slot_calendar.mark(doctor_id, slot, False)
+            self.stats["released"] += 1
+        return released is not None
+    
+    def invalidate(self, doctor_id: str):
+        self.taken.pop(doctor_id, None)
+    
+    async def taken_slots(self, doctor_ids: List[str]) -> dict:
+        """doctor_id -> frozenset of reserved slots, one query for all cache misses"""
+        result = {}
+        missing = []
+        for doctor_id in doctor_ids:
+            taken = self.taken.get(doctor_id)
+            if taken is None:
+                missing.append(doctor_id)
+            else:
+                result[doctor_id] = taken
+        self.stats["hits"] += len(doctor_ids) - len(missing)
+        self.stats["misses"] += len(missing)
+        
+        if missing:
+            fetched = {doctor_id: set() for doctor_id in missing}
+            cursor = db.slot_reservations.find(
+                {"doctor_id": {"$in": missing}, "appointment_id": {"$ne": None}},
+                {"_id": 0, "doctor_id": 1, "slot": 1}
+            )
+            async for reservation in cursor:
+                fetched[reservation["doctor_id"]].add(reservation["slot"])
+            for doctor_id, slots in fetched.items():
+                result[doctor_id] = self.taken[doctor_id] = frozenset(slots)
+        return result
+    
+    async def with_availability(self, doctors: List[dict]) -> List[dict]:
+        """Doctors with reserved slots removed from available_slots"""
+        taken = await self.taken_slots([doc["id"] for doc in doctors])
+        return [
+            {**doc, "available_slots": [slot for slot in doc["available_slots"] if slot not in taken[doc["id"]]]}
+            if taken[doc["id"]] else doc
+            for doc in doctors
+        ]
+
+slot_inventory = SlotInventory(SLOT_AVAILABILITY_TTL_SECONDS)
+
+def doctors_etag(index: DoctorIndex, doctors: List[dict]) -> str:
+    # Directory version plus the availability actually shown, so a booking changes the tag
+    availability = hashlib.sha256(
+        json.dumps([doc["available_slots"] for doc in doctors]).encode()
+    ).hexdigest()[:16]
+    return f'"{index.version[:16]}-{availability}"'
+
+# ============== DOCTORS ROUTES ==============
+
 @api_router.get("/doctors", response_model=List[DoctorResponse])
-async def get_doctors(current_user: dict = Depends(get_current_user)):
-    return MOCK_DOCTORS
+async def get_doctors(
+    request: Request,
+    response: Response,
+    specialty: Optional[str] = None,
+    min_rating: Optional[float] = Query(None, ge=0, le=5),
+    q: Optional[str] = Query(None, max_length=100),
+    sort: str = Query("rating", pattern="^(rating|experience|name)$"),
+    limit: int = Query(50, ge=1, le=PAGE_MAX_LIMIT),
+    offset: int = Query(0, ge=0),
+    current_user: dict = Depends(rate_limited(get_token_user, "read"))
+):
+    index = doctor_directory.index
+    matches = index.query(specialty, min_rating, q, sort)
+    page = await slot_inventory.with_availability(matches[offset:offset + limit])
+    
+    # The same URL only returns something new when the directory or the page's availability changes
+    headers = {"ETag": doctors_etag(index, page), "Cache-Control": "private, no-cache"}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    response.headers["X-Total-Count"] = str(len(matches))
+    return page
+
+@api_router.get("/slots/next", response_model=List[SlotResponse])
+async def get_next_slots(
+    specialty: Optional[str] = None,
+    doctor_id: Optional[str] = None,
+    after: Optional[datetime] = None,
+    limit: int = Query(10, ge=1, le=PAGE_MAX_LIMIT),
+    current_user: dict = Depends(rate_limited(get_token_user, "read"))
+):
+    """Earliest free timestamped slots, optionally for one specialty or doctor, after a given time"""
+    index = doctor_directory.index
+    if doctor_id:
+        doctor = index.get(doctor_id)
+        doctors = [doctor] if doctor else []
+    elif specialty:
+        doctors = index.query(specialty=specialty)
+    else:
+        doctors = index.doctors
+    
+    if after is not None and after.tzinfo is None:
+        after = after.replace(tzinfo=timezone.utc)
+    found = slot_calendar.next_free(doctors, index.week_masks, after or datetime.now(timezone.utc), limit)
+    return [
+        SlotResponse(
+            doctor_id=doc["id"],
+            doctor_name=doc["name"],
+            specialty=doc["specialty"],
+            start=slot_key(position),
+            end=(slot_start(position) + timedelta(minutes=SLOT_MINUTES)).isoformat()
+        )
+        for position, doc in found
+    ]
+
+@api_router.get("/doctors/specialties", response_model=List[str])
+async def get_specialties(current_user: dict = Depends(rate_limited(get_token_user, "read"))):
+    return doctor_directory.index.specialties
 
 @api_router.get("/doctors/{doctor_id}", response_model=DoctorResponse)
-async def get_doctor(doctor_id: str, current_user: dict = Depends(get_current_user)):
-    for doc in MOCK_DOCTORS:
-        if doc["id"] == doctor_id:
-            return doc
-    raise HTTPException(status_code=404, detail="Doctor not found")
+async def get_doctor(
+    doctor_id: str,
+    request: Request,
+    response: Response,
+    current_user: dict = Depends(rate_limited(get_token_user, "read"))
+):
+    index = doctor_directory.index
+    doctor = index.get(doctor_id)
+    if doctor is None:
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    
+    [doctor] = await slot_inventory.with_availability([doctor])
+    headers = {"ETag": doctors_etag(index, [doctor]), "Cache-Control": "private, no-cache"}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return doctor
 
 # ============== APPOINTMENTS ROUTES ==============
 
 @api_router.post("/appointments", response_model=AppointmentResponse)
 async def create_appointment(
     appointment_data: AppointmentCreate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(rate_limited(get_current_user, "write"))
 ):
     # Find doctor
-    doctor = None
-    for doc in MOCK_DOCTORS:
-        if doc["id"] == appointment_data.doctor_id:
-            doctor = doc
-            break
-    
+    doctor = doctor_directory.index.get(appointment_data.doctor_id)
     if not doctor:
         raise HTTPException(status_code=404, detail="Doctor not found")
     
-    if appointment_data.slot not in doctor["available_slots"]:
+    slot = appointment_data.slot
+    position = parse_slot_key(slot)
+    if position is not None:
+        # Timestamped slot: must be in the doctor's opening hours, ahead of now and within the horizon
+        now_position = slot_position(datetime.now(timezone.utc))
+        week_masks = doctor_directory.index.week_masks[doctor["id"]]
+        in_horizon = now_position < position < now_position + SLOT_HORIZON_DAYS * SLOTS_PER_DAY
+        if not in_horizon or not is_scheduled(week_masks, position):
+            raise HTTPException(status_code=400, detail="Selected slot is not available")
+        slot = slot_key(position)
+    elif slot not in doctor["available_slots"]:
         raise HTTPException(status_code=400, detail="Selected slot is not available")
     
     appointment_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
     
+    if not await slot_inventory.reserve(doctor["id"], slot, appointment_id, current_user["id"]):
+        raise HTTPException(status_code=409, detail="Selected slot has just been booked")
+    
     appointment_doc = {
         "id": appointment_id,
         "user_id": current_user["id"],
         "doctor_id": doctor["id"],
         "doctor_name": doctor["name"],
         "doctor_specialty": doctor["specialty"],
-        "slot": appointment_data.slot,
+        "slot": slot,
         "symptoms": appointment_data.symptoms,
         "notes": appointment_data.notes or "",
         "status": "scheduled",
         "created_at": now
     }
     
-    await db.appointments.insert_one(appointment_doc)
+    try:
+        await db.appointments.insert_one(appointment_doc)
+    except Exception:
+        # Don't strand the slot if the appointment itself couldn't be saved
+        await slot_inventory.release(doctor["id"], slot, appointment_id)
+        raise
     
     return AppointmentResponse(**appointment_doc)
 
 @api_router.get("/appointments", response_model=List[AppointmentResponse])
-async def get_appointments(current_user: dict = Depends(get_current_user)):
-    appointments = await db.appointments.find(
-        {"user_id": current_user["id"]},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(50)
-    return appointments
+async def get_appointments(
+    response: Response,
+    limit: int = Query(50, ge=1, le=PAGE_MAX_LIMIT),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    current_user: dict = Depends(rate_limited(get_token_user, "read"))
+):
+    return await fetch_page(
+        "appointments", {"user_id": current_user["id"]}, "created_at",
+        limit, before, after, response
+    )
 
 @api_router.patch("/appointments/{appointment_id}/cancel")
 async def cancel_appointment(
     appointment_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(rate_limited(get_current_user, "write"))
 ):
-    result = await db.appointments.update_one(
+    previous = await db.appointments.find_one_and_update(
         {"id": appointment_id, "user_id": current_user["id"]},
-        {"$set": {"status": "cancelled"}}
+        {"$set": {"status": "cancelled"}},
+        projection={"_id": 0, "doctor_id": 1, "slot": 1, "status": 1}
     )
     
-    if result.matched_count == 0:
+    if previous is None:
         raise HTTPException(status_code=404, detail="Appointment not found")
     
+    if previous["status"] != "cancelled":
+        await slot_inventory.release(previous["doctor_id"], previous["slot"], appointment_id)
+    
     return {"message": "Appointment cancelled"}
 
+# ============== INDEXES ==============
+
+# Indexes backing every lookup and .find().sort() above; create_indexes is idempotent
+INDEX_MODELS = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+    ],
+    "chat_sessions": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING), ("last_message_at", DESCENDING), ("id", DESCENDING)], name="user_last_message"),
+    ],
+    "chat_messages": [
+        IndexModel([("session_id", ASCENDING), ("timestamp", ASCENDING), ("id", ASCENDING)], name="session_timestamp"),
+    ],
+    "appointments": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="user_created"),
+    ],
+    "doctors": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+    ],
+    "slot_reservations": [
+        IndexModel([("doctor_id", ASCENDING), ("slot", ASCENDING)], unique=True, name="doctor_slot_unique"),
+        IndexModel([("starts_at", ASCENDING), ("appointment_id", ASCENDING)], name="starts_at_window"),
+        IndexModel([("changed_at", ASCENDING), ("starts_at", ASCENDING)], name="changed_since"),
+    ],
+    "rate_limits": [
+        IndexModel([("expires", ASCENDING)], expireAfterSeconds=0, name="expires_ttl"),
+    ],
+    "tts_clips": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("expires", ASCENDING)], expireAfterSeconds=0, name="expires_ttl"),
+    ],
+}
+
+# (name, collection, filter, sort) for each query the API serves per request
+HOT_QUERIES = [
+    ("user by email", "users", {"email": ""}, None),
+    ("user by id", "users", {"id": ""}, None),
+    ("sessions by user", "chat_sessions", {"user_id": ""}, [("last_message_at", -1), ("id", -1)]),
+    ("session by id and user", "chat_sessions", {"id": "", "user_id": ""}, None),
+    ("messages by session", "chat_messages", {"session_id": ""}, [("timestamp", -1), ("id", -1)]),
+    ("appointments by user", "appointments", {"user_id": ""}, [("created_at", -1), ("id", -1)]),
+    ("appointment by id and user", "appointments", {"id": "", "user_id": ""}, None),
+    ("reservations by doctor", "slot_reservations", {"doctor_id": {"$in": [""]}, "appointment_id": {"$ne": None}}, None),
+    ("calendar window", "slot_reservations", {"starts_at": {"$gte": datetime.min, "$lt": datetime.max}, "appointment_id": {"$ne": None}}, None),
+    ("calendar changes", "slot_reservations", {"changed_at": {"$gt": datetime.min}, "starts_at": {"$gte": datetime.min}}, None),
+    ("clip by id and user", "tts_clips", {"id": "", "user_id": ""}, None),
+]
+
+async def ensure_indexes():
+    for collection, models in INDEX_MODELS.items():
+        try:
+            await db[collection].create_indexes(models)
+        except Exception as e:
+            # e.g. duplicate emails predating the unique index; keep serving, but make it visible
+            logging.error(f"Index creation failed for {collection}: {e}")
+
+def plan_stages(plan: dict) -> List[str]:
+    """Flatten a winning plan tree into its stage names"""
+    stages = [plan.get("stage", "")]
+    if "inputStage" in plan:
+        stages += plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+async def explain_hot_queries() -> List[dict]:
+    """Run explain() on each hot query and flag the ones that scan the whole collection"""
+    report = []
+    for name, collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = await cursor.explain()
+        winning_plan = plan.get("queryPlanner", {}).get("winningPlan", {})
+        # Newer servers nest the classic plan under queryPlan
+        stages = plan_stages(winning_plan.get("queryPlan", winning_plan))
+        report.append({
+            "query": name,
+            "collection": collection,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+    return report
+
+# ============== METRICS ENDPOINT ==============
+
+@metrics.collector("carebot_http_requests_in_flight", "gauge", "HTTP requests currently being served")
+def collect_in_flight():
+    middleware = getattr(MetricsMiddleware, "instance", None)
+    yield {}, middleware.in_flight if middleware else 0
+
+@metrics.collector("carebot_event_loop_lag_last_seconds", "gauge", "Most recent event-loop lag sample")
+def collect_loop_lag():
+    yield {}, loop_monitor.lag
+
+@metrics.collector("carebot_cache_requests_total", "counter", "Cache lookups by cache and result")
+def collect_cache_requests():
+    caches = {
+        "user": (user_cache.hits, user_cache.misses),
+        "conversation": (conversation_store.hits, conversation_store.misses),
+        "response": (response_cache.exact_hits + response_cache.similar_hits, response_cache.misses),
+        "tts": (tts_cache.stats["memory_hits"] + tts_cache.stats["disk_hits"], tts_cache.stats["misses"]),
+        "slot_availability": (slot_inventory.stats["hits"], slot_inventory.stats["misses"]),
+    }
+    for cache, (hits, misses) in caches.items():
+        yield {"cache": cache, "result": "hit"}, hits
+        yield {"cache": cache, "result": "miss"}, misses
+
+@metrics.collector("carebot_cache_hit_ratio", "gauge", "Share of cache lookups served from the cache")
+def collect_cache_hit_ratio():
+    totals = {}
+    for labels, value in collect_cache_requests():
+        totals.setdefault(labels["cache"], {})[labels["result"]] = value
+    for cache, counts in totals.items():
+        lookups = counts["hit"] + counts["miss"]
+        yield {"cache": cache}, counts["hit"] / lookups if lookups else 0.0
+
+@metrics.collector("carebot_upstream_in_flight", "gauge", "Upstream provider calls in flight or queued")
+def collect_upstream():
+    for limiter in (llm_limiter, voice_limiter):
+        yield {"limiter": limiter.name, "state": "in_flight"}, limiter.in_flight
+        yield {"limiter": limiter.name, "state": "waiting"}, limiter.waiting
+
+@metrics.collector("carebot_upstream_rejected_total", "counter", "Upstream calls rejected with 429")
+def collect_upstream_rejected():
+    for limiter in (llm_limiter, voice_limiter):
+        yield {"limiter": limiter.name}, limiter.stats["rejected"]
+
+@metrics.collector("carebot_rate_limited_total", "counter", "Requests rejected by rate limits")
+def collect_rate_limited():
+    for (endpoint_class, scope), count in list(rate_limiter.stats.items()):
+        yield {"class": endpoint_class, "scope": scope}, count
+
+@metrics.collector("carebot_llm_calls_total", "counter", "LLM call outcomes")
+def collect_llm_outcomes():
+    for outcome, count in llm_caller.outcomes.items():
+        yield {"outcome": outcome}, count
+
+@metrics.collector("carebot_llm_circuit_open", "gauge", "1 when the LLM circuit breaker is not closed")
+def collect_circuit():
+    yield {"state": llm_caller.breaker.state}, 0 if llm_caller.breaker.state == "closed" else 1
+
+@metrics.collector("carebot_mongo_pool_connections", "gauge", "MongoDB pool connections in use and checkouts waiting")
+def collect_mongo_pool():
+    for address, count in list(mongo_pool.checked_out.items()):
+        yield {"server": f"{address[0]}:{address[1]}", "state": "checked_out"}, count
+    for address, count in list(mongo_pool.waiting.items()):
+        yield {"server": f"{address[0]}:{address[1]}", "state": "waiting"}, count
+
+@metrics.collector("carebot_chat_streams_active", "gauge", "Chat replies currently streaming")
+def collect_chat_streams():
+    yield {}, chat_stream_stats["active"]
+
+@metrics.collector("carebot_password_hash_pending", "gauge", "bcrypt jobs running or queued")
+def collect_password_hash():
+    yield {}, password_hash_stats["pending"]
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    """Prometheus text exposition"""
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # ============== HEALTH CHECK ==============
 
 @api_router.get("/")
 async def root():
     return {"message": "Healthcare Chatbot API", "status": "healthy"}
 
+READINESS_CACHE_SECONDS = float(os.environ.get('READINESS_CACHE_SECONDS', '2'))
+READINESS_MONGO_TIMEOUT_SECONDS = float(os.environ.get('READINESS_MONGO_TIMEOUT_SECONDS', '1'))
+READINESS_MAX_POOL_SATURATION = float(os.environ.get('READINESS_MAX_POOL_SATURATION', '0.95'))
+READINESS_MAX_LOOP_LAG_SECONDS = float(os.environ.get('READINESS_MAX_LOOP_LAG_SECONDS', '1.0'))
+
+class ReadinessProbe:
+    """Dependency checks behind /health/ready, cached so load-balancer polling adds no load.
+    
+    Concurrent callers share one probe while it runs. An open LLM circuit only marks the pod
+    "degraded": every pod shares the provider, so pulling them all out of rotation would also
+    take down doctors and appointments.
+    """
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.result = None
+        self.checked_at = 0.0
+        self.lock = asyncio.Lock()
+        self.stats = {"probes": 0, "cached": 0}
+    
+    async def check(self) -> dict:
+        if self.result is not None and time.monotonic() - self.checked_at < self.ttl:
+            self.stats["cached"] += 1
+            return self.result
+        async with self.lock:
+            if self.result is None or time.monotonic() - self.checked_at >= self.ttl:
+                self.result = await self.probe()
+                self.checked_at = time.monotonic()
+                self.stats["probes"] += 1
+            else:
+                self.stats["cached"] += 1
+            return self.result
+    
+    async def probe(self) -> dict:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(db.command("ping"), READINESS_MONGO_TIMEOUT_SECONDS)
+            mongo = {"ok": True}
+        except asyncio.TimeoutError:
+            mongo = {"ok": False, "error": "timeout"}
+        except Exception as e:
+            mongo = {"ok": False, "error": str(e)}
+        mongo["latency_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        
+        max_pool_size = client.options.pool_options.max_pool_size
+        saturation = mongo_pool.saturation(max_pool_size)
+        waiting = sum(mongo_pool.waiting.values())
+        pool = {
+            "ok": saturation is None or not (saturation >= READINESS_MAX_POOL_SATURATION and waiting > 0),
+            "checked_out": sum(mongo_pool.checked_out.values()),
+            "waiting": waiting,
+            "max_pool_size": max_pool_size,
+            "saturation": round(saturation, 3) if saturation is not None else None,
+        }
+        loop = {"ok": loop_monitor.lag <= READINESS_MAX_LOOP_LAG_SECONDS, "lag_ms": round(loop_monitor.lag * 1000, 2)}
+        llm = {"ok": llm_caller.breaker.state == "closed", "circuit": llm_caller.breaker.state}
+        
+        ready = mongo["ok"] and pool["ok"] and loop["ok"]
+        return {
+            "status": ("ready" if llm["ok"] else "degraded") if ready else "not_ready",
+            "checked_at": datetime.now(timezone.utc).isoformat(),
+            "checks": {"mongo": mongo, "mongo_pool": pool, "event_loop": loop, "llm": llm},
+        }
+
+readiness_probe = ReadinessProbe(READINESS_CACHE_SECONDS)
+
 @api_router.get("/health")
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
+@api_router.get("/health/live")
+async def liveness_check():
+    """The process is up and its event loop is answering; no dependencies are touched"""
+    return {"status": "alive", "timestamp": datetime.now(timezone.utc).isoformat()}
+
+@api_router.get("/health/ready")
+async def readiness_check():
+    """200 while this pod should receive traffic, 503 otherwise"""
+    result = await readiness_probe.check()
+    status_code = 503 if result["status"] == "not_ready" else 200
+    return Response(json.dumps(result), status_code=status_code, media_type="application/json")
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(UploadLimitMiddleware, limits={STT_PATH: STT_MAX_UPLOAD_BYTES})
+
+app.add_middleware(MetricsMiddleware)
+
+app.add_middleware(TracingMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Before-Cursor", "X-After-Cursor", "X-Total-Count", "ETag", "Content-Range", "Accept-Ranges", "X-Request-ID"],
 )
 
 # Configure logging
+class RequestIdFilter(logging.Filter):
+    """Stamps log records with the request they were emitted under"""
+    
+    def filter(self, record):
+        record.request_id = current_request_id() or "-"
+        return True
+
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_loop_monitor():
+    loop_monitor.start()
+
+@app.on_event("startup")
+async def start_trace_exporter():
+    trace_exporter.start()
+
+@app.on_event("startup")
+async def create_db_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def load_doctor_directory():
+    await doctor_directory.reload()
+    doctor_directory.start()
+
+@app.on_event("startup")
+async def load_slot_calendar():
+    await slot_calendar.backfill()
+    await slot_calendar.load()
+    slot_calendar.start()
+
+@app.on_event("startup")
+async def start_tts_prewarm():
+    if TTS_PREWARM:
+        # In the background so a slow provider doesn't hold up startup
+        spawn_background(prewarm_tts_cache())
+
+@app.on_event("startup")
+async def start_chat_write_behind():
+    if CHAT_WRITE_BEHIND:
+        chat_write_behind.start()
+
+@app.on_event("shutdown")
+async def flush_chat_write_behind():
+    # Runs before the client is closed so queued turns still reach Mongo
+    await chat_write_behind.stop()
+
+@app.on_event("shutdown")
+async def stop_loop_monitor():
+    await loop_monitor.stop()
+
+@app.on_event("shutdown")
+async def flush_trace_exporter():
+    await trace_exporter.stop()
+
+@app.on_event("shutdown")
+async def stop_doctor_directory():
+    await doctor_directory.stop()
+
+@app.on_event("shutdown")
+async def stop_slot_calendar():
+    await slot_calendar.stop()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+@app.on_event("shutdown")
+async def shutdown_password_hash_pool():
+    password_hash_executor.shutdown(wait=False)
+
+async def check_indexes() -> int:
+    await ensure_indexes()
+    report = await explain_hot_queries()
+    for entry in report:
+        flag = "COLLSCAN" if entry["collscan"] else "ok"
+        print(f"{flag:<8} {entry['collection']:<14} {entry['query']:<28} {' > '.join(entry['stages'])}")
+    client.close()
+    return 1 if any(entry["collscan"] for entry in report) else 0
+
+if __name__ == "__main__":
+    # python server.py check-indexes: create indexes, then explain each hot query
+    if sys.argv[1:] == ["check-indexes"]:
+        sys.exit(asyncio.run(check_indexes()))
+    print("Usage: python server.py check-indexes")
+    sys.exit(2)
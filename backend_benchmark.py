@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for CareBot backend hot paths.
+
+Usage: python backend_benchmark.py [benchmark ...]
+Runs every benchmark when none are named. Uses backend/.env like the server.
+"""
+
+import asyncio
+import io
+import itertools
+import random
+import re
+import statistics
+import struct
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI, File, UploadFile
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+import server
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def sample_loop_lag(stop, samples, interval=0.005):
+    """Record how late the event loop wakes a sleeping task"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def bench_password_hashing(logins=32):
+    """Event-loop lag while many logins verify bcrypt hashes concurrently"""
+    hashed = server.hash_password("benchmark-password")
+
+    async def inline_login():
+        await asyncio.sleep(0)
+        return server.verify_password("benchmark-password", hashed)
+
+    async def pooled_login():
+        return await server.verify_password_async("benchmark-password", hashed)
+
+    print(f"🔐 Password hashing: {logins} concurrent logins, {server.PASSWORD_HASH_WORKERS} pool workers")
+    for label, login in (("inline", inline_login), ("pooled", pooled_login)):
+        stop = asyncio.Event()
+        lag = []
+        sampler = asyncio.create_task(sample_loop_lag(stop, lag))
+        await asyncio.sleep(0.02)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        await sampler
+        print(
+            f"   {label:<7} wall {elapsed * 1000:8.1f} ms | loop lag p50 {statistics.median(lag) * 1000:7.2f} ms"
+            f" p95 {percentile(lag, 95) * 1000:7.2f} ms max {max(lag) * 1000:7.2f} ms"
+        )
+    print(f"   peak queue depth {server.password_hash_stats['peak_queue_depth']}")
+
+
+DISCLAIMER = "⚠️ This is not a medical diagnosis. Please consult a healthcare professional if symptoms persist or worsen."
+
+# (assistant reply, expected severity, expected suggestions)
+CLASSIFIER_CORPUS = [
+    ("🚨 EMERGENCY: Please call emergency services (911) or go to the nearest emergency room immediately.", "emergency", []),
+    ("Chest pain with shortness of breath can be serious. Call 911 right away.", "emergency", []),
+    ("Please go to the emergency room now, these are signs of a stroke.", "emergency", []),
+    (f"A mild headache often improves with rest and plenty of water. {DISCLAIMER}", "mild", ["Get adequate rest", "Stay hydrated"]),
+    (f"You can take acetaminophen or ibuprofen as directed on the label. {DISCLAIMER}", "mild", ["Consider OTC pain relievers"]),
+    (f"For a cold, stay hydrated, get some rest and try warm fluids. {DISCLAIMER}", "mild", ["Get adequate rest", "Stay hydrated"]),
+    (f"Clean the small cut and cover it with a bandage. {DISCLAIMER}", "mild", []),
+    (f"I understand your interest in natural remedies; honey in tea can soothe a sore throat. {DISCLAIMER}", "mild", []),
+    (f"The restaurant food may have upset your stomach; sip clear fluids. {DISCLAIMER}", "mild", ["Stay hydrated"]),
+    ("This is not an emergency, but a cough lasting three weeks should be checked by a doctor.", "consultation", []),
+    ("I'd recommend booking an appointment to have that rash examined.", "consultation", []),
+    ("Persistent back pain like this deserves medical attention from a physician.", "consultation", []),
+    (f"Since the fever has lasted five days, please consult your doctor. {DISCLAIMER}", "consultation", []),
+    ("It isn't an emergency, but you should see a doctor this week.", "consultation", []),
+]
+
+# (patient message, whether it should get the emergency notice); negatives are benign
+# messages that share words with the emergency rules
+PATIENT_MESSAGE_CORPUS = [
+    ("I have crushing chest pain spreading to my left arm", True),
+    ("I can't breathe and my lips are turning blue", True),
+    ("My dad is unconscious and won't respond", True),
+    ("Her face is drooping and she has slurred speech", True),
+    ("I think I took an overdose of my sleeping pills", True),
+    ("My friend overdosed and won't wake up", True),
+    ("I want to kill myself", True),
+    ("My throat is closing after eating peanuts", True),
+    ("The cut won't stop bleeding, there's blood everywhere", True),
+    ("Chest pain and I'm short of breath", True),
+    ("I think I am having a heart attack", True),
+    ("my wife is having a stroke", True),
+    ("my face is drooping", True),
+    ("I want to die", True),
+    ("I took too many pills", True),
+    ("My toddler swallowed bleach", True),
+    ("chest pain and trouble breathing", True),
+    ("He collapsed and is not breathing", True),
+    ("I can’t breathe through my nose, stuffy", False),
+    ("I can't breathe through my nose at night because of congestion", False),
+    ("Is it possible to overdose on ibuprofen?", False),
+    ("What is a normal overdose of vitamin C?", False),
+    ("Can you overdose on melatonin?", False),
+    ("I'm not suicidal, just feeling low this week", False),
+    ("I have no chest pain, just a cough", False),
+    ("Is it normal to have chest pain after coughing a lot?", False),
+    ("I've never had a seizure but my cousin has epilepsy", False),
+    ("Mild headache since this morning", False),
+    ("My knee hurts after running", False),
+    ("What happens if I take ibuprofen with a cold medicine?", False),
+    ("What are the signs of a heart attack in women?", False),
+    ("My father had a stroke last year, how can I lower my risk?", False),
+    ("Is it safe to clean the bathroom with bleach?", False),
+    ("I'm dying to know if stretching helps my back", False),
+    ("How many pills of ibuprofen can I take in a day?", False),
+    ("I had a heart attack five years ago and want to start running", False),
+]
+
+
+def legacy_classify(response):
+    """The substring-scan classifier the compiled matcher replaced, kept as a baseline"""
+    severity = "mild"
+    response_lower = response.lower()
+    if "emergency" in response_lower or "🚨" in response or "911" in response_lower:
+        severity = "emergency"
+    elif "consult" in response_lower or "doctor" in response_lower or "appointment" in response_lower:
+        severity = "consultation"
+    suggestions = []
+    if severity == "mild":
+        if "rest" in response_lower:
+            suggestions.append("Get adequate rest")
+        if "hydrat" in response_lower or "water" in response_lower:
+            suggestions.append("Stay hydrated")
+        if "pain reliever" in response_lower or "acetaminophen" in response_lower or "ibuprofen" in response_lower:
+            suggestions.append("Consider OTC pain relievers")
+    return {"severity": severity, "suggestions": suggestions}
+
+
+async def bench_classifier(iterations=20000):
+    """Accuracy on CLASSIFIER_CORPUS and per-call cost, legacy scan vs compiled matcher"""
+    print(f"🏷️  Classifier: {len(CLASSIFIER_CORPUS)} labelled replies, {iterations} timed calls")
+    for label, classify in (("legacy", legacy_classify), ("compiled", server.classify_response)):
+        correct = sum(
+            classify(text) == {"severity": severity, "suggestions": suggestions}
+            for text, severity, suggestions in CLASSIFIER_CORPUS
+        )
+        started = time.perf_counter()
+        for i in range(iterations):
+            classify(CLASSIFIER_CORPUS[i % len(CLASSIFIER_CORPUS)][0])
+        per_call = (time.perf_counter() - started) / iterations
+        print(f"   {label:<9} accuracy {correct}/{len(CLASSIFIER_CORPUS)} | {per_call * 1e6:6.2f} µs per call")
+
+    # The emergency notice on patient messages: misses and false alarms both matter
+    misses = [text for text, emergency in PATIENT_MESSAGE_CORPUS if emergency and not server.triage_classifier.is_emergency_message(text)]
+    false_alarms = [text for text, emergency in PATIENT_MESSAGE_CORPUS if not emergency and server.triage_classifier.is_emergency_message(text)]
+    correct = len(PATIENT_MESSAGE_CORPUS) - len(misses) - len(false_alarms)
+    print(f"   patient   accuracy {correct}/{len(PATIENT_MESSAGE_CORPUS)} | {len(misses)} missed, {len(false_alarms)} false alarms")
+    for text in misses + false_alarms:
+        print(f"      ✗ {text}")
+
+    # Extending the table: one word-boundary regex per rule vs the single compiled pass
+    rules = [
+        {"pattern": f"synthetic symptom {i}", "label": "consultation", "weight": 1.0, "key": "consultation"}
+        for i in range(500)
+    ]
+    per_rule = [re.compile(rf"(?<!\w){re.escape(rule['pattern'])}(?!\w)") for rule in rules]
+    matcher = server.PhraseMatcher(rules)
+    texts = [text.lower() for text, _, _ in CLASSIFIER_CORPUS]
+    for label, scan in (
+        ("per-rule", lambda text: [regex.search(text) for regex in per_rule]),
+        ("compiled", matcher.scores),
+    ):
+        started = time.perf_counter()
+        for i in range(iterations // 20):
+            scan(texts[i % len(texts)])
+        per_call = (time.perf_counter() - started) / (iterations // 20)
+        print(f"   {label:<9} {len(rules)} rules | {per_call * 1e6:8.2f} µs per call")
+
+
+class CountingTranscriber:
+    """Stands in for Whisper: drains the upload in chunks the way the HTTP client would"""
+
+    async def transcribe(self, file, model, response_format, language):
+        size = 0
+        while chunk := file.read(64 * 1024):
+            size += len(chunk)
+        await asyncio.sleep(0.05)
+        return type("Transcription", (), {"text": f"{size} bytes"})()
+
+
+# EBML header and a Segment whose Info states a one-minute duration, so uploads pass the length check
+WEBM_HEADER = (
+    b"\x1a\x45\xdf\xa3\x80" + b"\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff"
+    + b"\x15\x49\xa9\x66\x8b\x44\x89\x88" + struct.pack(">d", 60_000.0)
+)
+
+
+def multipart_upload(size, chunk=64 * 1024):
+    """Streamed multipart body with a WebM header, so the client never holds the whole file"""
+    async def body():
+        yield (
+            b'--bench\r\nContent-Disposition: form-data; name="audio_file"; filename="clip.webm"\r\n'
+            b"Content-Type: audio/webm\r\n\r\n" + WEBM_HEADER
+        )
+        for offset in range(0, size, chunk):
+            yield bytes(min(chunk, size - offset))
+        yield b"\r\n--bench--\r\n"
+    return body()
+
+
+def legacy_stt_app():
+    """The read-everything handler the streamed upload replaced, kept as a baseline"""
+    legacy = FastAPI()
+
+    @legacy.post("/api/voice/speech-to-text")
+    async def speech_to_text(audio_file: UploadFile = File(...)):
+        audio_content = await audio_file.read()
+        audio_io = io.BytesIO(audio_content)
+        audio_io.name = audio_file.filename or "audio.webm"
+        response = await server.providers.stt.transcribe(file=audio_io, model="whisper-1", response_format="json", language="en")
+        return {"text": response.text}
+
+    return legacy
+
+
+async def bench_stt_uploads(uploads=8, size_mb=20):
+    """Peak Python heap while concurrent large uploads are transcribed, buffered vs streamed"""
+    size = size_mb * 1024 * 1024
+    server.providers.stt = CountingTranscriber()
+    # One user per upload so the per-user voice cap doesn't turn the benchmark into a 429 test
+    users = itertools.count()
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": f"benchmark-user-{next(users)}"}
+    headers = {"Content-Type": "multipart/form-data; boundary=bench"}
+
+    print(f"🎙️  Speech-to-text uploads: {uploads} concurrent x {size_mb} MB")
+    for label, app in (("buffered", legacy_stt_app()), ("streamed", server.app)):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            tracemalloc.start()
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(
+                client.post("/api/voice/speech-to-text", content=multipart_upload(size), headers=headers)
+                for _ in range(uploads)
+            ))
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        statuses = sorted({response.status_code for response in responses})
+        print(
+            f"  {label:9s} peak heap {peak / 1024 / 1024:7.1f} MB "
+            f"({peak / uploads / size:4.2f}x upload size each)  {elapsed:5.2f}s  status {statuses}"
+        )
+    server.app.dependency_overrides.clear()
+
+
+SPECIALTIES = ["Cardiology", "Dermatology", "Family Medicine", "General Practitioner", "Internal Medicine",
+               "Neurology", "Pediatrics", "Psychiatry", "Orthopedics", "Emergency Medicine"]
+
+
+def generated_doctors(count, rng):
+    """Doctors with varied weekly opening hours, as a directory file would list them"""
+    template = dict(server.MOCK_DOCTORS[0])
+    doctors = []
+    for i in range(count):
+        start = rng.choice(["07:00", "08:00", "09:00", "10:00"])
+        end = rng.choice(["13:00", "16:00", "17:00", "19:00"])
+        days = rng.sample(server.WEEKDAYS[:6], rng.randint(3, 5))
+        doctors.append({
+            **template,
+            "id": f"bench-{i}",
+            "name": f"Dr. Bench {i}",
+            "specialty": SPECIALTIES[i % len(SPECIALTIES)],
+            "rating": round(rng.uniform(3.5, 5.0), 1),
+            "weekly_schedule": {day: [[start, end]] for day in days},
+        })
+    return doctors
+
+
+def materialized_next_free(doctors, reserved, after, horizon_days, limit):
+    """Baseline: expand every slot as a datetime, drop reserved ones, sort"""
+    candidates = []
+    for doc in doctors:
+        for offset in range(horizon_days):
+            day = after.date() + timedelta(days=offset)
+            for opens, closes in doc["weekly_schedule"].get(server.WEEKDAYS[day.weekday()], []):
+                moment = datetime.combine(day, datetime.strptime(opens, "%H:%M").time(), tzinfo=timezone.utc)
+                end = datetime.combine(day, datetime.strptime(closes, "%H:%M").time(), tzinfo=timezone.utc)
+                while moment < end:
+                    if moment >= after and (doc["id"], moment) not in reserved:
+                        candidates.append((moment, doc["id"]))
+                    moment += timedelta(minutes=server.SLOT_MINUTES)
+    return sorted(candidates)[:limit]
+
+
+async def bench_slot_queries(doctors=5000, days=90, booked=0.4, queries=200):
+    """Next-10 free slots across a specialty: bitmap k-way merge vs materialized slot lists"""
+    rng = random.Random(20)
+    server.SLOT_HORIZON_DAYS = days
+    index = server.DoctorIndex(generated_doctors(doctors, rng))
+    calendar = server.SlotCalendar(0)
+
+    # Book a share of every doctor's scheduled slots over the horizon
+    now = datetime.now(timezone.utc)
+    first = server.slot_position(now, round_up=True)
+    reserved = set()
+    for doc in index.doctors:
+        masks = index.week_masks[doc["id"]]
+        for position in range(first, first + days * server.SLOTS_PER_DAY):
+            if server.is_scheduled(masks, position) and rng.random() < booked:
+                key = server.slot_key(position)
+                calendar.mark(doc["id"], key, True)
+                reserved.add((doc["id"], server.slot_start(position)))
+    bitmap_days = sum(len(days_map) for days_map in calendar.reserved.values())
+    bitmap_bytes = sum(sys.getsizeof(bits) for days_map in calendar.reserved.values() for bits in days_map.values())
+
+    print(f"📅 Slot queries: {doctors} doctors, {days}-day horizon, {booked:.0%} booked, "
+          f"{len(reserved)} reservations in {bitmap_days} day bitmaps (~{bitmap_bytes / 1024 / 1024:.1f} MB)")
+    afters = [now + timedelta(hours=rng.uniform(0, 24 * 30)) for _ in range(queries)]
+    for label, specialty in (("one specialty", SPECIALTIES[3]), ("all doctors", None)):
+        candidates = index.query(specialty=specialty) if specialty else index.doctors
+        timings = []
+        for after in afters:
+            started = time.perf_counter()
+            calendar.next_free(candidates, index.week_masks, after, 10)
+            timings.append(time.perf_counter() - started)
+        print(f"  bitmap       {label:14s} ({len(candidates):5d} doctors) "
+              f"p50 {percentile(timings, 50) * 1000:7.2f}ms  p99 {percentile(timings, 99) * 1000:7.2f}ms")
+
+    candidates = index.query(specialty=SPECIALTIES[3])
+    timings = []
+    for after in afters[:5]:  # slow enough that a handful of runs is plenty
+        started = time.perf_counter()
+        expected = materialized_next_free(candidates, reserved, after, days, 10)
+        timings.append(time.perf_counter() - started)
+    # Doctors tied on the same start time may be picked differently; the start times must agree
+    got = [server.slot_start(position) for position, _ in calendar.next_free(candidates, index.week_masks, afters[4], 10)]
+    expected = [moment for moment, _ in expected]
+    print(f"  materialized one specialty  ({len(candidates):5d} doctors) "
+          f"p50 {percentile(timings, 50) * 1000:7.2f}ms  (results match: {got == expected})")
+
+
+BENCHMARKS = {
+    "password_hashing": bench_password_hashing,
+    "classifier": bench_classifier,
+    "stt_uploads": bench_stt_uploads,
+    "slot_queries": bench_slot_queries,
+}
+
+
+async def run(names):
+    for name in names:
+        await BENCHMARKS[name]()
+        print()
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"Unknown benchmark(s): {', '.join(unknown)}. Available: {', '.join(BENCHMARKS)}")
+        return 1
+    asyncio.run(run(names))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
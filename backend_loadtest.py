@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""Async load generator for the CareBot API, with per-endpoint latency percentiles.
+
+Usage:
+    python backend_loadtest.py                       # in-process, offline: fake providers, in-memory Mongo
+    python backend_loadtest.py --users 100 --duration 60 --llm-latency 1.5
+    python backend_loadtest.py --base-url http://localhost:8001/api   # a running server, real providers
+    python backend_loadtest.py --budget chat_message=1500 --budget doctors=50   # exit 1 if a p95 is over
+
+Offline mode needs mongomock-motor (see backend/requirements.txt) and drives the app through
+httpx's ASGI transport, so nothing leaves the process. Rate limits are off there unless
+RATE_LIMITS is set; against a running server, start it with RATE_LIMITS="" to measure capacity.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+
+CHAT_MESSAGES = [
+    "I've had a headache since this morning",
+    "I have a mild fever and a sore throat",
+    "My stomach hurts after eating",
+    "I feel tired all the time",
+    "I have a cough that won't go away",
+    "My back hurts when I bend over",
+    "I get dizzy when I stand up quickly",
+    "I have a rash on my arm that itches",
+    "I can't sleep well at night",
+    "My knee is swollen after running",
+    "I have chest pain and trouble breathing",
+    "What should I do about seasonal allergies?",
+]
+
+FAKE_REPLIES = [
+    "This sounds like it could be a tension headache. Rest, stay hydrated and limit screen time. "
+    "⚠️ This is not a medical diagnosis. Please consult a healthcare professional if symptoms persist or worsen.",
+    "A mild fever with a sore throat is often viral. Drink fluids and rest. You may want to consult a doctor "
+    "if it lasts more than three days. ⚠️ This is not a medical diagnosis.",
+    "Fatigue has many causes, including poor sleep and stress. Consider seeing a doctor for a check-up. "
+    "⚠️ This is not a medical diagnosis. Please consult a healthcare professional if symptoms persist or worsen.",
+]
+
+# (action, weight): roughly what a day of real patient traffic looks like
+TRAFFIC_MIX = [
+    ("chat_message", 30),
+    ("chat_stream", 8),
+    ("chat_sessions", 10),
+    ("session_messages", 8),
+    ("doctors", 14),
+    ("doctor", 4),
+    ("next_slots", 6),
+    ("book_appointment", 4),
+    ("appointments", 6),
+    ("text_to_speech", 5),
+    ("speech_to_text", 5),
+]
+
+
+# ============== FAKE PROVIDERS ==============
+
+class Latency:
+    """Log-normal delay around a mean, like real upstream response times"""
+
+    def __init__(self, mean: float, rng: random.Random):
+        self.mean = mean
+        self.rng = rng
+
+    async def wait(self, scale: float = 1.0):
+        if self.mean > 0:
+            await asyncio.sleep(scale * self.mean * self.rng.lognormvariate(-0.125, 0.5))
+
+
+class FakeChat:
+    """Stands in for LlmChat: same messages list and send_message coroutine"""
+
+    def __init__(self, latency: Latency, rng: random.Random):
+        self.latency = latency
+        self.rng = rng
+        self.messages = []
+
+    async def send_message(self, message):
+        await self.latency.wait()
+        return self.rng.choice(FAKE_REPLIES)
+
+
+class FakeSpeechToText:
+    def __init__(self, latency: Latency):
+        self.latency = latency
+
+    async def transcribe(self, file, model, response_format, language):
+        size = 0
+        while chunk := file.read(64 * 1024):
+            size += len(chunk)
+        # Whisper time grows with the clip
+        await self.latency.wait(scale=0.5 + size / (256 * 1024))
+        return type("Transcription", (), {"text": random.choice(CHAT_MESSAGES)})()
+
+
+class FakeTextToSpeech:
+    def __init__(self, latency: Latency):
+        self.latency = latency
+
+    async def generate_speech(self, text, model, voice, response_format):
+        await self.latency.wait(scale=0.5 + len(text) / 200)
+        # ~16 kB per second of speech at 128 kbps, ~15 characters per second
+        return b"ID3" + os.urandom(max(1024, len(text) * 1000))
+
+
+class FakeProviders:
+    """Drop-in for server.ProviderClients backed by the fakes above"""
+
+    def __init__(self, llm_latency: Latency, stt_latency: Latency, tts_latency: Latency, rng: random.Random):
+        self.api_key = "offline"
+        self.llm_latency = llm_latency
+        self.rng = rng
+        self.stt = FakeSpeechToText(stt_latency)
+        self.tts = FakeTextToSpeech(tts_latency)
+
+    def chat(self, session_id, system_message):
+        return FakeChat(self.llm_latency, self.rng)
+
+    async def close(self):
+        pass
+
+
+def fake_acompletion(latency: Latency, rng: random.Random):
+    """Stands in for litellm.acompletion(stream=True): word-sized deltas after a first-token delay"""
+
+    class Chunk:
+        def __init__(self, text):
+            delta = type("Delta", (), {"content": text})()
+            self.choices = [type("Choice", (), {"delta": delta})()]
+
+    async def acompletion(**kwargs):
+        await latency.wait(scale=0.3)
+        words = rng.choice(FAKE_REPLIES).split(" ")
+
+        async def stream():
+            for word in words:
+                await asyncio.sleep(latency.mean * 0.7 / len(words))
+                yield Chunk(word + " ")
+        return stream()
+
+    return acompletion
+
+
+async def offline_app(args):
+    """Import the server against in-memory Mongo and fake providers; returns (server module, app)"""
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("Offline mode needs mongomock-motor: pip install mongomock-motor")
+
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "carebot_loadtest")
+    os.environ.setdefault("JWT_SECRET", "loadtest-secret")
+    os.environ.setdefault("EMERGENT_LLM_KEY", "offline")
+    # Measure capacity, not the per-user limits every virtual user would soon run into
+    os.environ.setdefault("RATE_LIMITS", "")
+    os.environ.setdefault("RATE_LIMITS_GLOBAL", "")
+    os.environ["TTS_CACHE_DIR"] = tempfile.mkdtemp(prefix="carebot-tts-")
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    rng = random.Random(args.seed)
+    server.client = AsyncMongoMockClient()
+    server.db = server.client[os.environ["DB_NAME"]]
+    server.providers = FakeProviders(
+        Latency(args.llm_latency, rng), Latency(args.stt_latency, rng), Latency(args.tts_latency, rng), rng
+    )
+    server.acompletion = fake_acompletion(Latency(args.llm_latency, rng), rng)
+    await server.app.router.startup()
+    return server, server.app
+
+
+# ============== LOAD GENERATION ==============
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def record(self, label: str, seconds: float, status):
+        self.latencies[label].append(seconds)
+        self.statuses[label][status] += 1
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class VirtualUser:
+    """One patient: registers, logs in, then performs weighted actions until the deadline"""
+
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, rng: random.Random, think_time: float,
+                 time_first_token: bool):
+        self.client = client
+        self.time_first_token = time_first_token
+        self.recorder = recorder
+        self.rng = rng
+        self.think_time = think_time
+        self.headers = {}
+        self.session_id = None
+        self.appointments = []
+
+    async def request(self, label: str, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, headers=self.headers, **kwargs)
+        except Exception as e:
+            self.recorder.record(label, time.perf_counter() - started, type(e).__name__)
+            return None
+        self.recorder.record(label, time.perf_counter() - started, response.status_code)
+        return response
+
+    async def sign_up(self):
+        email = f"load-{uuid.uuid4().hex[:12]}@example.com"
+        credentials = {"email": email, "password": "load-test-password"}
+        await self.request("register", "POST", "/auth/register",
+                           json={**credentials, "full_name": "Load Test", "age": self.rng.randint(18, 90)})
+        response = await self.request("login", "POST", "/auth/login", json=credentials)
+        if response is None or response.status_code != 200:
+            return False
+        self.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        return True
+
+    async def chat_message(self):
+        body = {"message": self.rng.choice(CHAT_MESSAGES), "session_id": self.session_id}
+        response = await self.request("chat_message", "POST", "/chat/message", json=body)
+        if response is not None and response.status_code == 200:
+            self.session_id = response.json()["session_id"]
+
+    async def chat_stream(self):
+        body = {"message": self.rng.choice(CHAT_MESSAGES), "session_id": self.session_id}
+        started = time.perf_counter()
+        first_token = None
+        try:
+            async with self.client.stream("POST", "/chat/message/stream", json=body, headers=self.headers) as response:
+                async for line in response.aiter_lines():
+                    if first_token is None and line == "event: token":
+                        first_token = time.perf_counter() - started
+                status = response.status_code
+        except Exception as e:
+            status = type(e).__name__
+        self.recorder.record("chat_stream", time.perf_counter() - started, status)
+        if self.time_first_token and first_token is not None:
+            self.recorder.record("chat_stream_first_token", first_token, status)
+
+    async def chat_sessions(self):
+        await self.request("chat_sessions", "GET", "/chat/sessions", params={"limit": 20})
+
+    async def session_messages(self):
+        if self.session_id is None:
+            return await self.chat_message()
+        await self.request("session_messages", "GET", f"/chat/sessions/{self.session_id}/messages", params={"limit": 50})
+
+    async def doctors(self):
+        params = self.rng.choice([{}, {"min_rating": 4.8}, {"specialty": "Family Medicine"}, {"sort": "name"}])
+        await self.request("doctors", "GET", "/doctors", params=params)
+
+    async def doctor(self):
+        await self.request("doctor", "GET", f"/doctors/doc-{self.rng.randint(1, 4)}")
+
+    async def next_slots(self):
+        await self.request("next_slots", "GET", "/slots/next", params={"limit": 10})
+
+    async def book_appointment(self):
+        if self.appointments and self.rng.random() < 0.5:
+            appointment_id = self.appointments.pop()
+            await self.request("cancel_appointment", "PATCH", f"/appointments/{appointment_id}/cancel")
+            return
+        response = await self.request("next_slots", "GET", "/slots/next", params={"limit": 20})
+        if response is None or response.status_code != 200 or not response.json():
+            return
+        slot = self.rng.choice(response.json())
+        body = {"doctor_id": slot["doctor_id"], "slot": slot["start"], "symptoms": self.rng.choice(CHAT_MESSAGES)}
+        response = await self.request("book_appointment", "POST", "/appointments", json=body)
+        if response is not None and response.status_code == 200:
+            self.appointments.append(response.json()["id"])
+
+    async def appointments_list(self):
+        await self.request("appointments", "GET", "/appointments", params={"limit": 20})
+
+    async def text_to_speech(self):
+        text = self.rng.choice(FAKE_REPLIES)
+        await self.request("text_to_speech", "POST", "/voice/text-to-speech", json={"text": text})
+
+    async def speech_to_text(self):
+        clip = b"\x1a\x45\xdf\xa3" + os.urandom(self.rng.randint(20, 200) * 1024)
+        files = {"audio_file": ("clip.webm", clip, "audio/webm")}
+        await self.request("speech_to_text", "POST", "/voice/speech-to-text", files=files)
+
+    async def run(self, deadline: float):
+        if not self.headers:
+            return
+        actions = {
+            "chat_message": self.chat_message,
+            "chat_stream": self.chat_stream,
+            "chat_sessions": self.chat_sessions,
+            "session_messages": self.session_messages,
+            "doctors": self.doctors,
+            "doctor": self.doctor,
+            "next_slots": self.next_slots,
+            "book_appointment": self.book_appointment,
+            "appointments": self.appointments_list,
+            "text_to_speech": self.text_to_speech,
+            "speech_to_text": self.speech_to_text,
+        }
+        names = [name for name, _ in TRAFFIC_MIX]
+        weights = [weight for _, weight in TRAFFIC_MIX]
+        while time.perf_counter() < deadline:
+            await actions[self.rng.choices(names, weights)[0]]()
+            if self.think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / self.think_time))
+
+
+def report(recorder: Recorder, elapsed: float) -> dict:
+    summary = {}
+    print(f"{'endpoint':26s} {'count':>7s} {'rps':>7s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s}  statuses")
+    for label in sorted(recorder.latencies):
+        samples = recorder.latencies[label]
+        summary[label] = {
+            "count": len(samples),
+            "rps": len(samples) / elapsed,
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "statuses": {str(status): count for status, count in recorder.statuses[label].items()},
+        }
+        row = summary[label]
+        statuses = " ".join(f"{status}:{count}" for status, count in sorted(row["statuses"].items()))
+        print(f"{label:26s} {row['count']:7d} {row['rps']:7.1f} "
+              f"{row['p50_ms']:8.1f} {row['p95_ms']:8.1f} {row['p99_ms']:8.1f}  {statuses}")
+    total = sum(len(samples) for samples in recorder.latencies.values())
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+    return summary
+
+
+def over_budget(summary: dict, budgets: list) -> list:
+    failures = []
+    for budget in budgets:
+        label, _, limit = budget.partition("=")
+        p95 = summary.get(label, {}).get("p95_ms")
+        if p95 is not None and p95 > float(limit):
+            failures.append(f"{label} p95 {p95:.1f}ms > {float(limit):.1f}ms")
+    return failures
+
+
+async def run(args) -> int:
+    server = None
+    if args.base_url:
+        transport, base_url = None, args.base_url.rstrip("/")
+    else:
+        server, app = await offline_app(args)
+        transport, base_url = httpx.ASGITransport(app=app), "http://loadtest/api"
+
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users * 2)
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=120, limits=limits) as client:
+        print(f"🚦 {args.users} users for {args.duration:.0f}s against {base_url}"
+              + ("" if args.base_url else f" (offline: LLM {args.llm_latency}s, STT {args.stt_latency}s, TTS {args.tts_latency}s)"))
+        # The ASGI transport hands over whole bodies, so time-to-first-token only means something over a socket
+        users = [
+            VirtualUser(client, recorder, random.Random(rng.random()), args.think_time, bool(args.base_url))
+            for _ in range(args.users)
+        ]
+        # Sign-ups are bcrypt-bound; they are measured but kept out of the timed mix
+        await asyncio.gather(*(user.sign_up() for user in users))
+
+        started = time.perf_counter()
+        deadline = started + args.duration
+
+        async def start(user, delay):
+            await asyncio.sleep(delay)
+            await user.run(deadline)
+
+        await asyncio.gather(*(start(user, args.ramp * i / args.users) for i, user in enumerate(users)))
+        elapsed = time.perf_counter() - started
+
+    print()
+    summary = report(recorder, elapsed)
+    if server is not None:
+        await server.app.router.shutdown()
+    if args.json:
+        Path(args.json).write_text(json.dumps({"elapsed_seconds": elapsed, "endpoints": summary}, indent=2))
+
+    failures = over_budget(summary, args.budget)
+    for failure in failures:
+        print(f"❌ {failure}")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load")
+    parser.add_argument("--ramp", type=float, default=2, help="seconds over which users start")
+    parser.add_argument("--think-time", type=float, default=0.2, help="mean pause between a user's actions")
+    parser.add_argument("--base-url", help="drive a running server instead, e.g. http://localhost:8001/api")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="mean fake LLM latency (offline)")
+    parser.add_argument("--stt-latency", type=float, default=0.4, help="mean fake STT latency (offline)")
+    parser.add_argument("--tts-latency", type=float, default=0.3, help="mean fake TTS latency (offline)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="also write the summary to this file")
+    parser.add_argument("--budget", action="append", default=[], metavar="ENDPOINT=P95_MS",
+                        help="fail (exit 1) when an endpoint's p95 exceeds this; repeatable")
+    return asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -82,6 +82,23 @@ class HealthcareChatbotAPITester:
         self.log_test("Health Check", success, "" if success else response)
         return success
 
+    def test_liveness_and_readiness(self):
+        """Test liveness and cached dependency readiness"""
+        success, response = self.make_request('GET', 'health/live', expected_status=200)
+        if not success:
+            self.log_test("Liveness Check", False, response)
+            return False
+        success, response = self.make_request('GET', 'health/ready', expected_status=200)
+        if success and isinstance(response, dict):
+            checks = response.get('checks', {})
+            if response.get('status') in ('ready', 'degraded') and {'mongo', 'mongo_pool', 'event_loop', 'llm'} <= set(checks):
+                self.log_test("Readiness Check", True, f"Mongo ping: {checks['mongo'].get('latency_ms')} ms")
+                return True
+            self.log_test("Readiness Check", False, f"Unexpected readiness body: {response}")
+            return False
+        self.log_test("Readiness Check", False, response)
+        return False
+
     def test_user_registration(self):
         """Test user registration"""
         timestamp = int(time.time())
@@ -174,6 +191,51 @@ class HealthcareChatbotAPITester:
             self.log_test("AI Chat Message", False, response)
             return False
 
+    def test_emergency_notice(self):
+        """Test that emergencies get the notice at once, the model's answer after it, and benign look-alikes neither"""
+        notice = "🚨 EMERGENCY"
+        cases = [
+            ("Is it possible to overdose on ibuprofen?", False),
+            ("What are the signs of a heart attack in women?", False),
+            ("I have crushing chest pain spreading to my left arm", True),
+            ("I think I am having a heart attack", True),
+            ("my wife is having a stroke", True),
+            ("my face is drooping", True),
+            ("I want to die", True),
+            ("I took too many pills", True),
+            ("swallowed bleach", True),
+            ("chest pain and trouble breathing", True),
+        ]
+        for message, emergency in cases:
+            started = time.time()
+            success, response = self.make_request('POST', 'chat/message', {"message": message}, expected_status=200)
+            if not success or not isinstance(response, dict):
+                self.log_test("Emergency Notice", False, response)
+                return False
+            content = response.get('content', '')
+            if content.startswith(notice) != emergency or bool(response.get('follow_up_pending')) != emergency:
+                self.log_test("Emergency Notice", False, f"Notice {'missing' if emergency else 'shown'} for: {message}")
+                return False
+            if emergency and response.get('severity') != 'emergency':
+                self.log_test("Emergency Notice", False, f"Severity {response.get('severity')} for: {message}")
+                return False
+            # The notice must not wait for the model
+            if emergency and time.time() - started > 2:
+                self.log_test("Emergency Notice", False, f"Notice took {time.time() - started:.1f}s for: {message}")
+                return False
+        
+        # The model's answer follows the last notice as a second assistant message
+        for _ in range(30):
+            success, messages = self.make_request('GET', f"chat/sessions/{response['session_id']}/messages", expected_status=200)
+            if success and len(messages) >= 3:
+                break
+            time.sleep(2)
+        if not success or len(messages) < 3 or messages[2].get('role') != 'assistant':
+            self.log_test("Emergency Notice", False, "Model's answer never followed the notice")
+            return False
+        self.log_test("Emergency Notice", True)
+        return True
+
     def test_chat_sessions(self):
         """Test retrieving chat sessions"""
         success, response = self.make_request('GET', 'chat/sessions', expected_status=200)
@@ -195,6 +257,32 @@ class HealthcareChatbotAPITester:
             self.log_test("Chat Sessions Retrieval", False, response)
             return False
 
+    def test_chat_message_stream(self):
+        """Test streaming a chat reply over server-sent events"""
+        url = f"{self.base_url}/chat/message/stream"
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.token}'}
+        chat_data = {
+            "message": "Thanks. Should I drink more water?",
+            "session_id": self.session_id
+        }
+        
+        try:
+            response = requests.post(url, json=chat_data, headers=headers, stream=True, timeout=60)
+            if response.status_code != 200:
+                self.log_test("AI Chat Message Stream", False, f"Status {response.status_code}")
+                return False
+            
+            events = [line[len("event: "):] for line in response.iter_lines(decode_unicode=True) if line.startswith("event: ")]
+            if events and events[0] == "session" and "token" in events and events[-1] == "done":
+                self.log_test("AI Chat Message Stream", True)
+                return True
+            else:
+                self.log_test("AI Chat Message Stream", False, f"Unexpected event sequence: {events[:5]}")
+                return False
+        except Exception as e:
+            self.log_test("AI Chat Message Stream", False, f"Request error: {str(e)}")
+            return False
+
     def test_doctors_listing(self):
         """Test retrieving doctors list"""
         success, response = self.make_request('GET', 'doctors', expected_status=200)
@@ -298,6 +386,92 @@ class HealthcareChatbotAPITester:
             self.log_test("Appointment Cancellation", False, response)
             return False
 
+    def register_race_users(self, count):
+        """Fresh accounts, so each stays within its own write rate limit during the race"""
+        stamp = int(time.time() * 1000)
+        tokens = []
+        for i in range(count):
+            response = requests.post(f"{self.base_url}/auth/register", json={
+                "full_name": f"Race User {i}",
+                "email": f"race{stamp}-{i}@example.com",
+                "password": "testpass123",
+                "age": 30
+            }, timeout=30)
+            if response.status_code != 200:
+                return None
+            tokens.append(response.json()['access_token'])
+        return tokens
+
+    def test_slot_reservation_race(self, bookings=200, users=20):
+        """Test that parallel bookings of one slot produce exactly one appointment"""
+        from concurrent.futures import ThreadPoolExecutor
+        
+        success, doctor = self.make_request('GET', 'doctors/doc-3', expected_status=200)
+        if not success or not doctor.get('available_slots'):
+            self.log_test("Slot Reservation Race", False, "No free slot to book")
+            return False
+        
+        # bookings / users stays within each user's write burst, so every request reaches the slot
+        tokens = self.register_race_users(users)
+        if not tokens:
+            self.log_test("Slot Reservation Race", False, "Could not register race users")
+            return False
+        
+        slot = doctor['available_slots'][0]
+        url = f"{self.base_url}/appointments"
+        booking = {"doctor_id": "doc-3", "slot": slot, "symptoms": "Concurrent booking test"}
+        
+        def book(i):
+            headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {tokens[i % users]}'}
+            return i % users, requests.post(url, json=booking, headers=headers, timeout=60)
+        
+        try:
+            with ThreadPoolExecutor(max_workers=50) as pool:
+                results = list(pool.map(book, range(bookings)))
+        except Exception as e:
+            self.log_test("Slot Reservation Race", False, f"Request error: {str(e)}")
+            return False
+        
+        winners = [(user, r.json()) for user, r in results if r.status_code == 200]
+        conflicts = sum(1 for _, r in results if r.status_code == 409)
+        if len(winners) != 1 or conflicts != bookings - 1:
+            statuses = sorted({r.status_code for _, r in results})
+            self.log_test("Slot Reservation Race", False, f"{len(winners)} bookings won, {conflicts} conflicts, statuses {statuses}")
+            return False
+        
+        # Cancelling the winner frees the slot again
+        user, appointment = winners[0]
+        requests.patch(f"{url}/{appointment['id']}/cancel", headers={'Authorization': f'Bearer {tokens[user]}'}, timeout=30)
+        success, doctor = self.make_request('GET', 'doctors/doc-3', expected_status=200)
+        if success and slot in doctor['available_slots']:
+            self.log_test("Slot Reservation Race", True, f"1 of {bookings} bookings won")
+            return True
+        self.log_test("Slot Reservation Race", False, "Slot not released after cancellation")
+        return False
+
+    def test_rate_limiting(self, requests_sent=150):
+        """Test that a burst beyond the per-user read limit gets 429 with Retry-After"""
+        from concurrent.futures import ThreadPoolExecutor
+        
+        url = f"{self.base_url}/doctors/specialties"
+        headers = {'Authorization': f'Bearer {self.token}'}
+        try:
+            with ThreadPoolExecutor(max_workers=50) as pool:
+                responses = list(pool.map(lambda _: requests.get(url, headers=headers, timeout=30), range(requests_sent)))
+        except Exception as e:
+            self.log_test("Rate Limiting", False, f"Request error: {str(e)}")
+            return False
+        
+        limited = [r for r in responses if r.status_code == 429]
+        if not limited:
+            self.log_test("Rate Limiting", False, f"No 429 in {requests_sent} requests")
+            return False
+        if not all(r.headers.get('Retry-After', '').isdigit() for r in limited):
+            self.log_test("Rate Limiting", False, "429 without a Retry-After header")
+            return False
+        self.log_test("Rate Limiting", True, f"{len(limited)} of {requests_sent} requests limited")
+        return True
+
     def test_voice_voices_endpoint(self):
         """Test getting available voices"""
         success, response = self.make_request('GET', 'voice/voices', expected_status=200)
@@ -348,51 +522,106 @@ class HealthcareChatbotAPITester:
             self.log_test("Voice Text-to-Speech", False, response)
             return False
 
+    def test_voice_text_to_speech_stream(self):
+        """Test streamed MP3 audio with ETag revalidation and byte ranges"""
+        headers = {'Authorization': f'Bearer {self.token}'}
+        
+        try:
+            # The text is posted once; playback fetches the clip by an opaque id
+            clip = requests.post(
+                f"{self.base_url}/voice/text-to-speech/clips",
+                json={"text": "Hello, this is a test of the text to speech functionality."},
+                headers=headers,
+                timeout=30
+            )
+            if clip.status_code != 200:
+                self.log_test("Voice Text-to-Speech Stream", False, f"Clip registration {clip.status_code}")
+                return False
+            url = f"{self.base_url}/voice/text-to-speech/clips/{clip.json()['clip_id']}"
+            response = requests.get(url, headers=headers, stream=True, timeout=60)
+            audio = b"".join(response.iter_content(chunk_size=16384))
+            if response.status_code != 200 or response.headers.get('Content-Type') != 'audio/mpeg' or not audio:
+                self.log_test("Voice Text-to-Speech Stream", False, f"Status {response.status_code}")
+                return False
+            
+            etag = response.headers.get('ETag')
+            cached = requests.get(url, headers={**headers, 'If-None-Match': etag}, timeout=30)
+            partial = requests.get(url, headers={**headers, 'Range': 'bytes=0-99'}, timeout=30)
+            # A weak tag in If-Range must not splice a partial response onto a different rendering
+            weak = requests.get(url, headers={**headers, 'Range': 'bytes=0-99', 'If-Range': 'W/"x"'}, timeout=30)
+            if cached.status_code == 304 and partial.status_code == 206 and partial.content == audio[:100] and weak.status_code == 200:
+                self.log_test("Voice Text-to-Speech Stream", True)
+                return True
+            else:
+                self.log_test("Voice Text-to-Speech Stream", False, f"Revalidation {cached.status_code}, range {partial.status_code}")
+                return False
+        except Exception as e:
+            self.log_test("Voice Text-to-Speech Stream", False, f"Request error: {str(e)}")
+            return False
+
     def test_voice_speech_to_text(self):
         """Test speech-to-text conversion (mock test since we can't generate real audio)"""
         # Create a minimal mock audio file for testing
         import io
         
-        # Create a simple mock audio blob (this will likely fail but tests the endpoint)
-        mock_audio = b"mock audio data for testing"
-        
-        # Use requests directly for file upload
         url = f"{self.base_url}/voice/speech-to-text"
         headers = {}
         if self.token:
             headers['Authorization'] = f'Bearer {self.token}'
         
-        files = {'audio_file': ('test.webm', io.BytesIO(mock_audio), 'audio/webm')}
-        
         try:
+            # Bytes that are not audio at all are rejected by header sniffing before transcription
+            files = {'audio_file': ('test.webm', io.BytesIO(b"mock audio data for testing"), 'audio/webm')}
             response = requests.post(url, files=files, headers=headers, timeout=30)
-            
-            # We expect this to fail with 500 due to invalid audio, but endpoint should exist
-            if response.status_code in [200, 500]:
-                if response.status_code == 500:
-                    # Check if it's a transcription error (expected with mock data)
-                    try:
-                        error_data = response.json()
-                        if 'Transcription failed' in str(error_data):
-                            self.log_test("Voice Speech-to-Text Endpoint", True, "Endpoint exists (failed with mock audio as expected)")
-                            return True
-                    except:
-                        pass
-                elif response.status_code == 200:
-                    # Unexpected success with mock data
-                    self.log_test("Voice Speech-to-Text Endpoint", True, "Endpoint working (unexpected success with mock data)")
-                    return True
-                
-                self.log_test("Voice Speech-to-Text Endpoint", False, f"Unexpected response: {response.status_code}")
-                return False
-            else:
-                self.log_test("Voice Speech-to-Text Endpoint", False, f"Endpoint error: {response.status_code}")
+            if response.status_code != 415:
+                self.log_test("Voice Speech-to-Text Endpoint", False, f"Expected 415 for non-audio upload, got {response.status_code}")
                 return False
+            
+            # A WebM header with a junk body reaches the transcriber (this will likely fail but tests the endpoint)
+            mock_audio = b"\x1a\x45\xdf\xa3" + b"mock audio data for testing"
+            files = {'audio_file': ('test.webm', io.BytesIO(mock_audio), 'audio/webm')}
+            response = requests.post(url, files=files, headers=headers, timeout=30)
+            
+            if response.status_code == 500 and 'Transcription failed' in response.text:
+                self.log_test("Voice Speech-to-Text Endpoint", True, "Endpoint exists (failed with mock audio as expected)")
+                return True
+            elif response.status_code == 200:
+                self.log_test("Voice Speech-to-Text Endpoint", True, "Endpoint working (unexpected success with mock data)")
+                return True
+            
+            self.log_test("Voice Speech-to-Text Endpoint", False, f"Unexpected response: {response.status_code}")
+            return False
                 
         except Exception as e:
             self.log_test("Voice Speech-to-Text Endpoint", False, f"Request error: {str(e)}")
             return False
 
+    def test_voice_turn_websocket(self):
+        """Test the voice-turn WebSocket accepts a turn (mock audio, so transcription will likely fail)"""
+        from websockets.sync.client import connect
+        
+        url = self.base_url.replace("https://", "wss://").replace("http://", "ws://") + "/voice/turn"
+        try:
+            with connect(url, open_timeout=30) as websocket:
+                websocket.send(json.dumps({"type": "auth", "token": self.token}))
+                ready = json.loads(websocket.recv(timeout=30))
+                if ready.get("type") != "ready":
+                    self.log_test("Voice Turn WebSocket", False, f"Not authenticated: {ready}")
+                    return False
+                websocket.send(json.dumps({"type": "start", "filename": "test.webm"}))
+                websocket.send(b"\x1a\x45\xdf\xa3" + b"mock audio data for testing")
+                websocket.send(json.dumps({"type": "end"}))
+                event = json.loads(websocket.recv(timeout=60))
+            
+            if event.get("type") == "transcript" or (event.get("type") == "error" and event.get("status") == 500):
+                self.log_test("Voice Turn WebSocket", True, f"First event: {event.get('type')}")
+                return True
+            self.log_test("Voice Turn WebSocket", False, f"Unexpected event: {event}")
+            return False
+        except Exception as e:
+            self.log_test("Voice Turn WebSocket", False, f"WebSocket error: {str(e)}")
+            return False
+
     def run_all_tests(self):
         """Run all API tests in sequence"""
         print("🚀 Starting Healthcare Chatbot API Tests")
@@ -402,18 +631,25 @@ class HealthcareChatbotAPITester:
         # Test sequence
         tests = [
             self.test_health_check,
+            self.test_liveness_and_readiness,
             self.test_user_registration,
             self.test_user_login,
             self.test_protected_route_access,
             self.test_chat_message,
+            self.test_chat_message_stream,
+            self.test_emergency_notice,
             self.test_chat_sessions,
             self.test_doctors_listing,
             self.test_appointment_booking,
             self.test_appointments_listing,
             self.test_appointment_cancellation,
+            self.test_slot_reservation_race,
             self.test_voice_voices_endpoint,
             self.test_voice_text_to_speech,
-            self.test_voice_speech_to_text
+            self.test_voice_text_to_speech_stream,
+            self.test_voice_speech_to_text,
+            self.test_voice_turn_websocket,
+            self.test_rate_limiting
         ]
         
         for test in tests:
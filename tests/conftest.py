@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# server.py reads its settings at import time; unit tests never reach these services
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "carebot_test")
+os.environ.setdefault("JWT_SECRET", "test-secret")
+os.environ.setdefault("EMERGENT_LLM_KEY", "test-key")
+os.environ.setdefault("TTS_CACHE_DIR", tempfile.mkdtemp(prefix="carebot-tts-"))
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
@@ -0,0 +1,28 @@
+import asyncio
+from types import SimpleNamespace
+
+import server
+
+
+def test_pool_saturation():
+    monitor = server.MongoPoolMonitor()
+    monitor.checked_out[("db", 27017)] = 5
+    assert monitor.saturation(10) == 0.5
+    # maxPoolSize=0 means unbounded: there is no share to report
+    assert monitor.saturation(0) is None
+
+
+def test_readiness_with_unbounded_pool(monkeypatch):
+    async def ping(command):
+        return {"ok": 1}
+
+    options = SimpleNamespace(pool_options=SimpleNamespace(max_pool_size=0))
+    monkeypatch.setattr(server, "client", SimpleNamespace(options=options))
+    monkeypatch.setattr(server, "db", SimpleNamespace(command=ping))
+
+    result = asyncio.run(server.ReadinessProbe(0).probe())
+
+    pool = result["checks"]["mongo_pool"]
+    assert pool["ok"] is True
+    assert pool["saturation"] is None
+    assert result["status"] in ("ready", "degraded")
@@ -0,0 +1,119 @@
+import asyncio
+import io
+import itertools
+import struct
+import tracemalloc
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def webm(duration_ms=None, body=b""):
+    """EBML header, then a Segment of unknown size whose Info may state a duration"""
+    info = b""
+    if duration_ms is not None:
+        info = b"\x15\x49\xa9\x66\x8b" + b"\x44\x89\x88" + struct.pack(">d", duration_ms)
+    return b"\x1a\x45\xdf\xa3\x80" + b"\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff" + info + body
+
+
+def flac(seconds, rate=16000):
+    fields = rate << 44 | 0 << 41 | 15 << 36 | seconds * rate
+    streaminfo = bytes(10) + fields.to_bytes(8, "big") + bytes(16)
+    return b"fLaC" + b"\x80\x00\x00\x22" + streaminfo
+
+
+def ogg_opus(seconds, body=b""):
+    def page(header_type, granule, payload):
+        return b"OggS\x00" + bytes([header_type]) + granule.to_bytes(8, "little") + bytes(12) + bytes([1, len(payload)]) + payload
+    return page(2, 0, b"OpusHead" + bytes(11)) + body + page(4, seconds * 48000, bytes(10))
+
+
+def m4a(seconds, body=b""):
+    def box(box_type, payload):
+        return (8 + len(payload)).to_bytes(4, "big") + box_type + payload
+    mvhd = box(b"mvhd", bytes(4) + bytes(8) + (1000).to_bytes(4, "big") + (seconds * 1000).to_bytes(4, "big") + bytes(80))
+    # moov after mdat, as most encoders that don't "fast start" write it
+    return box(b"ftyp", b"M4A " + bytes(4)) + box(b"mdat", body) + box(b"moov", mvhd)
+
+
+def check(data):
+    upload = io.BytesIO(data)
+    try:
+        server.open_audio_upload(upload, "clip")
+    except HTTPException as e:
+        return e.status_code
+    assert upload.tell() == 0
+    return 200
+
+
+@pytest.mark.parametrize("short, long", [
+    (webm(60_000), webm(3_600_000)),
+    (flac(60), flac(3600)),
+    (ogg_opus(60), ogg_opus(3600)),
+    (m4a(60), m4a(3600)),
+])
+def test_duration_from_container(short, long):
+    assert check(short) == 200
+    assert check(long) == 413
+
+
+def test_duration_bound_without_metadata():
+    # A browser-recorded WebM (no Duration) or an MP3 is refused only when it can't fit at 320 kbps
+    assert check(webm(body=bytes(1024 * 1024))) == 200
+    assert check(webm(body=bytes(13 * 1024 * 1024))) == 413
+    assert check(b"ID3" + bytes(13 * 1024 * 1024)) == 413
+
+
+class DrainingTranscriber:
+    """Stands in for Whisper: reads the upload in chunks the way the HTTP client would"""
+
+    async def transcribe(self, file, model, response_format, language):
+        size = 0
+        while chunk := file.read(64 * 1024):
+            size += len(chunk)
+        return type("Transcription", (), {"text": f"{size} bytes"})()
+
+
+def multipart_upload(size, chunk=64 * 1024):
+    async def body():
+        yield (
+            b'--test\r\nContent-Disposition: form-data; name="audio_file"; filename="clip.webm"\r\n'
+            b"Content-Type: audio/webm\r\n\r\n" + webm(60_000)
+        )
+        for offset in range(0, size, chunk):
+            yield bytes(min(chunk, size - offset))
+        yield b"\r\n--test--\r\n"
+    return body()
+
+
+def test_concurrent_uploads_are_not_held_in_memory(monkeypatch):
+    uploads, size = 4, 16 * 1024 * 1024
+    monkeypatch.setattr(server.providers, "stt", DrainingTranscriber())
+    users = itertools.count()
+    monkeypatch.setitem(server.app.dependency_overrides, server.get_current_user, lambda: {"id": f"upload-user-{next(users)}"})
+
+    async def post_all():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=120) as client:
+            return await asyncio.gather(*(
+                client.post(
+                    "/api/voice/speech-to-text",
+                    content=multipart_upload(size),
+                    headers={"Content-Type": "multipart/form-data; boundary=test"}
+                )
+                for _ in range(uploads)
+            ))
+
+    tracemalloc.start()
+    try:
+        responses = asyncio.run(post_all())
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert [response.status_code for response in responses] == [200] * uploads
+    # Buffering would hold every upload (64 MB) at once; streamed they spool to disk
+    assert peak < 8 * 1024 * 1024, f"peak heap {peak / 1024 / 1024:.1f} MB"